@@ -0,0 +1,96 @@
+## Times lib.api_ingest against the local mock API of benchmarks.mock_graphql, serving a synthetic dataset,
+## and checks that the combined table of the fetched records equals the combined table of the whole dumps restricted to the same IDs.
+## Every run fetches a random subset of molecule IDs and of target IDs twice, once cold with simulated latency and failing
+## requests, once from the response cache. Exits with 1 if a combined table differs.
+##
+## python -m benchmarks.bench_api_ingest --scale 0.1 --n_ids 200
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import write_dataset
+from benchmarks.mock_graphql import MockOpenTargets, start_server
+
+
+def combined_table(targets_file, moa_file, molecules_file):
+    from lib.data_process import DataProcess
+    dataprocess_obj = DataProcess(targets_file=targets_file, mechanism_of_action_file=moa_file, molecules_file=molecules_file, use_cache=False)
+    try:
+        dataprocess_obj.preprocess()
+    finally:
+        dataprocess_obj.work_area.cleanup()
+    return dataprocess_obj.combined_data
+
+
+def _sorted_rows(df):
+    columns = sorted(df.columns)
+    return df[columns].astype(str).sort_values(columns).reset_index(drop=True)
+
+
+def fetch(url, cache_dir, concurrency, batch_size, **ids):
+    from lib.api_ingest import ApiIngest
+    ingest = ApiIngest(url=url, cache_dir=cache_dir, concurrency=concurrency, batch_size=batch_size, backoff=0.05, **ids)
+    start = time.perf_counter()
+    ingest.process()
+    seconds = time.perf_counter() - start
+    return ingest, seconds
+
+
+def main(scale=0.1, n_ids=200, concurrency=4, batch_size=50, latency=0.05, fail_every=7, seed=0):
+    data_dir = tempfile.mkdtemp(prefix="bench_api_OT")
+    try:
+        files, counts = write_dataset(os.path.join(data_dir, "dumps"), scale=scale, seed=seed)
+        api = MockOpenTargets(files, latency=latency, fail_every=fail_every)
+        server, url = start_server(api)
+        full = combined_table(files["targets"], files["mechanismOfAction"], files["molecule"])
+
+        rng = random.Random(seed)
+        subsets = {
+            "molecule_ids": (sorted(rng.sample(sorted(api.molecules), min(n_ids, len(api.molecules)))), "ChemblID"),
+            "target_ids": (sorted(rng.sample(sorted(api.known_drugs.keys() & api.targets.keys()), min(n_ids, len(api.targets)))), "EnsemblID"),
+        }
+        failures = []
+        print("ids\tcold_seconds\twarm_seconds\trequests\tcombined_rows\tequal")
+        for name, (ids, column) in subsets.items():
+            cache_dir = os.path.join(data_dir, f"cache_{name}")
+            requests_before = api.requests
+            ingest, cold_seconds = fetch(url, cache_dir, concurrency, batch_size, **{name: ids})
+            try:
+                fetched = combined_table(*ingest.get_combined_files())
+            finally:
+                ingest.cleanup()
+            requests = api.requests - requests_before
+
+            ingest, warm_seconds = fetch(url, cache_dir, concurrency, batch_size, **{name: ids})
+            ingest.cleanup()
+
+            expected = full[full[column].isin(ids)]
+            equal = _sorted_rows(fetched).equals(_sorted_rows(expected))
+            if not equal:
+                failures.append(name)
+            print(f"{len(ids)} {name}\t{cold_seconds:.2f}\t{warm_seconds:.2f}\t{requests}\t{len(fetched)}\t{equal}")
+        server.shutdown()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    if failures:
+        print(f"Combined tables differ from the dumps for {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--scale", type=float, help="Fraction of the real release sizes of the synthetic dumps", required=False, default=0.1)
+    parser.add_argument("--n_ids", type=int, help="Number of molecule and of target IDs fetched", required=False, default=200)
+    parser.add_argument("--concurrency", type=int, help="Requests in flight at a time", required=False, default=4)
+    parser.add_argument("--batch_size", type=int, help="IDs per request", required=False, default=50)
+    parser.add_argument("--latency", type=float, help="Seconds every answer of the mock API is delayed", required=False, default=0.05)
+    parser.add_argument("--fail_every", type=int, help="Every n-th request to the mock API fails with http status 503", required=False, default=7)
+    parser.add_argument("--seed", type=int, help="Seed of the synthetic data and the ID subsets", required=False, default=0)
+    args = parser.parse_args()
+    main(args.scale, args.n_ids, args.concurrency, args.batch_size, args.latency, args.fail_every, args.seed)
@@ -0,0 +1,70 @@
+## Compares utils.convert_json2pandas with the streaming, projected reader on a synthetic targets file.
+## Each reader runs in a fresh process so that the peak RSS of one does not leak into the other.
+##
+## python -m benchmarks.bench_json_reader --size_mb 2048
+
+import multiprocessing
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic import write_targets, file_size_mb
+
+TARGETS_FIELDS = ["id", "biotype", "subcellularLocations"]
+
+
+def _read_normalize(json_file):
+    from utils import convert_json2pandas
+    return len(convert_json2pandas(json_file)[TARGETS_FIELDS])
+
+
+def _read_streaming(json_file):
+    from utils import read_json_fields
+    return len(read_json_fields(json_file, TARGETS_FIELDS, dtypes={"biotype": "category"}))
+
+
+def _run(reader, json_file, queue):
+    import resource
+    start = time.perf_counter()
+    n_rows = reader(json_file)
+    elapsed = time.perf_counter() - start
+    queue.put((n_rows, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def run_reader(reader, json_file):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run, args=(reader, json_file, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(size_mb, keep_file=None, skip_normalize=False):
+    json_file = keep_file if keep_file is not None else tempfile.mktemp(suffix="targets_bench.json")
+    if not os.path.exists(json_file):
+        n_records = write_targets(json_file, size_mb * 2 ** 20)
+        print(f"Generated {n_records} targets ({file_size_mb(json_file):.0f} MB) at {json_file}")
+
+    readers = [("streaming", _read_streaming)]
+    if not skip_normalize:
+        readers.insert(0, ("convert_json2pandas", _read_normalize))
+
+    print("reader\trows\tseconds\tpeak_rss_mb")
+    for name, reader in readers:
+        n_rows, elapsed, peak_rss = run_reader(reader, json_file)
+        print(f"{name}\t{n_rows}\t{elapsed:.2f}\t{peak_rss:.0f}")
+
+    if keep_file is None:
+        os.remove(json_file)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--size_mb", type=int, help="Size of the synthetic targets file", required=False, default=256)
+    parser.add_argument("--keep_file", type=str, help="Reuse or keep the synthetic file at this path", required=False, default=None)
+    parser.add_argument("--skip_normalize", action="store_true", help="Only run the streaming reader, e.g. for inputs larger than RAM", required=False, default=False)
+    args = parser.parse_args()
+    main(args.size_mb, args.keep_file, args.skip_normalize)
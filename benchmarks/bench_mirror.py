@@ -0,0 +1,120 @@
+## Checks lib.mirror.DatasetMirror against the local release server of benchmarks.mock_mirror, serving synthetic part files.
+## Runs a fresh sync with connections cut off in the middle of every file, a rerun that fetches nothing, the rename of a
+## complete partial file of an interrupted run, and a partial file whose remote file changed in the meantime.
+## Every scenario checks the mirrored files byte by byte; exits with 1 if one fails.
+##
+## python -m benchmarks.bench_mirror --scale 0.05 --parts 4
+
+import filecmp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from settings import DATASETS
+from benchmarks.synthetic import write_dataset
+from benchmarks.mock_mirror import MockMirrorState, start_server
+
+
+def write_release(root, scale, parts, seed=0):
+    """
+    Writes the synthetic datasets as root/<dataset>/part-0000<i>.json part files
+    :return: list of the relative part file paths
+    """
+    files, _ = write_dataset(os.path.join(root, "joined"), scale=scale, seed=seed)
+    part_files = []
+    for dataset in DATASETS:
+        os.makedirs(os.path.join(root, dataset), exist_ok=True)
+        with open(files[dataset]) as fh:
+            lines = fh.readlines()
+        for part in range(parts):
+            part_file = os.path.join(dataset, f"part-{part:05d}.json")
+            with open(os.path.join(root, part_file), "w") as fh:
+                fh.writelines(lines[part::parts])
+            part_files.append(part_file)
+    shutil.rmtree(os.path.join(root, "joined"))
+    return part_files
+
+
+def mirror_equal(remote_dir, local_dir, part_files):
+    return all(
+        os.path.exists(os.path.join(local_dir, file)) and filecmp.cmp(os.path.join(remote_dir, file), os.path.join(local_dir, file), shallow=False)
+        for file in part_files
+    )
+
+
+def main(scale=0.05, parts=4, workers=4):
+    from lib.mirror import DatasetMirror
+
+    work_dir = tempfile.mkdtemp(prefix="bench_mirror_OT")
+    remote_dir, local_dir = os.path.join(work_dir, "remote"), os.path.join(work_dir, "local")
+    results = {}
+    try:
+        part_files = write_release(remote_dir, scale, parts)
+        state = MockMirrorState(drop_after=1000)
+        server, url = start_server(remote_dir, state)
+
+        def sync():
+            state.gets.clear()
+            start = time.perf_counter()
+            DatasetMirror(local_dir=local_dir, base_url=url, workers=workers).sync(DATASETS)
+            return time.perf_counter() - start
+
+        ## every first download is cut off after 1000 bytes and resumed with a range request
+        seconds = sync()
+        resumed = sum(1 for _, range_header in state.gets if range_header == "bytes=1000-")
+        results["fresh sync, resumed after cut offs"] = mirror_equal(remote_dir, local_dir, part_files) and resumed == len(part_files)
+        print(f"Fresh sync of {len(part_files)} files in {seconds:.1f}s, {len(state.gets)} GET and {state.heads} HEAD requests, {resumed} resumed")
+
+        sync()
+        results["rerun fetches nothing"] = not state.gets
+
+        ## a complete partial file that was never renamed is only renamed
+        part_file = part_files[0]
+        local_file = os.path.join(local_dir, part_file)
+        os.replace(local_file, local_file + DatasetMirror.PARTIAL_SUFFIX)
+        with open(os.path.join(local_dir, DatasetMirror.MANIFEST)) as fh:
+            manifest = json.load(fh)
+        manifest[part_file + DatasetMirror.PARTIAL_SUFFIX] = manifest.pop(part_file)
+        with open(os.path.join(local_dir, DatasetMirror.MANIFEST), "w") as fh:
+            json.dump(manifest, fh)
+        sync()
+        results["complete partial file renamed"] = not state.gets and mirror_equal(remote_dir, local_dir, part_files)
+
+        ## a partial file of an old version is not resumed after the remote file changed
+        part_file = part_files[1]
+        local_file = os.path.join(local_dir, part_file)
+        with open(local_file, "rb") as fh:
+            old_content = fh.read()
+        os.remove(local_file)
+        with open(local_file + DatasetMirror.PARTIAL_SUFFIX, "wb") as fh:
+            fh.write(old_content[:len(old_content) // 2])
+        remote_file = os.path.join(remote_dir, part_file)
+        with open(remote_file, "wb") as fh:
+            fh.write(old_content[::-1])
+        modified = os.path.getmtime(remote_file) + 10
+        os.utime(remote_file, (modified, modified))
+        sync()
+        results["stale partial file fetched again"] = mirror_equal(remote_dir, local_dir, part_files) and all(
+            range_header is None for path, range_header in state.gets if path.endswith(part_file)
+        )
+        server.shutdown()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for scenario, passed in results.items():
+        print(f"{scenario}\t{'ok' if passed else 'FAILED'}")
+    if not all(results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--scale", type=float, help="Fraction of the real release sizes of the synthetic datasets", required=False, default=0.05)
+    parser.add_argument("--parts", type=int, help="Part files per dataset", required=False, default=4)
+    parser.add_argument("--workers", type=int, help="Files downloaded at the same time", required=False, default=4)
+    args = parser.parse_args()
+    main(args.scale, args.parts, args.workers)
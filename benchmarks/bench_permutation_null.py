@@ -0,0 +1,80 @@
+## Checks the calibration of lib.resampling.permutation_test under the null hypothesis.
+## Synthetic drugs get a modality and target locations drawn independently of it, but the number of rows per drug
+## (the fan-out over targets and locations) depends on the modality, as it does for antibodies and small molecules.
+## The p-values of all cells should then be roughly uniform: the share below a level should be about that level.
+## Exits with 1 if the share of p-values below 0.05 or 0.1, or the Kolmogorov-Smirnov distance to the uniform distribution,
+## is out of bounds.
+##
+## python -m benchmarks.bench_permutation_null --datasets 20 --permutations 500
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+MODALITIES = ["Antibody", "Protein", "Small molecule"]
+## mean rows per drug of every modality
+FAN_OUT = [12, 4, 2]
+N_LOCATIONS = 11
+
+
+def null_dataset(rng, n_drugs=2000):
+    """
+    :return: combined-like table with ChemblID, drugType and subcellular_location_label, locations independent of drugType
+    """
+    modalities = rng.integers(len(MODALITIES), size=n_drugs)
+    rows_per_drug = rng.poisson(np.asarray(FAN_OUT)[modalities]) + 1
+    drug_codes = np.repeat(np.arange(n_drugs), rows_per_drug)
+    ## skewed location frequencies like the real ones
+    location_share = rng.dirichlet(np.ones(N_LOCATIONS))
+    locations = rng.choice(N_LOCATIONS, size=len(drug_codes), p=location_share)
+    return pd.DataFrame({
+        "ChemblID": [f"CHEMBL{code}" for code in drug_codes],
+        "drugType": np.asarray(MODALITIES)[modalities[drug_codes]],
+        "subcellular_location_label": [f"location {code}" for code in locations],
+    })
+
+
+def main(datasets=20, permutations=500, seed=0, workers=None):
+    from scipy.stats import kstest
+    from lib.resampling import ContingencyBlocks, permutation_test
+
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+    p_values = []
+    for dataset in range(datasets):
+        blocks = ContingencyBlocks.from_frame(null_dataset(rng), "ChemblID", "drugType", "subcellular_location_label")
+        ## no early stopping, so every p-value is estimated from all permutations
+        dataset_p_values, _ = permutation_test(blocks, n_permutations=permutations, seed=seed + dataset, workers=workers, confidence_z=1e9)
+        p_values.append(dataset_p_values.to_numpy().ravel())
+    p_values = np.concatenate(p_values)
+
+    failures = []
+    print("level\tshare_below\tallowed")
+    for level in [0.05, 0.1]:
+        share = (p_values <= level).mean()
+        ## the cells of one table are correlated, so the binomial standard error is widened
+        allowed = 4 * np.sqrt(level * (1 - level) / len(p_values)) + 1 / (permutations + 1)
+        print(f"{level}\t{share:.3f}\t{level - allowed:.3f}-{level + allowed:.3f}")
+        if abs(share - level) > allowed:
+            failures.append(f"share below {level}")
+    distance = kstest(p_values, "uniform").statistic
+    print(f"{len(p_values)} p-values of {datasets} datasets in {time.perf_counter() - start:.1f}s, Kolmogorov-Smirnov distance {distance:.3f}")
+    if distance > 0.05:
+        failures.append("Kolmogorov-Smirnov distance")
+
+    if failures:
+        print(f"Permutation p-values are not uniform under the null: {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--datasets", type=int, help="Number of synthetic null datasets", required=False, default=20)
+    parser.add_argument("--permutations", type=int, help="Permutations per dataset", required=False, default=500)
+    parser.add_argument("--seed", type=int, help="Random seed", required=False, default=0)
+    parser.add_argument("--workers", type=int, help="Number of processes running the permutations", required=False, default=None)
+    args = parser.parse_args()
+    main(args.datasets, args.permutations, args.seed, args.workers)
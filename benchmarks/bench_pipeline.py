@@ -0,0 +1,169 @@
+## Times every stage of the pipeline on synthetic datasets of several sizes, see benchmarks.synthetic.write_dataset.
+## Each scale runs in a fresh process with an enabled RunProfile, so the peak RSS of one scale does not leak into the next.
+## Results can be stored as a baseline, later runs are compared with it and regressions make the script exit with 1.
+##
+## python -m benchmarks.bench_pipeline --scales 0.1 0.5 1 --save_baseline benchmarks/baseline.json
+## python -m benchmarks.bench_pipeline --scales 0.1 0.5 1 --baseline benchmarks/baseline.json
+
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import write_dataset, file_size_mb
+
+## input file of the stages that parse json, for the MB/s throughput
+STAGE_INPUTS = {
+    "convert_json2pandas": "targets",
+    "preprocess_targets": "targets",
+    "preprocess_moa": "mechanismOfAction",
+    "preprocess_molecules": "molecule",
+}
+## slowdowns below this many seconds are timer noise, never regressions
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def _run_pipeline(files, out_dir, workers, queue):
+    import matplotlib
+    matplotlib.use("Agg")
+    from lib.data_process import DataProcess
+    from lib.profiling import RunProfile
+
+    profile = RunProfile(enabled=True)
+    dataprocess_obj = DataProcess(
+        targets_file=files["targets"], mechanism_of_action_file=files["mechanismOfAction"], molecules_file=files["molecule"],
+        out_dir=out_dir, use_cache=False, workers=workers, profile=profile,
+    )
+    dataprocess_obj.process()
+    queue.put(profile.stages)
+
+
+def _run_normalize(files, out_dir, workers, queue):
+    from lib.profiling import RunProfile
+    from utils import convert_json2pandas
+
+    profile = RunProfile(enabled=True)
+    with profile.stage("convert_json2pandas") as record:
+        record["rows_out"] = len(convert_json2pandas(files["targets"]))
+    queue.put(profile.stages)
+
+
+def run_in_process(target, files, out_dir, workers=None):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=target, args=(files, out_dir, workers, queue))
+    process.start()
+    stages = queue.get()
+    process.join()
+    return stages
+
+
+def summarize(stages, files):
+    """
+    :return: {stage: wall seconds, peak RSS, rows and throughput}
+    """
+    summary = {}
+    for record in stages:
+        rows = record["rows_in"] if record["rows_in"] is not None else record["rows_out"]
+        seconds = record["wall_seconds"]
+        result = {"seconds": seconds, "peak_rss_mb": record["peak_rss_mb"], "rows": rows}
+        result["rows_per_second"] = round(rows / seconds) if rows and seconds > 0 else None
+        if record["stage"] in STAGE_INPUTS and seconds > 0:
+            result["mb_per_second"] = round(file_size_mb(files[STAGE_INPUTS[record["stage"]]]) / seconds, 2)
+        summary[record["stage"]] = result
+    return summary
+
+
+def run_scale(scale, workers=None, skip_normalize=False, keep_dir=None, seed=0):
+    data_dir = keep_dir if keep_dir is not None else tempfile.mkdtemp(prefix="bench_data_OT")
+    data_dir = os.path.join(data_dir, f"scale_{scale}")
+    start = time.perf_counter()
+    files, counts = write_dataset(data_dir, scale=scale, seed=seed)
+    print(f"Generated scale {scale}: {counts} in {time.perf_counter() - start:.1f}s")
+
+    out_dir = os.path.join(data_dir, "out")
+    stages = [] if skip_normalize else run_in_process(_run_normalize, files, out_dir)
+    stages += run_in_process(_run_pipeline, files, out_dir, workers)
+    result = {"records": counts, "input_mb": round(sum(file_size_mb(file) for file in files.values()), 1), "stages": summarize(stages, files)}
+
+    if keep_dir is None:
+        shutil.rmtree(os.path.dirname(data_dir))
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Adds the baseline seconds and peak RSS to every stage of results
+    :return: list of (scale, stage, metric, value, baseline value) regressions beyond tolerance
+    """
+    regressions = []
+    for scale, result in results["scales"].items():
+        baseline_stages = baseline["scales"].get(scale, {}).get("stages", {})
+        for stage, stage_result in result["stages"].items():
+            if stage not in baseline_stages:
+                continue
+            baseline_result = baseline_stages[stage]
+            stage_result["baseline_seconds"] = baseline_result["seconds"]
+            stage_result["baseline_peak_rss_mb"] = baseline_result["peak_rss_mb"]
+            seconds, baseline_seconds = stage_result["seconds"], baseline_result["seconds"]
+            if seconds > baseline_seconds * (1 + tolerance) and seconds - baseline_seconds > MIN_REGRESSION_SECONDS:
+                regressions.append((scale, stage, "seconds", seconds, baseline_seconds))
+            if stage_result["peak_rss_mb"] > baseline_result["peak_rss_mb"] * (1 + tolerance):
+                regressions.append((scale, stage, "peak_rss_mb", stage_result["peak_rss_mb"], baseline_result["peak_rss_mb"]))
+    return regressions
+
+
+def print_results(results):
+    print("scale\tstage\trows\tseconds\trows/s\tMB/s\tpeak_rss_mb\tbaseline_seconds\tbaseline_peak_rss_mb")
+    for scale, result in results["scales"].items():
+        for stage, stage_result in result["stages"].items():
+            values = [
+                scale, stage, stage_result["rows"], stage_result["seconds"], stage_result["rows_per_second"], stage_result.get("mb_per_second"),
+                stage_result["peak_rss_mb"], stage_result.get("baseline_seconds"), stage_result.get("baseline_peak_rss_mb"),
+            ]
+            print("\t".join("" if value is None else str(value) for value in values))
+
+
+def main(scales, workers=None, skip_normalize=False, keep_dir=None, baseline_file=None, save_baseline=None, tolerance=0.25, output_file=None):
+    results = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "scales": {str(scale): run_scale(scale, workers, skip_normalize, keep_dir) for scale in scales},
+    }
+
+    regressions = []
+    if baseline_file is not None:
+        with open(baseline_file) as fh:
+            regressions = compare(results, json.load(fh), tolerance)
+    print_results(results)
+
+    for file in [output_file, save_baseline]:
+        if file is not None:
+            with open(file, "w") as fh:
+                json.dump(results, fh, indent=2)
+            print(f"Results written to {file}")
+
+    for scale, stage, metric, value, baseline_value in regressions:
+        print(f"REGRESSION scale {scale} {stage} {metric}: {value} vs baseline {baseline_value}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--scales", type=float, nargs="+", help="Dataset sizes as fractions of the real release", required=False, default=[0.05, 0.2, 1.0])
+    parser.add_argument("--workers", type=int, help="Workers of the pipeline", required=False, default=None)
+    parser.add_argument("--skip_normalize", action="store_true", help="Do not time utils.convert_json2pandas on the targets", required=False, default=False)
+    parser.add_argument("--keep_dir", type=str, help="Keep the synthetic datasets and outputs in this directory", required=False, default=None)
+    parser.add_argument("--baseline", type=str, help="Baseline json of an earlier run to compare with", required=False, default=None)
+    parser.add_argument("--save_baseline", type=str, help="Store the results as a baseline json", required=False, default=None)
+    parser.add_argument("--tolerance", type=float, help="Relative slowdown or memory growth over the baseline flagged as a regression", required=False, default=0.25)
+    parser.add_argument("--output", type=str, help="Write the results json to this file", required=False, default=None)
+    args = parser.parse_args()
+    sys.exit(main(args.scales, args.workers, args.skip_normalize, args.keep_dir, args.baseline, args.save_baseline, args.tolerance, args.output))
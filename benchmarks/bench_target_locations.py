@@ -0,0 +1,61 @@
+## Compares the per-row apply flattening of subcellularLocations with DataProcess._flatten_target_locations.
+## Runs on a real targets json file when given, on synthetic targets otherwise.
+##
+## python -m benchmarks.bench_target_locations --targets_file /path/to/targets_combined.json
+
+import random
+import time
+
+import pandas as pd
+
+from benchmarks.synthetic import target_record
+from lib.data_process import DataProcess
+
+
+def _get_target_loc_values(x):
+    location = x.get("location", None)
+    if ":" in location: location = location.split(":")[1].strip()
+    return location, x.get("labelSL", None)
+
+
+def flatten_with_apply(df_targets):
+    """The former implementation: explode, then one pd.Series per location"""
+    df_targets_exp_locs = df_targets.explode("subcellularLocations")
+    df_targets_exp_locs.dropna(subset=["subcellularLocations"], inplace=True)
+    df_targets_exp_locs[["subcellular_location", "subcellular_location_label"]] = df_targets_exp_locs["subcellularLocations"].apply(lambda x: pd.Series(_get_target_loc_values(x)))
+    return df_targets_exp_locs.drop("subcellularLocations", axis=1)
+
+
+def load_targets(targets_file=None, n_targets=63000):
+    if targets_file is not None:
+        return DataProcess._read_json_data(targets_file, DataProcess.TARGETS_FIELDS).dropna(subset=["subcellularLocations"])
+    rng = random.Random(0)
+    records = [target_record(rng, number) for number in range(n_targets)]
+    df_targets = pd.DataFrame([{field: record.get(field) for field in DataProcess.TARGETS_FIELDS} for record in records])
+    return df_targets.dropna(subset=["subcellularLocations"])
+
+
+def main(targets_file=None, n_targets=63000):
+    df_targets = load_targets(targets_file, n_targets)
+    print(f"{len(df_targets)} targets with subcellular locations")
+
+    start = time.perf_counter()
+    expected = flatten_with_apply(df_targets.copy())
+    apply_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    flattened = DataProcess._flatten_target_locations(df_targets.copy())
+    batched_seconds = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(expected, flattened)
+    print(f"{len(flattened)} locations")
+    print(f"apply\t{apply_seconds:.3f}s\nbatched\t{batched_seconds:.3f}s\nspeedup\t{apply_seconds / batched_seconds:.1f}x")
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--targets_file", type=str, help="Targets json lines file, synthetic targets are used if not given", required=False, default=None)
+    parser.add_argument("--n_targets", type=int, help="Number of synthetic targets", required=False, default=63000)
+    args = parser.parse_args()
+    main(args.targets_file, args.n_targets)
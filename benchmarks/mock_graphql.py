@@ -0,0 +1,161 @@
+## Local stand-in for the OpenTargets GraphQL API, answering the queries of lib.api_ingest from dump shaped json lines files,
+## e.g. the synthetic datasets of benchmarks.synthetic.write_dataset. The queries are not parsed, the server answers by
+## operationName with the fields lib.api_ingest asks for. Latency and failing requests can be simulated to exercise
+## the concurrency and the retries of the client.
+##
+## python -m benchmarks.mock_graphql --data_dir /path/to/synthetic --port 18000
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockOpenTargets:
+    """
+    The records of the targets, mechanismOfAction and molecule files, indexed by ID like the API serves them
+    """
+
+    def __init__(self, files, latency=0.0, fail_every=0):
+        """
+        :param files: {"targets", "mechanismOfAction", "molecule": json lines file}
+        :param latency: seconds every answer is delayed
+        :param fail_every: every n-th request fails with http status 503, 0 to never fail
+        """
+        self.targets = {record["id"]: record for record in _read_records(files["targets"])}
+        self.molecules = {record["id"]: record for record in _read_records(files["molecule"])}
+        ## mechanisms by drug and known drugs by target, a drug listed twice in a mechanism gets it twice like the dump
+        self.mechanisms = {}
+        self.known_drugs = {}
+        for record in _read_records(files["mechanismOfAction"]):
+            for chembl_id in record.get("chemblIds") or []:
+                self.mechanisms.setdefault(chembl_id, []).append(record)
+                for target in record.get("targets") or []:
+                    self.known_drugs.setdefault(target, []).append(chembl_id)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        """
+        :return: False if this request should fail
+        """
+        with self._lock:
+            self.requests += 1
+            return not self.fail_every or self.requests % self.fail_every != 0
+
+    def answer(self, operation_name, variables):
+        if operation_name == "Targets":
+            return {"targets": [self._target(self.targets[id_]) for id_ in variables["ids"] if id_ in self.targets]}
+        if operation_name == "Drugs":
+            return {"drugs": [self._drug(self.molecules[id_]) for id_ in variables["ids"] if id_ in self.molecules]}
+        if operation_name == "TargetDrugs":
+            return {"targets": [
+                {"id": id_, "knownDrugs": self._known_drugs(id_, variables["size"], None)} for id_ in variables["ids"] if id_ in self.targets
+            ]}
+        if operation_name == "TargetDrugsPage":
+            id_ = variables["id"]
+            if id_ not in self.targets:
+                return {"target": None}
+            return {"target": {"id": id_, "knownDrugs": self._known_drugs(id_, variables["size"], variables.get("cursor"))}}
+        raise ValueError(f"Unknown operation {operation_name}")
+
+    @staticmethod
+    def _target(record):
+        return {
+            "id": record["id"], "biotype": record.get("biotype"), "alternativeGenes": record.get("alternativeGenes") or [],
+            "subcellularLocations": record.get("subcellularLocations") or [],
+        }
+
+    def _drug(self, record):
+        linked_targets = record.get("linkedTargets") or {"rows": [], "count": 0}
+        return {
+            "id": record["id"],
+            "drugType": record.get("drugType"),
+            "parentMolecule": {"id": record["parentId"]} if record.get("parentId") else None,
+            "childMolecules": [{"id": child} for child in record.get("childChemblIds") or []],
+            "linkedTargets": {"count": linked_targets["count"], "rows": [{"id": target} for target in linked_targets["rows"]]},
+            "mechanismsOfAction": {"rows": [{
+                "actionType": mechanism.get("actionType"),
+                "mechanismOfAction": mechanism.get("mechanismOfAction"),
+                "targetName": mechanism.get("targetName"),
+                "targetType": mechanism.get("targetType"),
+                "targets": [{"id": target} for target in mechanism.get("targets") or []],
+            } for mechanism in self.mechanisms.get(record["id"], [])]},
+        }
+
+    def _known_drugs(self, target_id, size, cursor):
+        ## the cursor is the offset of the next page
+        drugs = self.known_drugs.get(target_id, [])
+        offset = int(cursor) if cursor else 0
+        end = offset + size
+        return {"count": len(drugs), "cursor": str(end) if end < len(drugs) else None, "rows": [{"drugId": drug} for drug in drugs[offset:end]]}
+
+
+def _read_records(json_file):
+    with open(json_file) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+class MockGraphQLServer(ThreadingHTTPServer):
+    ## the default backlog of 5 connections would hold back clients with many requests in flight
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class MockGraphQLHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        api = self.server.api
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if api.latency:
+            time.sleep(api.latency)
+        if not api.count_request():
+            self._send(503, {"errors": [{"message": "Service unavailable"}]})
+            return
+        try:
+            self._send(200, {"data": api.answer(request.get("operationName"), request.get("variables") or {})})
+        except (ValueError, KeyError) as error:
+            self._send(200, {"errors": [{"message": str(error)}]})
+
+    def _send(self, status, answer):
+        body = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+
+def start_server(api, host="127.0.0.1", port=0):
+    """
+    Serves api in a background thread, port 0 picks a free port
+    :return: (server, graphql url), server.shutdown() stops it
+    """
+    server = MockGraphQLServer((host, port), MockGraphQLHandler)
+    server.api = api
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/api/v4/graphql"
+
+
+if __name__ == "__main__":
+    import os
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--data_dir", type=str, help="Directory with targets.json, mechanismOfAction.json and molecule.json", required=True)
+    parser.add_argument("--port", type=int, help="Port of the server", required=False, default=18000)
+    parser.add_argument("--latency", type=float, help="Seconds every answer is delayed", required=False, default=0.0)
+    parser.add_argument("--fail_every", type=int, help="Every n-th request fails with http status 503", required=False, default=0)
+    args = parser.parse_args()
+
+    files = {dataset: os.path.join(args.data_dir, f"{dataset}.json") for dataset in ["targets", "mechanismOfAction", "molecule"]}
+    server, url = start_server(MockOpenTargets(files, latency=args.latency, fail_every=args.fail_every), port=args.port)
+    print(f"Serving {args.data_dir} on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,108 @@
+## Local stand-in for the OpenTargets release server, serving a directory over http the way lib.mirror.DatasetMirror lists
+## and fetches it: an html index with the file links, HEAD requests with Content-Length and Last-Modified, and byte ranges.
+## Dropped connections can be simulated to exercise resuming and retries.
+##
+## python -m benchmarks.mock_mirror --root /path/to/release --port 18001
+
+import os
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockMirrorState:
+    """
+    Requests seen by the server and the simulated failures
+    """
+
+    def __init__(self, drop_after=None):
+        """
+        :param drop_after: the first GET of every file is cut off after this many bytes, None to never cut
+        """
+        self.drop_after = drop_after
+        self.gets = []
+        self.heads = 0
+        self._dropped = set()
+        self._lock = threading.Lock()
+
+    def should_drop(self, path):
+        with self._lock:
+            if self.drop_after is None or path in self._dropped:
+                return False
+            self._dropped.add(path)
+            return True
+
+
+class MockMirrorHandler(SimpleHTTPRequestHandler):
+
+    def do_HEAD(self):
+        with self.server.state._lock:
+            self.server.state.heads += 1
+        super().do_HEAD()
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            super().do_GET()
+            return
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        state = self.server.state
+        range_header = self.headers.get("Range")
+        with state._lock:
+            state.gets.append((self.path, range_header))
+
+        size = os.path.getsize(path)
+        start = int(range_header.split("=")[1].split("-")[0]) if range_header else 0
+        if start >= size and size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return
+        self.send_response(206 if range_header else 200)
+        if range_header:
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.send_header("Content-Length", str(size - start))
+        self.send_header("Last-Modified", self.date_time_string(int(os.path.getmtime(path))))
+        self.end_headers()
+
+        with open(path, "rb") as fh:
+            fh.seek(start)
+            if state.should_drop(self.path):
+                ## the client sees a response shorter than its Content-Length
+                self.wfile.write(fh.read(state.drop_after))
+                self.close_connection = True
+                return
+            self.wfile.write(fh.read())
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(root, state=None, host="127.0.0.1", port=0):
+    """
+    Serves root in a background thread, port 0 picks a free port
+    :return: (server, base url), server.shutdown() stops it
+    """
+    server = ThreadingHTTPServer((host, port), partial(MockMirrorHandler, directory=root))
+    server.daemon_threads = True
+    server.state = state if state is not None else MockMirrorState()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--root", type=str, help="Directory with one sub directory of json part files per dataset", required=True)
+    parser.add_argument("--port", type=int, help="Port of the server", required=False, default=18001)
+    parser.add_argument("--drop_after", type=int, help="Cut the first download of every file off after this many bytes", required=False, default=None)
+    args = parser.parse_args()
+
+    server, url = start_server(args.root, MockMirrorState(args.drop_after), port=args.port)
+    print(f"Serving {args.root} on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,171 @@
+## Generators for synthetic OpenTargets shaped json lines files.
+## The records follow the schema of the real dumps (see exploratory_analysis/examples.txt),
+## including the nested fields that the pipeline never uses, so parsing costs are realistic.
+
+import json
+import os
+import random
+
+LOCATIONS = [
+    ("Cytoplasm", "Cytosol"), ("Nucleus", "Nucleus"), ("Nuclear speckles", "Nucleus speckle"),
+    ("Cell membrane", "Plasma membrane"), ("Mitochondrion", "Mitochondrion"),
+    ("Endoplasmic reticulum membrane", "Endoplasmic reticulum"), ("Golgi apparatus", "Golgi apparatus"),
+    ("Secreted", "Extracellular region or secreted"), ("Cytoplasm: Perinuclear region", "Cytosol"),
+    ("Lysosome", "Lysosome"), ("Vesicles", "Vesicle"), ("Centrosome", "Microtubule organizing center"),
+]
+BIOTYPES = ["protein_coding", "processed_pseudogene", "lncRNA", "miRNA", "unprocessed_pseudogene"]
+## Ensembl numbers of the alternative genes, above those of the targets
+ALTERNATIVE_GENES_OFFSET = 10 ** 9
+
+
+def _ensembl_id(number):
+    return f"ENSG{number:011d}"
+
+
+def _text(rng, n_words):
+    return " ".join(rng.choice(["protein", "kinase", "subunit", "receptor", "alpha", "beta", "factor", "domain"]) for _ in range(n_words))
+
+
+def target_record(rng, number):
+    n_locations = rng.choice([0, 1, 1, 2, 3, 5])
+    locations = []
+    for location, label in rng.sample(LOCATIONS, n_locations):
+        locations.append({"location": location, "source": "uniprot", "termSL": f"SL-{rng.randint(1, 500):04d}", "labelSL": label})
+    start = rng.randint(1, 200000000)
+    return {
+        "id": _ensembl_id(number),
+        "approvedSymbol": f"GENE{number}",
+        "biotype": rng.choice(BIOTYPES),
+        "transcriptIds": [f"ENST{number * 10 + i:011d}" for i in range(rng.randint(1, 6))],
+        "genomicLocation": {"chromosome": str(rng.randint(1, 22)), "start": start, "end": start + rng.randint(100, 100000), "strand": 1},
+        "approvedName": _text(rng, 6),
+        "synonyms": [{"label": _text(rng, 4), "source": "uniprot"} for _ in range(rng.randint(0, 8))],
+        ## genes on alternative haplotypes, which are not targets themselves
+        "alternativeGenes": [_ensembl_id(ALTERNATIVE_GENES_OFFSET + number * 4 + i) for i in range(rng.randint(1, 3))] if rng.random() < 0.05 else [],
+        "functionDescriptions": [_text(rng, 30)],
+        "subcellularLocations": locations,
+        "dbXrefs": [{"id": str(rng.randint(1, 99999)), "source": "InterPro"} for _ in range(rng.randint(0, 20))],
+        "pathways": [{"pathwayId": f"R-HSA-{rng.randint(1, 999999)}", "pathway": _text(rng, 5), "topLevelTerm": _text(rng, 2)} for _ in range(rng.randint(0, 10))],
+    }
+
+
+## record counts of release 24.03, scale 1.0 of write_dataset
+RELEASE_TARGETS = 63000
+RELEASE_MOLECULES = 18000
+RELEASE_MOA = 6700
+
+DRUG_TYPES = [("Small molecule", 75), ("Antibody", 10), ("Protein", 6), ("Oligonucleotide", 3), ("Enzyme", 2),
+              ("Unknown", 2), ("Oligosaccharide", 1), ("Cell", 1)]
+ACTION_TYPES = [("INHIBITOR", 40), ("ANTAGONIST", 20), ("AGONIST", 15), ("MODULATOR", 5), ("BLOCKER", 5),
+                ("POSITIVE ALLOSTERIC MODULATOR", 4), ("OPENER", 2), ("BINDING AGENT", 3), ("DEGRADER", 1),
+                ("ACTIVATOR", 3), ("PARTIAL AGONIST", 2)]
+## targetType and the number of targets of a mechanism of action with that type
+TARGET_TYPES = [("single protein", 70, (1, 1)), ("protein complex", 12, (2, 8)), ("protein family", 10, (2, 20)),
+                ("ion channel", 4, (2, 6)), ("protein-protein interaction", 2, (2, 2)), ("cell-line", 2, (0, 0))]
+## number of molecules of a mechanism of action, mostly one and a few large drug classes
+CHEMBL_FAN_OUT = [1] * 14 + [2, 2, 3, 5, 12, 30]
+
+
+def _weighted(rng, choices):
+    return rng.choices([choice[0] for choice in choices], weights=[choice[1] for choice in choices])[0]
+
+
+def _chembl_id(number):
+    return f"CHEMBL{number}"
+
+
+def molecule_record(rng, number, n_molecules, n_targets):
+    """
+    A molecule, 10 % of them have children and a parentId pointing back to the parent, most of them have linked targets
+    """
+    record = {
+        "id": _chembl_id(number),
+        "canonicalSmiles": "".join(rng.choice("CNOc1()=") for _ in range(rng.randint(10, 80))),
+        "inchiKey": "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(27)),
+        "drugType": _weighted(rng, DRUG_TYPES),
+        "blackBoxWarning": rng.random() < 0.05,
+        "name": _text(rng, 2).upper(),
+        "yearOfFirstApproval": rng.choice([None, rng.randint(1950, 2024)]),
+        "maximumClinicalTrialPhase": rng.choice([0.5, 1.0, 2.0, 3.0, 4.0]),
+        "hasBeenWithdrawn": rng.random() < 0.02,
+        "isApproved": rng.random() < 0.2,
+        "tradeNames": [_text(rng, 1) for _ in range(rng.randint(0, 3))],
+        "synonyms": [_text(rng, 2) for _ in range(rng.randint(0, 6))],
+        "crossReferences": {"PubChem": [str(rng.randint(1, 10 ** 8))], "drugbank": [f"DB{rng.randint(1, 99999):05d}"]},
+        "description": _text(rng, 15),
+    }
+    if rng.random() < 0.1:
+        record["childChemblIds"] = [_chembl_id(rng.randrange(n_molecules)) for _ in range(rng.randint(1, 3))]
+    if rng.random() < 0.1:
+        record["parentId"] = _chembl_id(rng.randrange(n_molecules))
+    if rng.random() < 0.6:
+        rows = [_ensembl_id(rng.randrange(n_targets)) for _ in range(rng.randint(1, 4))]
+        record["linkedTargets"] = {"rows": rows, "count": len(rows)}
+    return record
+
+
+def moa_record(rng, n_molecules, n_targets):
+    """
+    A mechanism of action with list valued chemblIds and targets. About 5 % of the IDs are unknown
+    to the molecules and targets datasets, like in the real dumps
+    """
+    target_type, _, (min_targets, max_targets) = rng.choices(TARGET_TYPES, weights=[choice[1] for choice in TARGET_TYPES])[0]
+    chembl_ids = [_chembl_id(rng.randrange(int(n_molecules * 1.05))) for _ in range(rng.choice(CHEMBL_FAN_OUT))]
+    targets = [_ensembl_id(rng.randrange(int(n_targets * 1.05))) for _ in range(rng.randint(min_targets, max_targets))]
+    return {
+        "actionType": _weighted(rng, ACTION_TYPES),
+        "mechanismOfAction": _text(rng, 5),
+        "chemblIds": chembl_ids,
+        "targetName": _text(rng, 4),
+        "targetType": target_type,
+        "targets": targets,
+        "references": [{"source": "PubMed", "ids": [str(rng.randint(1, 10 ** 8))], "urls": []} for _ in range(rng.randint(0, 3))],
+    }
+
+
+def write_dataset(output_dir, scale=0.1, seed=0):
+    """
+    Writes synthetic targets, mechanismOfAction and molecule json lines files,
+    with the record counts of the real release times scale
+    :return: {"targets", "mechanismOfAction", "molecule": file path}, {dataset: number of records}
+    """
+    rng = random.Random(seed)
+    counts = {
+        "targets": max(int(RELEASE_TARGETS * scale), 1),
+        "mechanismOfAction": max(int(RELEASE_MOA * scale), 1),
+        "molecule": max(int(RELEASE_MOLECULES * scale), 1),
+    }
+    records = {
+        "targets": (target_record(rng, number) for number in range(counts["targets"])),
+        "mechanismOfAction": (moa_record(rng, counts["molecule"], counts["targets"]) for _ in range(counts["mechanismOfAction"])),
+        "molecule": (molecule_record(rng, number, counts["molecule"], counts["targets"]) for number in range(counts["molecule"])),
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    files = {}
+    for dataset, dataset_records in records.items():
+        files[dataset] = os.path.join(output_dir, f"{dataset}.json")
+        with open(files[dataset], "w") as fh:
+            for record in dataset_records:
+                fh.write(json.dumps(record) + "\n")
+    return files, counts
+
+
+def write_targets(output_file, size_bytes, seed=0):
+    """
+    Writes synthetic targets json lines until the file reaches size_bytes
+    :return: number of records written
+    """
+    rng = random.Random(seed)
+    number = 0
+    written = 0
+    with open(output_file, "w") as fh:
+        while written < size_bytes:
+            line = json.dumps(target_record(rng, number)) + "\n"
+            fh.write(line)
+            written += len(line)
+            number += 1
+    return number
+
+
+def file_size_mb(path):
+    return os.path.getsize(path) / 2 ** 20
@@ -1,34 +1,38 @@
-# This script looks if different gene IDs from  are intersecting with each other.
+# This script looks if different gene IDs from the datasets are intersecting with each other.
+# The ID sets are read from an IDIndexSet: either an id_index .npz file, saved with --save_process_data or in the preprocess cache,
+# or one built from the preprocessed tables.
 
-def ensembl_id_analysis():
-    targets_ids = set()
-    alt_gene_ids = set()
-    linked_targets = set()
-    moa_targets_ids = set() ## dataset to combine CHEMBLIDs and ENSGIDs
+import argparse
+import os
+import sys
 
-    with open("/data/moa_targets_ids.txt", "r") as fh:
-        ##cat preprocessed_moa.tsv | cut -f 4 | head -n -1 | sort | uniq -u > moa_targets_ids.txt
-        moa_targets_ids.update([ensembl_id.replace("\n", "") for ensembl_id in fh])
+import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 
-    with open("/data/targets_ids.txt", "r") as fh:
-        ##cat preprocessed_targets.tsv | cut -f1 | sort | uniq -u | head -n -1 > targets_ids.txt
-        targets_ids.update([ensembl_id.replace("\n", "") for ensembl_id in fh])
+from lib.id_index import IDIndexSet
 
-    with open("/data/alt_genes.txt", "r") as fh:
-        ##cat preprocessed_targets.tsv | cut -f3 | sort | uniq -u | head -n -1 > alt_genes.txt
-        import re
-        ENSG_pattern = r"ENSG\d{11}"
-        for line in fh:
-            alt_gene_ids.update(re.findall(ENSG_pattern, line))
+EXPLORATORY_DIR = os.path.dirname(os.path.abspath(__file__))
 
-    with open("/data/mols_linked_ids.txt", "r") as fh:
-        ##cat preprocessed_molecules.tsv  | cut -f5 | sort | uniq -u | head -n-1 > mols_linked_ids.txt
-        linked_targets.update([ensembl_id.replace("\n", "") for ensembl_id in fh])
+
+def load_id_index(index_file=None, moa_file=None, molecules_file=None, targets_file=None):
+    if index_file is not None:
+        return IDIndexSet.load(index_file)
+
+    df_moa = pd.read_csv(moa_file, sep="\t", dtype=str)
+    df_molecules = pd.read_csv(molecules_file, sep="\t", dtype=str)
+    df_targets = pd.read_csv(targets_file, sep="\t", dtype=str)
+    return IDIndexSet.from_tables(df_moa, df_molecules, df_targets)
+
+
+def ensembl_id_analysis(id_index):
+    moa_targets_ids = id_index["moa_targets"] ## dataset to combine CHEMBLIDs and ENSGIDs
+    targets_ids = id_index["targets"]
+    alt_gene_ids = id_index["alternative_genes"]
+    linked_targets = id_index["linked_targets"]
 
     print("MOA Targets")
     print(len(moa_targets_ids))
-    # 380
 
     print("Targets")
     print(len(targets_ids))
@@ -40,30 +44,24 @@ def ensembl_id_analysis():
 
     print("MOA Targets and Targets Intersection:")
     print(len(moa_targets_ids.intersection(targets_ids)))
-    # 78
     print(len(moa_targets_ids.difference(targets_ids)))
-    #302 difference between moa_targets_ids and targets_ids
 
     print("MOA Targets and Alt Genes Intersection:")
     print(len(moa_targets_ids.intersection(alt_gene_ids)))
-    # 0
 
     print("MOA Targets and Linked Targets Intersection:")
     print(len(moa_targets_ids.intersection(linked_targets)))
-    # 376
+    print("Are Linked Targets a subset of MOA Targets? If so, they can be ignored")
     print(linked_targets.issubset(moa_targets_ids))
-    # True --> we can ignore linked_targets
 
     print("Alt Genes and Targets Intersection:")
     print(len(alt_gene_ids.intersection(targets_ids)))
-    # 0
 
     print("Linked Targets and Targets Intersection:")
     print(len(linked_targets.intersection(targets_ids)))
 
     print("Linked Targets and Alt Genes Intersection:")
     print(len(linked_targets.intersection(alt_gene_ids)))
-    # 0
 
     print("Linked Targets but not in Targets:")
     print(len(linked_targets.difference(targets_ids)))
@@ -71,30 +69,15 @@ def ensembl_id_analysis():
     print("Linked Targets but not in Alt Genes:")
     print(len(linked_targets.difference(alt_gene_ids)))
 
-    ## Intersections with Alt Genes are 0, so we can ignore them.
+    ## If the intersections with Alt Genes are empty, they can be ignored.
 
 
-def chembl_id_analysis():
+def chembl_id_analysis(id_index):
     ## Let's look at the Chembl Ids
-    moa_chembl_ids = set()
-    molecules_chembl_ids = set()
-    molecules_parents = set()
-    molecules_children = set()
-
-    with open("/home/berk/Projects/OpenTargets/moa_chembl_ids.txt", "r") as fh:
-        #cat preprocessed_moa.tsv | cut -f 2 | head -n -1 | sort | uniq -u > moa_chembl_ids.txt
-        moa_chembl_ids.update([chembl_id.replace("\n", "") for chembl_id in fh])
-
-    with open("/exploratory_analysis/preprocessed_molecules.tsv", "r") as fh:
-        for line in fh:
-            line = line.split("\t")
-            molecules_chembl_ids.add(line[0])
-            molecules_parents.add(line[3])
-            molecules_children.add(line[2])
-
-        molecules_parents.remove("")
-        molecules_children.remove("")
-
+    moa_chembl_ids = id_index["moa_chembl"]
+    molecules_chembl_ids = id_index["molecules"]
+    molecules_parents = id_index["molecule_parents"]
+    molecules_children = id_index["molecule_children"]
 
     print("MOA Chembl Ids")
     print(len(moa_chembl_ids))
@@ -109,32 +92,39 @@ def chembl_id_analysis():
     print(len(molecules_children))
 
     print("Is parents and children subset of molecule ids?")
-    print(molecules_parents.issubset(molecules_chembl_ids)) ## False
-    print(molecules_children.issubset(molecules_chembl_ids)) ## False
+    print(molecules_parents.issubset(molecules_chembl_ids))
+    print(molecules_children.issubset(molecules_chembl_ids))
 
     print("PUC/molecules_chembl_ids n moa_chembl_ids")
-    print(molecules_parents.union(molecules_children).difference(molecules_chembl_ids).intersection(moa_chembl_ids))
+    print(molecules_parents.union(molecules_children).difference(molecules_chembl_ids).intersection(moa_chembl_ids).ids)
 
     print("MOA Chembl Ids and Molecules Chembl Ids Intersection:")
     print(len(moa_chembl_ids.intersection(molecules_chembl_ids)))
-    ## 3515
 
     print("MOA Chembl Ids and Molecules Parents Intersection:")
     print(len(moa_chembl_ids.intersection(molecules_parents)))
-    ## 431
 
     print("MOA Chembl Ids and Molecules Children Intersection:")
     print(len(moa_chembl_ids.intersection(molecules_children)))
-    ## 538
 
     print("MOA Chembl Ids in Parents and Children but not in molecules:")
     print(len(moa_chembl_ids.intersection(molecules_parents.union(molecules_children)).difference(molecules_chembl_ids)))
-    ## 0
 
-    ## When ID matching, we do not need to take into account parents and children.
-    print(molecules_parents.intersection(moa_chembl_ids))
+    ## If no MOA Chembl Id is only found in parents and children, ID matching does not need to take them into account.
+    print(molecules_parents.intersection(moa_chembl_ids).ids)
+
+    print(molecules_parents.intersection(molecules_chembl_ids).ids)
 
-    print(molecules_parents.intersection(molecules_chembl_ids))
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Overlap of the ChEMBL and Ensembl IDs of the datasets")
+    parser.add_argument("--index_file", type=str, required=False, default=None,
+                        help="id_index .npz file saved by the preprocessing, the tables below are used if not given")
+    parser.add_argument("--moa_file", type=str, required=False, default=os.path.join(EXPLORATORY_DIR, "preprocessed_moa.tsv"))
+    parser.add_argument("--molecules_file", type=str, required=False, default=os.path.join(EXPLORATORY_DIR, "preprocessed_molecules.tsv"))
+    parser.add_argument("--targets_file", type=str, required=False, default=os.path.join(EXPLORATORY_DIR, "preprocessed_targets.tsv"))
+    args = parser.parse_args()
 
-chembl_id_analysis()
+    id_index = load_id_index(args.index_file, args.moa_file, args.molecules_file, args.targets_file)
+    ensembl_id_analysis(id_index)
+    chembl_id_analysis(id_index)
@@ -0,0 +1,140 @@
+## Programmatic access to the analyses of one combined table, for notebooks and long lived processes.
+## The combined table is loaded once and kept in memory. Every crosstab, significance table and figure is computed
+## on first request and memoized, and the stats and plotting modules are only imported when first used.
+##
+##   analysis = CombinedAnalysis.from_combined_file("combined_data.arrow")
+##   analysis.crosstab("drugType", "subcellular_location_label")
+##   analysis.significance("drugType", "subcellular_location_label", correction="bh")
+##   analysis.plot("drugType", "subcellular_location_label", kind="heatmap", out_dir="figures")
+
+import os
+from collections import OrderedDict
+
+## significance tables kept per analysis, the least recently used are dropped
+MAX_SIGNIFICANCE_TABLES = 64
+
+
+class CombinedAnalysis:
+    """
+    Memoized crosstabs, significance tables and figures of a combined table.
+    The significance tables of the last MAX_SIGNIFICANCE_TABLES parameter sets are kept.
+    The returned dataframes are shared between calls and should not be modified
+    """
+
+    def __init__(self, combined_data, release=None):
+        """
+        :param combined_data: pandas dataframe of the combined table, see DataProcess.combine_data
+        :param release: OpenTargets release of the table, if known
+        """
+        self.combined_data = combined_data
+        self.release = release
+        self._crosstabs = {}
+        self._significance_tables = OrderedDict()
+        self._plots = {}
+
+    @classmethod
+    def from_combined_file(cls, combined_file, columns=None):
+        """
+        Loads a tsv or binary combined file, see lib.combined_file
+        :param columns: columns to load, all if None. Only the analysed keys are needed
+        """
+        from lib.combined_file import is_combined_file
+        if is_combined_file(combined_file):
+            from lib.combined_file import read_combined_file, read_combined_metadata
+            return cls(read_combined_file(combined_file, columns=columns), release=read_combined_metadata(combined_file)["release"])
+
+        import pandas as pd
+        return cls(pd.read_csv(combined_file, sep="\t", usecols=columns))
+
+    @classmethod
+    def from_datasets(cls, targets_file, mechanism_of_action_file, molecules_file, **options):
+        """
+        Preprocesses and combines the json datasets (or loads them from the preprocess cache)
+        :param options: more DataProcess options, e.g. use_cache, cache_dir or workers
+        """
+        from lib.data_process import DataProcess
+        from settings import DATA_VERSION
+
+        dataprocess_obj = DataProcess(
+            targets_file=targets_file, mechanism_of_action_file=mechanism_of_action_file, molecules_file=molecules_file, **options
+        )
+        try:
+            dataprocess_obj.preprocess()
+        finally:
+            dataprocess_obj.work_area.cleanup()
+        return cls(dataprocess_obj.combined_data, release=DATA_VERSION)
+
+    def crosstab(self, modality="drugType", location="subcellular_location_label"):
+        """
+        :return: locations x drug modalities contingency table
+        """
+        key = (modality, location)
+        if key not in self._crosstabs:
+            self.crosstabs([key])
+        return self._crosstabs[key]
+
+    def crosstabs(self, keys):
+        """
+        Builds the missing crosstabs of keys in one pass over the table, see DataProcess._create_contingency_tables
+        :param keys: list of (modality, location)
+        :return: {(modality, location): contingency table}
+        """
+        from lib.data_process import DataProcess
+        missing = [key for key in keys if key not in self._crosstabs]
+        for column in sorted({column for key in missing for column in key}):
+            if column not in self.combined_data.columns:
+                raise Exception(f"{column} is not a column of the combined table, select from {', '.join(self.combined_data.columns)}")
+        if missing:
+            self._crosstabs.update(DataProcess._create_contingency_tables(self.combined_data, missing))
+        return {key: self._crosstabs[key] for key in keys}
+
+    def percentages(self, modality="drugType", location="subcellular_location_label", by="loc"):
+        """
+        :param by: "loc" for the drug modality percentages of every location, anything else for the location percentages of every drug modality
+        """
+        from lib.data_process import get_percentages
+        return get_percentages(self.crosstab(modality, location), by)
+
+    def significance(self, modality="drugType", location="subcellular_location_label", correction="none", mid_p=False,
+                     significance=0.05, only_significant=False):
+        """
+        :return: significance table of the crosstab, see lib.data_process.significance_table
+        """
+        key = (modality, location, correction, bool(mid_p), float(significance))
+        if key not in self._significance_tables:
+            from lib.data_process import significance_table
+            self._significance_tables[key] = significance_table(self.crosstab(modality, location), correction, significance, mid_p)
+            while len(self._significance_tables) > MAX_SIGNIFICANCE_TABLES:
+                self._significance_tables.popitem(last=False)
+        self._significance_tables.move_to_end(key)
+        table = self._significance_tables[key]
+        return table[table["Significance"]] if only_significant else table
+
+    def plot(self, modality="drugType", location="subcellular_location_label", kind="heatmap", out_dir=".", formats=("pdf",)):
+        """
+        Renders a figure of the crosstab once per output path, see lib.plotting
+        :param kind: "heatmap" or "stacked_bar"
+        :return: list of the written files
+        """
+        from lib.plotting import output_files, plot_heatmap, plot_stacked_bar
+        if kind == "heatmap":
+            name, plot, data = "heatmap", plot_heatmap, self.crosstab(modality, location)
+        elif kind == "stacked_bar":
+            name, plot, data = "stacked_bar_distributions", plot_stacked_bar, self.percentages(modality, location, "loc")
+        else:
+            raise Exception(f"Unknown plot kind {kind}, select from heatmap, stacked_bar")
+
+        files = output_files(out_dir, f"{modality}_{location}_{name}", formats)
+        key = tuple(files)
+        if key not in self._plots:
+            os.makedirs(out_dir, exist_ok=True)
+            self._plots[key] = plot(data, modality, files)
+        return self._plots[key]
+
+    def clear(self):
+        """
+        Forgets the memoized results, e.g. after combined_data was replaced
+        """
+        self._crosstabs.clear()
+        self._significance_tables.clear()
+        self._plots.clear()
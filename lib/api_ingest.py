@@ -0,0 +1,356 @@
+## Fetches the records of a subset of targets and molecules from the OpenTargets GraphQL API instead of the release dumps.
+## Only the fields the preprocessing reads are queried. The IDs are sent in batches, at most `concurrency` requests are in
+## flight at a time, failed requests are retried with exponential backoff and every response is cached on disk by its query,
+## so refreshing a few hundred IDs takes seconds instead of a multi-GB download.
+## The records are written as json lines files shaped like the dumps, so DataProcess reads them unchanged.
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+from settings import OPENTARGETS_API_URL, API_CACHE_DIR, API_CACHE_MAX_AGE, API_CONCURRENCY, API_BATCH_SIZE
+from lib.profiling import RunProfile
+from lib.work_area import WorkArea
+
+TARGETS_QUERY = """
+query Targets($ids: [String!]!) {
+  targets(ensemblIds: $ids) {
+    id
+    biotype
+    alternativeGenes
+    subcellularLocations { location source termSL labelSL }
+  }
+}
+"""
+
+DRUGS_QUERY = """
+query Drugs($ids: [String!]!) {
+  drugs(chemblIds: $ids) {
+    id
+    drugType
+    parentMolecule { id }
+    childMolecules { id }
+    linkedTargets { count rows { id } }
+    mechanismsOfAction { rows { actionType mechanismOfAction targetName targetType targets { id } } }
+  }
+}
+"""
+
+TARGET_DRUGS_QUERY = """
+query TargetDrugs($ids: [String!]!, $size: Int!) {
+  targets(ensemblIds: $ids) {
+    id
+    knownDrugs(size: $size) { count cursor rows { drugId } }
+  }
+}
+"""
+
+TARGET_DRUGS_PAGE_QUERY = """
+query TargetDrugsPage($id: String!, $size: Int!, $cursor: String) {
+  target(ensemblId: $id) {
+    id
+    knownDrugs(size: $size, cursor: $cursor) { count cursor rows { drugId } }
+  }
+}
+"""
+
+KNOWN_DRUGS_PAGE_SIZE = 500
+## http status codes worth another attempt, all other errors fail at once
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class GraphQLClient:
+    """
+    Sends GraphQL queries over http with at most concurrency requests at a time.
+    Successful responses are cached in cache_dir by url, query and variables, cache_dir None disables the cache
+    """
+
+    def __init__(self, url=OPENTARGETS_API_URL, cache_dir=API_CACHE_DIR, concurrency=API_CONCURRENCY, retries=5, backoff=0.5,
+                 timeout=60, cache_max_age=API_CACHE_MAX_AGE):
+        """
+        :param retries: attempts of a request before it fails
+        :param backoff: seconds before the first retry, doubled with every further attempt
+        :param cache_max_age: seconds after which cached responses are fetched again, None to keep them forever
+        """
+        self.url = url
+        self.cache_dir = cache_dir
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache_max_age = cache_max_age
+        self.requests_sent = 0
+        self.cache_hits = 0
+        self._sessions = threading.local()
+        ## the blocking requests run on a pool of concurrency threads, the default executor of the loop could cap them
+        self._executor = None
+
+    def close(self):
+        """
+        Stops the threads of the requests, the client can be used again afterwards
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._executor = None
+
+    def cache_file(self, query, variables):
+        key = json.dumps({"url": self.url, "query": query, "variables": variables}, sort_keys=True)
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def _read_cache(self, cache_file):
+        if self.cache_dir is None or not os.path.exists(cache_file):
+            return None
+        if self.cache_max_age is not None and time.time() - os.path.getmtime(cache_file) > self.cache_max_age:
+            return None
+        try:
+            with open(cache_file) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            ## a truncated file of a killed run, fetched again
+            return None
+
+    def _write_cache(self, cache_file, data):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        partial_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(partial_file, "w") as fh:
+            json.dump(data, fh)
+        os.replace(partial_file, cache_file)
+
+    def _post(self, payload):
+        """
+        One blocking request, run in a worker thread. Every thread keeps its own session
+        :return: (http status, parsed body or None, Retry-After seconds or None)
+        """
+        import requests
+        if not hasattr(self._sessions, "session"):
+            self._sessions.session = requests.Session()
+        response = self._sessions.session.post(self.url, json=payload, timeout=self.timeout)
+        retry_after = response.headers.get("Retry-After")
+        retry_after = float(retry_after) if retry_after is not None and retry_after.isdigit() else None
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return response.status_code, body, retry_after
+
+    def _get_executor(self):
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="graphql")
+        return self._executor
+
+    async def query(self, semaphore, operation_name, query, variables):
+        """
+        :param semaphore: asyncio.Semaphore shared by the requests of one run, bounds the requests in flight
+        :return: the data of the response
+        """
+        import requests
+        cache_file = self.cache_file(query, variables) if self.cache_dir is not None else None
+        data = self._read_cache(cache_file)
+        if data is not None:
+            self.cache_hits += 1
+            return data
+
+        payload = {"operationName": operation_name, "query": query, "variables": variables}
+        for attempt in range(1, self.retries + 1):
+            async with semaphore:
+                self.requests_sent += 1
+                try:
+                    status, body, retry_after = await asyncio.get_running_loop().run_in_executor(self._get_executor(), self._post, payload)
+                    error = None
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    status, body, retry_after, error = None, None, None, e
+
+            if status == 200 and body is not None:
+                if body.get("errors"):
+                    raise Exception(f"{operation_name} query failed", body["errors"])
+                self._write_cache(cache_file, body["data"])
+                return body["data"]
+            if error is None and status not in RETRY_STATUS:
+                raise Exception(f"{operation_name} query failed with http status {status}", body)
+            if attempt == self.retries:
+                raise Exception(f"{operation_name} query failed after {self.retries} attempts", error if error is not None else status)
+
+            ## exponential backoff with jitter, so the retries of concurrent batches do not arrive together
+            delay = retry_after if retry_after is not None else self.backoff * 2 ** (attempt - 1) * (1 + random.random())
+            print(f"Retrying {operation_name} in {delay:.1f}s ({attempt}/{self.retries}): {error if error is not None else status}")
+            await asyncio.sleep(delay)
+
+
+class ApiIngest:
+    """
+    Fetches the targets, mechanisms of action and molecules of the given IDs from the GraphQL API and writes them
+    as json lines files into a work area, a drop-in replacement of lib.download_data.DownloadPrepareInitialData:
+
+        ingest = ApiIngest(molecule_ids=["CHEMBL25"])
+        ingest.process()
+        targets_file, moa_file, molecules_file = ingest.get_combined_files()
+
+    Given molecule IDs bring their mechanisms of action and all their targets. Given target IDs bring the known drugs
+    of the targets with all their mechanisms of action, but only the given targets, so the combined table is restricted to them
+    """
+
+    def __init__(self, target_ids=None, molecule_ids=None, url=OPENTARGETS_API_URL, cache_dir=API_CACHE_DIR,
+                 concurrency=API_CONCURRENCY, batch_size=API_BATCH_SIZE, retries=5, backoff=0.5, profile=None, work_dir=None):
+        """
+        :param cache_dir: directory of the response cache, None to always query the API
+        :param work_dir: directory the work area of the written files is created in, the system temp directory by default
+        """
+        if not target_ids and not molecule_ids:
+            raise Exception("No target or molecule IDs to fetch")
+        self.target_ids = sorted(set(target_ids or []))
+        self.molecule_ids = sorted(set(molecule_ids or []))
+        self.client = GraphQLClient(url=url, cache_dir=cache_dir, concurrency=concurrency, retries=retries, backoff=backoff)
+        self.batch_size = batch_size
+        self.profile = profile if profile is not None else RunProfile()
+        self.work_area = WorkArea(root=work_dir, prefix="api_OT")
+
+        self.targets_combined = self.work_area.path("targets.json")
+        self.moa_combined = self.work_area.path("mechanismOfAction.json")
+        self.molecules_combined = self.work_area.path("molecule.json")
+
+    def process(self):
+        start = time.perf_counter()
+        try:
+            asyncio.run(self._process())
+        finally:
+            self.client.close()
+        print(
+            f"Fetched {len(self.target_ids)} target and {len(self.molecule_ids)} molecule IDs from {self.client.url} "
+            f"in {time.perf_counter() - start:.1f}s, {self.client.requests_sent} requests, {self.client.cache_hits} cached responses"
+        )
+
+    async def _process(self):
+        ## the requests of all batches of a stage run at the same time, bounded by the semaphore
+        semaphore = asyncio.Semaphore(self.client.concurrency)
+
+        drug_ids = set(self.molecule_ids)
+        if self.target_ids:
+            with self.profile.stage("api_known_drugs", rows_in=len(self.target_ids)) as record:
+                known_drugs = await self.fetch_known_drugs(semaphore, self.target_ids)
+                drug_ids.update(known_drugs)
+                record["rows_out"] = len(known_drugs)
+
+        with self.profile.stage("api_molecules", rows_in=len(drug_ids)) as record:
+            drugs = await self._fetch_batches(semaphore, "Drugs", DRUGS_QUERY, "drugs", sorted(drug_ids))
+            molecules = [molecule_record(drug) for drug in drugs]
+            mechanisms = [mechanism for drug in drugs for mechanism in moa_records(drug)]
+            record["rows_out"] = self._write_records(self.molecules_combined, molecules) + self._write_records(self.moa_combined, mechanisms)
+
+        ## all targets of the given molecules, but only the given targets of the known drugs
+        target_ids = set(self.target_ids)
+        requested_molecules = set(self.molecule_ids)
+        target_ids.update(target for mechanism in mechanisms if requested_molecules.intersection(mechanism["chemblIds"]) for target in mechanism["targets"])
+        with self.profile.stage("api_targets", rows_in=len(target_ids)) as record:
+            targets = await self._fetch_batches(semaphore, "Targets", TARGETS_QUERY, "targets", sorted(target_ids))
+            record["rows_out"] = self._write_records(self.targets_combined, [target_record(target) for target in targets])
+
+        self._report_missing("molecule", self.molecule_ids, drugs)
+        self._report_missing("target", self.target_ids, targets)
+
+    async def _fetch_batches(self, semaphore, operation_name, query, field, ids, **variables):
+        """
+        Queries the ids in batches of batch_size. The ids are sorted, so the same ids give the same batches and cached responses
+        :return: list of the records of all batches
+        """
+        batches = [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+        responses = await asyncio.gather(*(
+            self.client.query(semaphore, operation_name, query, {"ids": batch, **variables}) for batch in batches
+        ))
+        return [record for response in responses for record in (response.get(field) or []) if record is not None]
+
+    async def fetch_known_drugs(self, semaphore, target_ids):
+        """
+        :return: sorted ChEMBL IDs of the known drugs of the targets, the drug lists longer than one page are paged with their cursor
+        """
+        targets = await self._fetch_batches(semaphore, "TargetDrugs", TARGET_DRUGS_QUERY, "targets", target_ids, size=KNOWN_DRUGS_PAGE_SIZE)
+        pages = await asyncio.gather(*(
+            self._fetch_known_drugs_pages(semaphore, target["id"], target["knownDrugs"])
+            for target in targets if target.get("knownDrugs")
+        ))
+        return sorted({drug_id for page in pages for drug_id in page})
+
+    async def _fetch_known_drugs_pages(self, semaphore, target_id, known_drugs):
+        drug_ids = [row["drugId"] for row in known_drugs["rows"]]
+        fetched = len(known_drugs["rows"])
+        while fetched < known_drugs["count"] and known_drugs.get("cursor"):
+            data = await self.client.query(
+                semaphore, "TargetDrugsPage", TARGET_DRUGS_PAGE_QUERY, {"id": target_id, "size": KNOWN_DRUGS_PAGE_SIZE, "cursor": known_drugs["cursor"]}
+            )
+            known_drugs = data["target"]["knownDrugs"]
+            if not known_drugs["rows"]:
+                break
+            drug_ids += [row["drugId"] for row in known_drugs["rows"]]
+            fetched += len(known_drugs["rows"])
+        return drug_ids
+
+    @staticmethod
+    def _write_records(output_file, records):
+        with open(output_file, "w") as fh:
+            for record in records:
+                fh.write(json.dumps(record) + "\n")
+        return len(records)
+
+    @staticmethod
+    def _report_missing(name, requested_ids, records):
+        missing = set(requested_ids).difference(record["id"] for record in records)
+        if missing:
+            print(f"{len(missing)} of the {len(requested_ids)} {name} IDs are unknown to the API, e.g. {', '.join(sorted(missing)[:5])}")
+
+    def get_combined_files(self):
+        return self.targets_combined, self.moa_combined, self.molecules_combined
+
+    def cleanup(self):
+        """
+        Removes the written files, the response cache is kept
+        """
+        self.work_area.cleanup()
+
+
+def target_record(target):
+    """
+    :return: the target as a record of the targets dump, with the fields of DataProcess.TARGETS_FIELDS
+    """
+    record = {"id": target["id"], "biotype": target.get("biotype"), "alternativeGenes": target.get("alternativeGenes") or []}
+    if target.get("subcellularLocations"):
+        record["subcellularLocations"] = target["subcellularLocations"]
+    return record
+
+
+def molecule_record(drug):
+    """
+    :return: the drug as a record of the molecule dump, where the relations are ID lists and missing ones are left out
+    """
+    record = {"id": drug["id"], "drugType": drug.get("drugType")}
+    if drug.get("childMolecules"):
+        record["childChemblIds"] = [child["id"] for child in drug["childMolecules"]]
+    if drug.get("parentMolecule"):
+        record["parentId"] = drug["parentMolecule"]["id"]
+    linked_targets = drug.get("linkedTargets") or {}
+    if linked_targets.get("rows"):
+        rows = [target["id"] for target in linked_targets["rows"]]
+        record["linkedTargets"] = {"rows": rows, "count": linked_targets.get("count", len(rows))}
+    return record
+
+
+def moa_records(drug):
+    """
+    The mechanisms of action of one drug as records of the mechanismOfAction dump. The dump lists every drug of a mechanism
+    in its chemblIds, here each drug has its own copy, which gives the same rows once DataProcess explodes chemblIds
+    :return: list of records
+    """
+    mechanisms = (drug.get("mechanismsOfAction") or {}).get("rows") or []
+    return [{
+        "actionType": mechanism.get("actionType"),
+        "mechanismOfAction": mechanism.get("mechanismOfAction"),
+        "chemblIds": [drug["id"]],
+        "targetName": mechanism.get("targetName"),
+        "targetType": mechanism.get("targetType"),
+        "targets": [target["id"] for target in mechanism.get("targets") or []],
+    } for mechanism in mechanisms]
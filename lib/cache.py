@@ -0,0 +1,131 @@
+## Persistent cache of the preprocessed and combined tables as parquet files, and of other
+## artifacts derived from them such as the ID index (.npz).
+## Entries are stored per release as <cache_dir>/<release>/<stage>-<key>.parquet and the whole
+## cache is kept under a size limit by evicting the least recently used entries across releases.
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from settings import CACHE_DIR, CACHE_SIZE_LIMIT, DATA_VERSION
+
+
+class PreprocessCache:
+    """
+    Stores pandas dataframes by stage name and key.
+    Object columns with repeated values are stored as categoricals, which keeps the files small and the reload fast.
+    """
+
+    SUFFIX = ".parquet"
+    SUFFIXES = (".parquet", ".npz")
+
+    def __init__(self, cache_dir=None, size_limit=CACHE_SIZE_LIMIT, release=DATA_VERSION):
+        self.cache_dir = cache_dir if cache_dir is not None else CACHE_DIR
+        self.size_limit = size_limit
+        self.release = release
+
+    def key(self, *parts):
+        """
+        Combines the release and the given parts (code version, input fingerprints, upstream keys) into a cache key
+        """
+        return hashlib.sha1("|".join([self.release] + [str(part) for part in parts]).encode()).hexdigest()[:16]
+
+    def path(self, stage, key, suffix=SUFFIX):
+        path = os.path.join(self.cache_dir, self.release, f"{stage}-{key}{suffix}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def load(self, stage, key):
+        """
+        :return: the cached dataframe or None if there is no entry
+        """
+        path = self.path(stage, key)
+        if not os.path.exists(path):
+            return None
+        df = pd.read_parquet(path)
+        ## modification time is the recency used by the eviction
+        os.utime(path)
+        print(f"Loaded {stage} from cache {path}")
+        return df
+
+    def store(self, stage, key, df):
+        path = self.path(stage, key)
+        self._with_categoricals(df).to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        self.evict()
+        return path
+
+    def load_id_index(self, key):
+        """
+        :return: the cached lib.id_index.IDIndexSet of the combined table with key, None if there is no entry
+        """
+        from lib.id_index import IDIndexSet
+        path = self.path("id_index", key, suffix=".npz")
+        if not os.path.exists(path):
+            return None
+        id_index = IDIndexSet.load(path)
+        os.utime(path)
+        print(f"Loaded id_index from cache {path}")
+        return id_index
+
+    def store_id_index(self, key, id_index):
+        path = self.path("id_index", key, suffix=".npz")
+        ## a file object, np.savez would append .npz to the temporary file name
+        with open(path + ".tmp", "wb") as fh:
+            id_index.save(fh)
+        os.replace(path + ".tmp", path)
+        self.evict()
+        return path
+
+    def set_latest(self, keys):
+        """
+        Records the keys of the last complete preprocessing run of the release, read by latest()
+        :param keys: {stage: key}
+        """
+        with open(os.path.join(self.cache_dir, self.release, "latest.json"), "w") as fh:
+            json.dump(keys, fh, indent=2)
+
+    def latest(self):
+        """
+        :return: {stage: key} of the last complete preprocessing run of the release, None if there is none
+        """
+        latest_file = os.path.join(self.cache_dir, self.release, "latest.json")
+        if not os.path.exists(latest_file):
+            return None
+        with open(latest_file) as fh:
+            return json.load(fh)
+
+    def evict(self):
+        """
+        Removes the least recently used entries of all releases until the cache fits into size_limit
+        """
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                if not file.endswith(self.SUFFIXES): continue
+                path = os.path.join(root, file)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.size_limit:
+                break
+            os.remove(path)
+            total_size -= size
+            print(f"Evicted {path} from cache")
+
+    @staticmethod
+    def _with_categoricals(df, max_ratio=0.5):
+        columns = {}
+        for column in df.columns:
+            if df[column].dtype != object: continue
+            try:
+                if df[column].nunique() <= max_ratio * len(df):
+                    columns[column] = "category"
+            except TypeError:
+                ## list values are not hashable
+                continue
+        return df.astype(columns)
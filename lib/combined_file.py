@@ -0,0 +1,70 @@
+## Binary format of the combined table: an uncompressed Arrow IPC file (feather v2).
+## Categorical columns are stored dictionary encoded, so the IDs and labels are integer codes on disk,
+## and the schema metadata holds the release, row count and columns of the table.
+## The file is memory-mapped on read and only the requested columns are converted to pandas.
+
+import json
+import os
+
+from settings import DATA_VERSION
+
+SUFFIX = ".arrow"
+## first bytes of every Arrow IPC file
+MAGIC = b"ARROW1"
+METADATA_KEY = b"opentargets"
+
+
+def is_combined_file(path):
+    """
+    :return: True if path is a binary combined file, False for a tsv file
+    """
+    with open(path, "rb") as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+def write_combined_file(df, output_file, release=DATA_VERSION, **metadata):
+    """
+    Writes the combined table with its object columns as categoricals
+    :param metadata: more json serializable entries of the metadata header
+    """
+    import pyarrow as pa
+
+    df = df.astype({column: "category" for column in df.columns if df[column].dtype == object})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    header = dict(release=release, rows=len(df), columns=list(df.columns), **metadata)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), METADATA_KEY: json.dumps(header)})
+
+    with pa.OSFile(output_file + ".tmp", "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(output_file + ".tmp", output_file)
+    return output_file
+
+
+def read_combined_metadata(path):
+    """
+    :return: the metadata header of a binary combined file, see write_combined_file
+    """
+    import pyarrow as pa
+
+    with pa.memory_map(path, "r") as source:
+        schema = pa.ipc.open_file(source).schema
+    return json.loads(schema.metadata[METADATA_KEY])
+
+
+def read_combined_file(path, columns=None):
+    """
+    Reads the given columns of a binary combined file, memory-mapped.
+    Dictionary encoded columns come back as pandas categoricals
+    :param columns: columns to load, all if None
+    :return: pandas dataframe
+    """
+    import pyarrow as pa
+
+    with pa.memory_map(path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            missing = [column for column in columns if column not in table.column_names]
+            if missing:
+                raise Exception(f"Columns {', '.join(missing)} are not in the combined file {path}")
+            table = table.select(columns)
+        return table.to_pandas()
@@ -3,35 +3,98 @@
 # - combines datasets into one table
 # - produces relevant illustrations/graphs
 
+import numpy as np
 import pandas as pd
-from utils import convert_to_list
-import tempfile
+from utils import convert_to_list, file_fingerprint
+from lib.cache import PreprocessCache
+from lib.profiling import RunProfile
+from lib.work_area import WorkArea
+from settings import CACHE_SIZE_LIMIT, WORK_AREA_MEMORY_LIMIT, WORK_AREA_SIZE_LIMIT
 import os
-import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+## number of json records parsed into one dataframe at a time
+READ_CHUNKSIZE = 50000
+## part of every cache key, bump it when the preprocessing or combining logic changes its output
+PREPROCESS_VERSION = "2"
+
+DRUG_MODALITY_KEYS = ["actionType", "drugType", "targetType", "biotype"]
+LOCATION_KEYS = ["subcellular_location_label", "subcellular_location"]
+## what the crosstabs count: every combined row, or the distinct drug and location or drug and target pairs of every cell,
+## as the columns identifying one counted unit
+COUNT_MODES = {"rows": [], "drug_location": ["ChemblID"], "drug_target": ["ChemblID", "EnsemblID"]}
+## mechanism of action rows joined with the targets at a time when the combined table is deduplicated
+DISTINCT_JOIN_CHUNKSIZE = 20000
+## figures of larger crosstabs are skipped, they are unreadable and a sparse crosstab would have to be made dense for them
+PLOT_CELL_LIMIT = 200000
 
 
 class DataProcess:
     """
     Takes in targets, moa and molecules json files,
     Preprocess and combine them into one table/tsv file
-
+    drug_modality and location_key can be lists, then every drug modality and location combination
+    is analysed from the same combined table, in parallel over workers processes
     """
 
+    ## json fields needed by each preprocessing step, the rest of the records are never loaded
+    TARGETS_FIELDS = ["id", "biotype", "alternativeGenes", "subcellularLocations"]
+    MOA_FIELDS = ["actionType", "chemblIds", "targetType", "targets"]
+    MOLECULES_FIELDS = ["id", "drugType", "childChemblIds", "parentId", "linkedTargets.rows"]
+
     def __init__(self, targets_file=None, mechanism_of_action_file=None, molecules_file=None, combined_file=None,
                  drug_modality="drugType", location_key="subcellular_location_label", show_only_significant=False,
-                 save_preprocess_data=False, out_dir=None, temp_dir=None):
+                 save_preprocess_data=False, out_dir=None, temp_dir=None, use_cache=True, cache_dir=None,
+                 cache_size_limit=CACHE_SIZE_LIMIT, correction="none", mid_p=False, workers=None, chunksize=None,
+                 profile=None, permutations=0, seed=0, previous_release=None, plot_formats=("pdf",), combined_format="tsv",
+                 plots=True, sparse=False, stratify_by=None, count_mode="rows", work_area_size_limit=WORK_AREA_SIZE_LIMIT,
+                 memory_limit=WORK_AREA_MEMORY_LIMIT, bootstrap=0, bootstrap_unit="ChemblID"):
 
         self.targets_file = targets_file
         self.mechanism_of_action_file = mechanism_of_action_file
         self.molecules_file = molecules_file
         self.save_preprocess_data = save_preprocess_data
-        self.out_dir = out_dir if out_dir is not None else f"./{drug_modality}_analysis"
-        self.temp_dir = temp_dir if temp_dir is not None else tempfile.mkdtemp(prefix="dataprocess_OT")
+        ## scratch directory of the run under temp_dir, created on first use and removed when process ends, see lib.work_area
+        self.work_area = WorkArea(root=temp_dir, prefix="dataprocess_OT", size_limit=work_area_size_limit, memory_limit=memory_limit)
         self.combined_file = combined_file
+        ## format of the combined table written by combine_data, "tsv" or the binary "arrow", see lib.combined_file
+        self.combined_format = combined_format
 
-        self.drug_modality_key = drug_modality
-        self.location_key = location_key
+        self.drug_modality_keys = [drug_modality] if isinstance(drug_modality, str) else list(drug_modality)
+        self.location_keys = [location_key] if isinstance(location_key, str) else list(location_key)
+        self.analysis_keys = [(modality, location) for modality in self.drug_modality_keys for location in self.location_keys]
+        self.drug_modality_key, self.location_key = self.analysis_keys[0]
+        self.out_dir = out_dir if out_dir is not None else f"./{self.drug_modality_key if len(self.drug_modality_keys) == 1 else 'drug_modality'}_analysis"
+        self.workers = workers
+        ## when set, --combined_file is aggregated chunk by chunk and never loaded as a whole
+        self.chunksize = chunksize
         self.show_only_significant = show_only_significant
+        ## figure formats, see lib.plotting.FORMATS, no figures and no plotting imports at all if plots is False
+        self.plot_formats = list(plot_formats)
+        self.plots = plots
+        ## crosstabs as lib.sparse.SparseContingency, only the non-zero cells are counted and tested
+        self.sparse = sparse
+        ## key the crosstabs are stratified by for the Cochran-Mantel-Haenszel tests, see lib.stratified
+        self.stratify_by = stratify_by
+        ## see COUNT_MODES, the combined table only keeps the distinct rows of the counted units
+        if count_mode not in COUNT_MODES:
+            raise Exception(f"Unknown count mode {count_mode}, select from {', '.join(COUNT_MODES)}")
+        self.count_mode = count_mode
+        self.unit_columns = COUNT_MODES[count_mode]
+        ## multiple testing correction used for the significance flag, see lib.stats.CORRECTIONS
+        self.correction = correction
+        self.mid_p = mid_p
+        ## drug level permutation test, see lib.resampling.permutation_test
+        self.permutations = permutations
+        self.seed = seed
+        self.permutation_p_values: pd.DataFrame = None
+        ## bootstrap confidence intervals of the percentages from resampling bootstrap_unit (drugs or targets), see lib.resampling.bootstrap_percentages
+        self.bootstrap = bootstrap
+        self.bootstrap_unit = bootstrap_unit
+        ## lower and upper bounds, locations x drug modalities pandas dataframes
+        self.percentage_intervals = None
 
         self.preprocessed_moa:pd.DataFrame = None
         self.preprocessed_targets:pd.DataFrame = None
@@ -39,135 +102,777 @@ class DataProcess:
         self.combined_data:pd.DataFrame = None
 
         self.contingency_table = None
+        ## ID sets of the preprocessed tables, see lib.id_index.IDIndexSet
+        self.id_index = None
+        ## {(drug_modality_key, location_key): contingency table}
+        self.contingency_tables = {}
+
+        self.cache = PreprocessCache(cache_dir=cache_dir, size_limit=cache_size_limit) if use_cache else None
+        ## release whose cached tables are updated incrementally instead of combining everything again, see lib.incremental
+        self.previous_release = previous_release
+        if previous_release is not None and self.cache is None:
+            raise Exception("Incremental updates from a previous release need the preprocess cache")
+        if previous_release is not None and self.unit_columns:
+            raise Exception("Incremental updates from a previous release only work with the rows count mode")
+        ## row counts of every drug modality and location combination, see lib.incremental.cell_counts
+        self.cell_counts: pd.DataFrame = None
+        self.previous_cell_counts: pd.DataFrame = None
+        ## {(drug_modality_key, location_key): contingency table of the previous release}
+        self.previous_contingency_tables = {}
+        self.previous_contingency_table = None
+        ## stage timings and memory, only measured when the profile is enabled
+        self.profile = profile if profile is not None else RunProfile()
+
 
+    @property
+    def temp_dir(self):
+        return self.work_area.dir
 
     def process(self):
+        """
+        Runs the whole analysis. The work area is removed at the end, also if a stage fails
+        """
+        try:
+            self._process()
+        finally:
+            self.work_area.cleanup()
+
+    def _process(self):
         ## Preprocess the data from json
         ## to combine them into one table
         if self.combined_file is None:
             self.preprocess()
+        elif self._is_binary_combined_file():
+            with self.profile.stage("read_combined_file") as record:
+                self.combined_data = self._read_binary_combined_file()
+                record["rows_out"] = len(self.combined_data)
+        elif self.chunksize is None:
+            with self.profile.stage("read_combined_file") as record:
+                self.combined_data = pd.read_csv(self.combined_file, sep="\t")
+                record["rows_out"] = len(self.combined_data)
         else:
-            self.combined_data = pd.read_csv(self.combined_file, sep="\t")
+            with self.profile.stage("chunked_crosstab") as record:
+                self.contingency_tables = self._read_contingency_tables_chunked()
+                record["rows_out"] = sum(table.size for table in self.contingency_tables.values())
 
         ## save preprocessed files to out_dir
         if not os.path.exists(self.out_dir):
             os.makedirs(self.out_dir)
 
         if self.save_preprocess_data:
-            shutil.copy(self.temp_dir, self.out_dir)
+            self.work_area.save(self.out_dir)
 
-        ## remove temp_dir
-        shutil.rmtree(self.temp_dir)
+        ## the intermediates are not needed anymore
+        self.work_area.cleanup()
 
         ## Creates contingency table for further analysis
-        self.contingency_table = pd.crosstab(self.combined_data[self.location_key], self.combined_data[self.drug_modality_key])
-        self.analyse()
+        if len(self.analysis_keys) == 1:
+            if self.contingency_tables:
+                self.contingency_table = self.contingency_tables[self.analysis_keys[0]]
+                self.previous_contingency_table = self.previous_contingency_tables.get(self.analysis_keys[0])
+            else:
+                with self.profile.stage("crosstab", rows_in=len(self.combined_data)) as record:
+                    self._add_combined_keys()
+                    if self.unit_columns:
+                        self.contingency_table = self._create_contingency_tables(
+                            self.combined_data, self.analysis_keys, self.sparse, self.unit_columns
+                        )[self.analysis_keys[0]]
+                    elif self.sparse:
+                        from lib.sparse import SparseContingency
+                        self.contingency_table = SparseContingency.from_frame(self.combined_data, self.location_key, self.drug_modality_key)
+                    else:
+                        self.contingency_table = pd.crosstab(self.combined_data[self.location_key], self.combined_data[self.drug_modality_key])
+                    record["rows_out"] = self.contingency_table.size
+            self.analyse()
+        else:
+            self.analyse_all()
+
+        if self.stratify_by is not None:
+            self.analyse_stratified()
+
+    def _is_binary_combined_file(self):
+        from lib.combined_file import is_combined_file
+        return is_combined_file(self.combined_file)
+
+    def _read_binary_combined_file(self):
+        """
+        Loads only the columns the analyses need from the memory-mapped binary combined file, see lib.combined_file.
+        The file is small enough to be read at once, so --chunksize does not apply to it
+        """
+        from lib.combined_file import read_combined_file, read_combined_metadata
+        metadata = read_combined_metadata(self.combined_file)
+        print(f"Reading combined file of release {metadata['release']} with {metadata['rows']} rows")
+        from lib.sparse import key_columns
+        columns = key_columns([key for keys in self.analysis_keys for key in keys] + ([self.stratify_by] if self.stratify_by else []))
+        if self.permutations or self.unit_columns or self.bootstrap:
+            columns = sorted(set(columns) | {"ChemblID"} | set(self.unit_columns) | ({self.bootstrap_unit} if self.bootstrap else set()))
+        return read_combined_file(self.combined_file, columns=columns)
+
+    def _add_combined_keys(self):
+        """
+        Adds the label columns of combined keys such as "drugType+biotype" to the combined table, see lib.sparse.add_combined_keys
+        """
+        from lib.sparse import add_combined_keys
+        add_combined_keys(self.combined_data, [key for keys in self.analysis_keys for key in keys])
+
+    def _read_contingency_tables_chunked(self):
+        """
+        Streams the two needed columns of every analysis out of the combined file, see utils.chunked_crosstabs
+        :return: {(drug_modality_key, location_key): contingency table}
+        """
+        from utils import chunked_crosstabs
+        from lib.sparse import KEY_SEPARATOR
+        if any(KEY_SEPARATOR in key for keys in self.analysis_keys for key in keys):
+            raise Exception("Combined keys are not supported with --chunksize")
+        if self.unit_columns:
+            raise Exception(f"The {self.count_mode} count mode does not work with --chunksize")
+        crosstabs = chunked_crosstabs(
+            self.combined_file, [(location, modality) for modality, location in self.analysis_keys], chunksize=self.chunksize
+        )
+        return {(modality, location): crosstab for (location, modality), crosstab in crosstabs.items()}
 
     def preprocess(self):
-        self.get_preprocess_targets()
-        self.get_preprocess_moa()
-        self.get_preprocess_molecules()
-        self.combine_data()
+        if self.cache is None:
+            self._profiled_stage("preprocess_targets", self.get_preprocess_targets, "preprocessed_targets")
+            self._spill_if_needed()
+            self._profiled_stage("preprocess_moa", self.get_preprocess_moa, "preprocessed_moa")
+            self._spill_if_needed()
+            self._profiled_stage("preprocess_molecules", self.get_preprocess_molecules, "preprocessed_molecules")
+            self._restore_spilled()
+            self._combine_data_profiled()
+            return
+
+        ## every stage is keyed by its inputs, the combined table by the keys of the three stages
+        stage_keys = {
+            "targets": self.cache.key(PREPROCESS_VERSION, "targets", file_fingerprint(self.targets_file)),
+            "moa": self.cache.key(PREPROCESS_VERSION, "moa", file_fingerprint(self.mechanism_of_action_file)),
+            "molecules": self.cache.key(PREPROCESS_VERSION, "molecules", file_fingerprint(self.molecules_file)),
+        }
+        combined_key = self.cache.key(PREPROCESS_VERSION, "combined", *stage_keys.values(), *([self.count_mode] if self.unit_columns else []))
+
+        with self.profile.stage("load_cached_combined") as record:
+            self.combined_data = self.cache.load("combined", combined_key)
+            record["rows_out"] = len(self.combined_data) if self.combined_data is not None else None
+        if self.combined_data is not None:
+            self.id_index = self.cache.load_id_index(combined_key)
+            self._save_cached_intermediates(stage_keys)
+            self._write_combined_data()
+            if self.id_index is not None:
+                self._save_id_index()
+            previous_tables = self._load_previous_release(["cell_counts"]) if self.previous_release is not None else None
+        else:
+            previous_tables = self._load_previous_release() if self.previous_release is not None else None
+            self.preprocessed_targets = self._cached_stage("targets", stage_keys["targets"], self.get_preprocess_targets, "preprocessed_targets")
+            self._spill_if_needed()
+            self.preprocessed_moa = self._cached_stage("moa", stage_keys["moa"], self.get_preprocess_moa, "preprocessed_moa")
+            self._spill_if_needed()
+            self.preprocessed_molecules = self._cached_stage("molecules", stage_keys["molecules"], self.get_preprocess_molecules, "preprocessed_molecules")
+            self._restore_spilled()
+            if previous_tables is None:
+                self._combine_data_profiled()
+            else:
+                self._combine_data_incremental(previous_tables)
+            self.cache.store("combined", combined_key, self.combined_data)
+            self.cache.store_id_index(combined_key, self.id_index)
+
+        if self.cell_counts is None:
+            self.cell_counts = self.cache.load("cell_counts", combined_key)
+        if self.cell_counts is None:
+            from lib.incremental import cell_counts
+            self.cell_counts = cell_counts(self.combined_data, DRUG_MODALITY_KEYS + LOCATION_KEYS)
+            self.cache.store("cell_counts", combined_key, self.cell_counts)
+        self.cache.set_latest(dict(stage_keys, combined=combined_key))
+
+        if previous_tables is not None:
+            ## crosstabs of both releases from the cell counts, the analysis reports the changes between them
+            self.previous_cell_counts = previous_tables["cell_counts"]
+            self.contingency_tables = self._contingency_tables_from_counts(self.cell_counts, self.analysis_keys, self.sparse)
+            self.previous_contingency_tables = self._contingency_tables_from_counts(self.previous_cell_counts, self.analysis_keys, self.sparse)
+
+    def _load_previous_release(self, stages=("moa", "molecules", "targets", "combined", "cell_counts")):
+        """
+        Loads the tables of the last preprocessing run of self.previous_release from the cache
+        :return: {stage: table}, or None if one of them is not cached anymore
+        """
+        previous_cache = PreprocessCache(cache_dir=self.cache.cache_dir, size_limit=self.cache.size_limit, release=self.previous_release)
+        keys = previous_cache.latest()
+        if keys is None:
+            print(f"No cached preprocessing run of release {self.previous_release}, combining the data from scratch")
+            return None
+
+        with self.profile.stage("load_previous_release"):
+            tables = {stage: previous_cache.load(stage, keys["combined" if stage == "cell_counts" else stage]) for stage in stages}
+            if tables["cell_counts"] is None and "combined" in tables and tables["combined"] is not None:
+                from lib.incremental import cell_counts
+                tables["cell_counts"] = cell_counts(tables["combined"], DRUG_MODALITY_KEYS + LOCATION_KEYS)
+        missing = [stage for stage, table in tables.items() if table is None]
+        if missing:
+            print(f"Release {self.previous_release} tables {', '.join(missing)} are not cached anymore, combining the data from scratch")
+            return None
+        return tables
+
+    def _combine_data_incremental(self, previous_tables):
+        """
+        Updates the combined table and the cell counts of the previous release with the differences of the preprocessed tables,
+        see lib.incremental. Only the combined rows of changed records are joined again
+        """
+        from lib.id_index import IDIndexSet
+        from lib.incremental import ReleaseUpdate, cell_counts, update_cell_counts
+        tables = {"moa": self.preprocessed_moa, "molecules": self.preprocessed_molecules, "targets": self.preprocessed_targets}
+        with self.profile.stage("release_diff", rows_in=sum(len(df) for df in tables.values())):
+            update = ReleaseUpdate.from_tables(previous_tables, tables)
+
+        previous_combined = previous_tables["combined"]
+        with self.profile.stage("combine_data_incremental", rows_in=len(previous_combined)) as record:
+            start = time.perf_counter()
+            self.id_index = IDIndexSet.from_tables(self.preprocessed_moa, self.preprocessed_molecules, self.preprocessed_targets)
+            self._save_id_index()
+            inserted = self._join_preprocessed(*update.affected_tables(tables["moa"], tables["molecules"], tables["targets"]), self.id_index, start)
+            self.preprocessed_moa = self.preprocessed_molecules = self.preprocessed_targets = None
+
+            deleted_rows = update.affected_rows(previous_combined)
+            deleted = previous_combined[deleted_rows]
+            print(f"combined: {len(deleted)} rows deleted, {len(inserted)} rows inserted")
+            keys = DRUG_MODALITY_KEYS + LOCATION_KEYS
+            self.cell_counts = update_cell_counts(previous_tables["cell_counts"], cell_counts(inserted, keys), cell_counts(deleted, keys))
+
+            self.combined_data = pd.concat([previous_combined[~deleted_rows], inserted[previous_combined.columns]], ignore_index=True)
+            self.combined_data["ChemblID"] = pd.Categorical(self.combined_data["ChemblID"], categories=self.id_index["molecules"].ids)
+            self.combined_data["EnsemblID"] = pd.Categorical(self.combined_data["EnsemblID"], categories=self.id_index["targets"].ids)
+            self.combined_data = self.combined_data.astype(
+                {column: "category" for column in DRUG_MODALITY_KEYS + LOCATION_KEYS if column in self.combined_data.columns}
+            )
+            self._report_stage("combined", self.combined_data, start)
+            record["rows_out"] = len(self.combined_data)
+        self._write_combined_data()
+
+    def _spill_if_needed(self):
+        """
+        Moves the finished preprocessed tables to the work area while the process or the machine is short of memory
+        """
+        for attribute in ["preprocessed_targets", "preprocessed_moa", "preprocessed_molecules"]:
+            df = getattr(self, attribute)
+            if df is None or not self.work_area.memory_pressure():
+                continue
+            with self.profile.stage(f"spill_{attribute}", rows_in=len(df)):
+                if self.work_area.spill(attribute, df):
+                    setattr(self, attribute, None)
+
+    def _restore_spilled(self):
+        for attribute in ["preprocessed_targets", "preprocessed_moa", "preprocessed_molecules"]:
+            if self.work_area.is_spilled(attribute):
+                with self.profile.stage(f"restore_{attribute}") as record:
+                    setattr(self, attribute, self.work_area.restore(attribute))
+                    record["rows_out"] = len(getattr(self, attribute))
+
+    def _save_intermediate(self, name, df):
+        """
+        Writes a preprocessed table to the work area, only if the intermediates are saved to out_dir, see save_preprocess_data
+        """
+        if self.save_preprocess_data:
+            return self.work_area.write_table(df, name)
+        return None
+
+    def _save_id_index(self):
+        if self.save_preprocess_data:
+            return self.work_area.add_file(self.id_index.save(self.work_area.path("id_index.npz")))
+        return None
+
+    def _cached_stage(self, stage, key, build, attribute):
+        """
+        Loads a preprocessed table from the cache, or builds it with build() and caches the result
+        """
+        with self.profile.stage(f"load_cached_{stage}") as record:
+            df = self.cache.load(stage, key)
+            record["rows_out"] = len(df) if df is not None else None
+        if df is None:
+            df = self._profiled_stage(f"preprocess_{stage}", build, attribute)
+            self.cache.store(stage, key, df)
+        else:
+            self._save_intermediate(f"preprocessed_{stage}", df)
+        return df
+
+    def _save_cached_intermediates(self, stage_keys):
+        """
+        Writes the cached preprocessed tables of a cached combined table, like a run that preprocesses them does,
+        only if the intermediates are saved to out_dir
+        :param stage_keys: {stage: cache key}
+        """
+        if not self.save_preprocess_data:
+            return
+        for stage, key in stage_keys.items():
+            df = self.cache.load(stage, key)
+            if df is None:
+                print(f"preprocessed_{stage} is not cached anymore, skipped writing it")
+                continue
+            self._save_intermediate(f"preprocessed_{stage}", df)
+
+    def _profiled_stage(self, stage, build, attribute):
+        with self.profile.stage(stage) as record:
+            build()
+            df = getattr(self, attribute)
+            record["rows_out"] = len(df)
+        return df
+
+    def _combine_data_profiled(self):
+        rows_in = len(self.preprocessed_moa) + len(self.preprocessed_molecules) + len(self.preprocessed_targets)
+        with self.profile.stage("combine_data", rows_in=rows_in) as record:
+            self.combine_data()
+            record["rows_out"] = len(self.combined_data)
 
     def get_preprocess_targets(self):
-        df_targets = self._read_json_data(self.targets_file)
+        self.preprocessed_targets = self._read_json_data(
+            self.targets_file, self.TARGETS_FIELDS, self._preprocess_targets_chunk, dtypes={"biotype": "category"},
+            workers=self.workers
+        )
+        self._save_intermediate("preprocessed_targets", self.preprocessed_targets)
 
+    @staticmethod
+    def _preprocess_targets_chunk(df_targets):
         ## Simplify the dataset
         ## narrow down the rows with no subcellular data
         df_targets.dropna(subset=['subcellularLocations'], inplace=True)
 
-        ## keep useful columns
-        columns_to_keep = ["id", "biotype", "subcellularLocations"]
-        df_targets = df_targets[columns_to_keep]
-        ## handle the subcellularLocations
-        # convert string to an array
-        df_targets["subcellularLocations"] = df_targets["subcellularLocations"].apply(lambda x: convert_to_list(x))
-        df_targets_exp_locs = df_targets.explode("subcellularLocations")
-        df_targets_exp_locs.dropna(subset=["subcellularLocations"], inplace=True)
+        ## one row per target and subcellular location
+        return DataProcess._flatten_target_locations(df_targets)
 
-        df_targets_exp_locs[["subcellular_location", "subcellular_location_label"]] = df_targets_exp_locs["subcellularLocations"].apply(lambda x: pd.Series(self._get_target_loc_values(x)))
+    @staticmethod
+    def _flatten_target_locations(df_targets):
+        """
+        Explodes the subcellularLocations records of the targets into subcellular_location and
+        subcellular_location_label columns in one pass over the records.
+        Locations in "<compartment>: <location>" format are reduced to the part after the colon.
+        :return: pandas dataframe with the remaining columns repeated per location, indexed like df.explode
+        """
+        # values read back from tsv files are strings of lists
+        records = [convert_to_list(x) if isinstance(x, str) else x for x in df_targets["subcellularLocations"]]
+        lengths = np.fromiter((len(x) for x in records), dtype=np.int64, count=len(records))
+        locations = [location for x in records for location in x]
+
+        ## drop the empty entries like explode + dropna would
+        valid = np.fromiter((isinstance(location, dict) for location in locations), dtype=bool, count=len(locations))
+        rows = np.repeat(np.arange(len(records)), lengths)[valid]
+        locations = [location for location in locations if isinstance(location, dict)]
+
+        location_names = pd.Series([location.get("location", None) for location in locations], dtype=object)
+        with_compartment = location_names.str.contains(":", regex=False, na=False).to_numpy(dtype=bool)
+        location_names[with_compartment] = location_names[with_compartment].str.split(":").str[1].str.strip()
 
-        self.preprocessed_targets = df_targets_exp_locs.drop("subcellularLocations", axis=1)
-        self.preprocessed_targets.to_csv(os.path.join(self.temp_dir, "preprocessed_targets.tsv"), sep="\t", index=False)
-        ### Free memory
-        del df_targets
-        del df_targets_exp_locs
+        df_targets_exp_locs = df_targets.drop("subcellularLocations", axis=1).iloc[rows]
+        df_targets_exp_locs["subcellular_location"] = location_names.to_numpy()
+        df_targets_exp_locs["subcellular_location_label"] = [location.get("labelSL", None) for location in locations]
+        return df_targets_exp_locs
 
     def get_preprocess_moa(self):
-        df_moa = self._read_json_data(self.mechanism_of_action_file)
-        df_moa.drop(columns=["references", "mechanismOfAction", "targetName"], inplace=True)
+        self.preprocessed_moa = self._read_json_data(
+            self.mechanism_of_action_file, self.MOA_FIELDS, self._preprocess_moa_chunk,
+            dtypes={"actionType": "category", "targetType": "category"}, workers=self.workers
+        )
+        self._save_intermediate("preprocessed_moa", self.preprocessed_moa)
+
+    @staticmethod
+    def _preprocess_moa_chunk(df_moa):
         df_moa["chemblIds"] = df_moa["chemblIds"].apply(lambda x: convert_to_list(x))
         df_moa["targets"] = df_moa["targets"].apply(lambda x: convert_to_list(x))
         df_moa_expChemId = df_moa.explode("chemblIds")
-        self.preprocessed_moa = df_moa_expChemId.explode("targets")
-        self.preprocessed_moa.dropna(subset=["targets"], inplace=True)
-        self.preprocessed_moa.to_csv(os.path.join(self.temp_dir, "preprocessed_moa.tsv"), sep="\t", index=False)
-        ## Free memory
-        del df_moa
-        del df_moa_expChemId
+        df_moa_exp = df_moa_expChemId.explode("targets")
+        df_moa_exp.dropna(subset=["targets"], inplace=True)
+        return df_moa_exp
 
     def get_preprocess_molecules(self):
-        df_molecules = self._read_json_data(self.molecules_file)
-        self.preprocessed_molecules = df_molecules[["id", "drugType"]]
-
-        self.preprocessed_molecules.to_csv(os.path.join(self.temp_dir, "preprocessed_molecules.tsv"), sep="\t", index=False)
-        ## Free memory
-        del df_molecules
+        self.preprocessed_molecules = self._read_json_data(
+            self.molecules_file, self.MOLECULES_FIELDS, dtypes={"drugType": "category"}, workers=self.workers
+        )
+        self._save_intermediate("preprocessed_molecules", self.preprocessed_molecules)
 
     def combine_data(self):
-        self.preprocessed_moa.rename(columns={"chemblIds": "ChemblID", "targets": "EnsemblID"}, inplace=True)
-        self.preprocessed_molecules.rename(columns={"id": "ChemblID"}, inplace=True)
-        self.preprocessed_targets.rename(columns={"id": "EnsemblID"}, inplace=True)
+        """
+        Joins the mechanisms of action with the molecules on ChemblID and with the targets on EnsemblID.
+        The IDs are encoded as integer codes of the molecules and targets ID indexes (see lib.id_index), which also
+        drops the rows without a partner on the other side before the joins. The preprocessed tables are released afterwards.
+        """
+        from lib.id_index import IDIndexSet
+        start = time.perf_counter()
+        self.id_index = IDIndexSet.from_tables(self.preprocessed_moa, self.preprocessed_molecules, self.preprocessed_targets)
+        self._save_id_index()
+
+        df_moa, df_molecules, df_targets = self.preprocessed_moa, self.preprocessed_molecules, self.preprocessed_targets
+        self.preprocessed_moa = self.preprocessed_molecules = self.preprocessed_targets = None
+        self.combined_data = self._join_preprocessed(df_moa, df_molecules, df_targets, self.id_index, start)
+        self._write_combined_data()
+
+    def _join_preprocessed(self, df_moa, df_molecules, df_targets, id_index, start):
+        """
+        Joins the preprocessed tables on the integer codes of id_index, see combine_data
+        :return: the combined pandas dataframe
+        """
+        df_moa = df_moa.rename(columns={"chemblIds": "ChemblID", "targets": "EnsemblID"})
+        df_molecules = df_molecules[["id", "drugType"]].rename(columns={"id": "ChemblID"})
+        df_targets = df_targets.drop(columns=["alternativeGenes"], errors="ignore").rename(columns={"id": "EnsemblID"})
+        self._report_stage("moa", df_moa, start)
+        self._report_stage("molecules", df_molecules, start)
+        self._report_stage("targets", df_targets, start)
+
+        ## shared dictionaries: the IDs that can be joined at all
+        chembl_ids = id_index["molecules"]
+        ensembl_ids = id_index["targets"]
+        df_moa["ChemblID"] = chembl_ids.encode(df_moa["ChemblID"])
+        df_moa["EnsemblID"] = ensembl_ids.encode(df_moa["EnsemblID"])
+        df_moa = df_moa[(df_moa["ChemblID"] >= 0) & (df_moa["EnsemblID"] >= 0)]
+        self._report_stage("moa with known molecule and target", df_moa, start)
+
+        df_molecules["ChemblID"] = chembl_ids.encode(df_molecules["ChemblID"])
+        df_molecules = df_molecules[np.isin(df_molecules["ChemblID"], df_moa["ChemblID"].unique())]
+        df_targets["EnsemblID"] = ensembl_ids.encode(df_targets["EnsemblID"])
+        df_targets = df_targets[np.isin(df_targets["EnsemblID"], df_moa["EnsemblID"].unique())]
+        self._report_stage("molecules with mechanism of action", df_molecules, start)
+        self._report_stage("targets with mechanism of action", df_targets, start)
+
+        if self.unit_columns:
+            ## repeated mechanisms of action and locations would only add duplicate rows
+            df_moa = df_moa.drop_duplicates()
+            df_targets = df_targets.drop_duplicates()
+            self._report_stage("distinct moa", df_moa, start)
+            self._report_stage("distinct targets", df_targets, start)
 
         ## Merge the datasets
-        df_drugmoa = pd.merge(self.preprocessed_moa, self.preprocessed_molecules, on="ChemblID")
-        self.combined_data = pd.merge(df_drugmoa, self.preprocessed_targets, on="EnsemblID")
+        df_drugmoa = pd.merge(df_moa, df_molecules, on="ChemblID")
+        del df_moa, df_molecules
+        self._report_stage("moa joined with molecules", df_drugmoa, start)
+        if "EnsemblID" in self.unit_columns or not self.unit_columns:
+            combined_data = pd.merge(df_drugmoa, df_targets, on="EnsemblID")
+        else:
+            combined_data = self._join_targets_distinct(df_drugmoa, df_targets)
+        del df_drugmoa, df_targets
 
-        self.combined_data.to_csv(os.path.join(self.temp_dir, "combined_data.tsv"), sep="\t", index=False)
-        del df_drugmoa
+        combined_data["ChemblID"] = pd.Categorical.from_codes(combined_data["ChemblID"], categories=chembl_ids.ids)
+        if "EnsemblID" in combined_data.columns:
+            combined_data["EnsemblID"] = pd.Categorical.from_codes(combined_data["EnsemblID"], categories=ensembl_ids.ids)
+        combined_data = combined_data.astype(
+            {column: "category" for column in DRUG_MODALITY_KEYS + LOCATION_KEYS if column in combined_data.columns}
+        )
+        self._report_stage("combined", combined_data, start)
+        return combined_data
 
     @staticmethod
-    def _read_json_data(json_file):
-        "Reads json file, normalizes and returns pandas dataframe"
-        from utils import convert_json2pandas
-        return convert_json2pandas(json_file)
+    def _join_targets_distinct(df_drugmoa, df_targets, chunksize=DISTINCT_JOIN_CHUNKSIZE):
+        """
+        Joins the targets to the drugs a few thousand drugs at a time, and keeps only the distinct rows without the targets.
+        The duplicates of one drug reached through several targets never exist for more than one chunk,
+        so the drug x target x location product of the whole table is never built
+        :return: pandas dataframe without EnsemblID
+        """
+        df_drugmoa = df_drugmoa.sort_values("ChemblID", kind="stable")
+        codes = df_drugmoa["ChemblID"].to_numpy()
+        ## chunk edges moved back to the first row of their drug, so every drug is in one chunk only
+        edges = np.unique(np.searchsorted(codes, codes[np.arange(0, len(codes), chunksize)], side="left"))
+        edges = np.append(edges, len(codes))
+        parts = []
+        for chunk_start, chunk_end in zip(edges[:-1], edges[1:]):
+            part = pd.merge(df_drugmoa.iloc[chunk_start:chunk_end], df_targets, on="EnsemblID")
+            parts.append(part.drop(columns=["EnsemblID"]).drop_duplicates())
+        if not parts:
+            return pd.merge(df_drugmoa, df_targets, on="EnsemblID").drop(columns=["EnsemblID"])
+        return pd.concat(parts, ignore_index=True)
+
+    def _write_combined_data(self):
+        """
+        Writes the combined table to the work area as combined_data.tsv(.gz), or as the binary combined_data.arrow
+        (see lib.combined_file), only if the intermediates are saved to out_dir
+        """
+        if not self.save_preprocess_data:
+            return None
+        if self.combined_format == "arrow":
+            from lib.combined_file import SUFFIX, write_combined_file
+            return self.work_area.add_file(write_combined_file(
+                self.combined_data, self.work_area.path(f"combined_data{SUFFIX}"), preprocess_version=PREPROCESS_VERSION
+            ))
+        return self.work_area.write_table(self.combined_data, "combined_data")
+
+    def _report_stage(self, stage, df, start):
+        """
+        Records an intermediate table of the join in the run profile, only with an enabled profile (--profile)
+        as measuring the memory scans the object columns
+        """
+        self.profile.checkpoint(stage, df, start)
 
     @staticmethod
-    def _get_target_loc_values(x):
-        location = x.get("location", None)
-        if ":" in location: location = location.split(":")[1].strip()
-        return location, x.get("labelSL", None)
+    def _read_json_data(json_file, fields, chunk_func=None, dtypes=None, workers=None):
+        """
+        Streams only the needed fields of the json file, applies chunk_func to every chunk
+        and returns the concatenated pandas dataframe.
+        json_file can also be a downloaded dataset directory, then its part files are read and
+        preprocessed in parallel over workers processes without joining them first
+        """
+        if not os.path.isdir(json_file):
+            return _read_json_part(json_file, fields, chunk_func, dtypes)
+
+        part_files = sorted(os.path.join(json_file, file) for file in os.listdir(json_file) if file.endswith(".json"))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(_read_json_part, part_files, repeat(fields), repeat(chunk_func), repeat(dtypes)))
+        df = pd.concat(parts, ignore_index=True)
+        return df.astype({column: dtype for column, dtype in (dtypes or {}).items() if column in df.columns})
 
     @staticmethod
     def _create_contingency_table(df, x, y):
         return pd.crosstab(df[x], df[y])
 
+    @staticmethod
+    def _create_contingency_tables(df, analysis_keys, sparse=False, unit_columns=()):
+        """
+        Builds the crosstab of every (drug_modality_key, location_key) pair from one groupby over the table.
+        Each crosstab is then summed from the small grouped counts and equals pd.crosstab(df[location_key], df[drug_modality_key])
+        :param sparse: build lib.sparse.SparseContingency crosstabs
+        :param unit_columns: count the distinct values of these columns per cell instead of the rows, see COUNT_MODES
+        :return: {(drug_modality_key, location_key): contingency table}
+        """
+        from lib.sparse import key_columns
+        columns = key_columns([key for keys in analysis_keys for key in keys])
+        counts = df.groupby(list(unit_columns) + columns, dropna=False, observed=True).size()
+        return DataProcess._contingency_tables_from_counts(counts, analysis_keys, sparse, unit_columns)
+
+    @staticmethod
+    def _contingency_tables_from_counts(counts, analysis_keys, sparse=False, unit_columns=()):
+        """
+        :param counts: pandas series of row counts indexed by the keys, or a lib.incremental.cell_counts dataframe.
+            Combined keys such as "drugType+biotype" are built from the counts of their parts
+        :param unit_columns: levels of counts that identify a counted unit, every unit is counted once per cell
+        :return: {(drug_modality_key, location_key): contingency table}
+        """
+        from lib.sparse import SparseContingency, add_combined_count_keys
+        if isinstance(counts, pd.DataFrame):
+            counts = counts.set_index([column for column in counts.columns if column != "count"])["count"]
+        ## the grouped counts are small, the combined labels are added to them instead of the table
+        counts = add_combined_count_keys(counts, list(unit_columns) + [key for pair in analysis_keys for key in pair])
+        contingency_tables = {}
+        for modality, location in analysis_keys:
+            pair_counts = _unit_counts(counts, [location, modality], unit_columns)
+            if sparse:
+                contingency_tables[(modality, location)] = SparseContingency.from_counts(pair_counts[pair_counts > 0], location, modality)
+            else:
+                contingency_tables[(modality, location)] = pair_counts.unstack(fill_value=0).rename_axis(index=location, columns=modality)
+        return contingency_tables
+
+    def analyse_all(self):
+        """
+        Analyses every drug modality and location combination of analysis_keys, see analyse.
+        The crosstabs are built in one pass and the reports and figures are created in parallel processes
+        """
+        if not self.contingency_tables:
+            with self.profile.stage("crosstabs", rows_in=len(self.combined_data)) as record:
+                self.contingency_tables = self._create_contingency_tables(self.combined_data, self.analysis_keys, self.sparse, self.unit_columns)
+                record["rows_out"] = sum(table.size for table in self.contingency_tables.values())
+        ## permutations run in their own process pool, before the analyses are distributed
+        permutation_p_values = {
+            (modality, location): self.get_permutation_p_values(modality, location) if self.permutations else None
+            for modality, location in self.analysis_keys
+        }
+        percentage_intervals = {
+            (modality, location): self.get_percentage_intervals(modality, location) if self.bootstrap else None
+            for modality, location in self.analysis_keys
+        }
+        options = dict(
+            out_dir=self.out_dir, use_cache=False, show_only_significant=self.show_only_significant,
+            correction=self.correction, mid_p=self.mid_p, plot_formats=self.plot_formats, plots=self.plots, sparse=self.sparse,
+            ## the analyses are already spread over the pool, each one renders its figures in its own process
+            workers=1,
+        )
+        with self.profile.stage("analyse_all", rows_in=len(self.contingency_tables)), ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                executor.submit(
+                    _analyse_contingency_table, contingency_table, modality, location, options,
+                    permutation_p_values[(modality, location)], self.previous_contingency_tables.get((modality, location)),
+                    percentage_intervals[(modality, location)]
+                )
+                for (modality, location), contingency_table in self.contingency_tables.items()
+            ]
+            for future in futures:
+                future.result()
+
+    @staticmethod
+    def _create_count_cubes(df, analysis_keys, stratum_key, unit_columns=()):
+        """
+        Builds the locations x drug modalities x strata count cube of every (drug_modality_key, location_key) pair
+        from one groupby over the table, see _create_contingency_tables
+        :return: {(drug_modality_key, location_key): lib.stratified.CountCube}
+        """
+        from lib.sparse import add_combined_count_keys, key_columns
+        from lib.stratified import CountCube
+        keys = [key for pair in analysis_keys for key in pair] + [stratum_key]
+        counts = df.groupby(list(unit_columns) + key_columns(keys), observed=True).size()
+        counts = add_combined_count_keys(counts, list(unit_columns) + keys)
+        return {
+            (modality, location): CountCube.from_counts(
+                _unit_counts(counts, [location, modality, stratum_key], unit_columns), location, modality, stratum_key
+            )
+            for modality, location in analysis_keys
+        }
+
+    def analyse_stratified(self):
+        """
+        Writes a __stratified_by_<key>_significance.tsv for every drug modality and location combination,
+        with the Cochran-Mantel-Haenszel test of every cell across the strata of self.stratify_by, see lib.stratified
+        """
+        if self.combined_data is None:
+            raise Exception("The stratified analysis needs the combined table, it does not work with --chunksize")
+        from lib.sparse import key_columns
+        missing = [column for column in key_columns([self.stratify_by]) if column not in self.combined_data.columns]
+        if missing:
+            raise Exception(f"{', '.join(missing)} is not a column of the combined table, select from {', '.join(self.combined_data.columns)}")
+
+        with self.profile.stage("stratified", rows_in=len(self.combined_data)) as record:
+            cubes = self._create_count_cubes(self.combined_data, self.analysis_keys, self.stratify_by, self.unit_columns)
+            for (modality, location), cube in cubes.items():
+                significance_table = cube.significance_table(self.correction)
+                if self.show_only_significant:
+                    significance_table = significance_table[significance_table["Significance"]]
+                significance_table.to_csv(
+                    os.path.join(self.out_dir, f"{modality}_{location}_stratified_by_{self.stratify_by}_significance.tsv"),
+                    sep="\t", index=False, na_rep="nan"
+                )
+            record["rows_out"] = sum(cube.counts.size for cube in cubes.values())
+
     def analyse(self):
         """
         Creates a __significance.tsv contains p-value and odds ratio for each drug modality and subcellular location
         and a heatmap for the drug modality and subcellular location
-        This method calls test_significance and create_heatmap methods to analyse the data
+        This method calls get_significance_table and create_heatmap methods to analyse the data
         drug_modality_key: drug_modality column_name to analyse
         inference_key : subcellular location to analyse
         :return:
         """
-        significance_table = ...
-        significance_file = os.path.join(self.out_dir, f"{self.drug_modality_key}_{self.location_key}_significance.tsv")
-        with open(significance_file, "w") as fh:
-            fh.write("Drug Modality\tLocation\tP-value\tOdds Ratio\tSignificance\n")
-            for key in self.contingency_table.columns:
-                for loc in self.contingency_table.index:
-                    fisher_p_value, odds_ratio, significance = self.test_significance(key, loc)
-                    if self.show_only_significant and not significance: continue
-                    stats_string = f"{fisher_p_value}\t{odds_ratio}\t{significance}"
-                    fh.write(f"{key}\t{loc}\t{stats_string}\n")
+        if self.permutations and self.permutation_p_values is None:
+            with self.profile.stage("permutation_test", rows_in=self.permutations):
+                self.permutation_p_values = self.get_permutation_p_values(self.drug_modality_key, self.location_key)
+        if self.bootstrap and self.percentage_intervals is None:
+            with self.profile.stage("bootstrap", rows_in=self.bootstrap):
+                self.percentage_intervals = self.get_percentage_intervals(self.drug_modality_key, self.location_key)
+
+        with self.profile.stage("significance", rows_in=self.contingency_table.size) as record:
+            significance_table = self.get_significance_table()
+            if self.show_only_significant:
+                significance_table = significance_table[significance_table["Significance"]]
+            significance_file = os.path.join(self.out_dir, f"{self.drug_modality_key}_{self.location_key}_significance.tsv")
+            significance_table.to_csv(significance_file, sep="\t", index=False, na_rep="nan")
+            record["rows_out"] = len(significance_table)
+
+        if self.percentage_intervals is not None:
+            with self.profile.stage("percentages", rows_in=self.contingency_table.size) as record:
+                percentage_table = self.get_percentage_table()
+                percentage_table.to_csv(
+                    os.path.join(self.out_dir, f"{self.drug_modality_key}_{self.location_key}_percentages.tsv"),
+                    sep="\t", index=False, na_rep="nan"
+                )
+                record["rows_out"] = len(percentage_table)
+
+        if self.previous_contingency_table is not None:
+            with self.profile.stage("release_changes", rows_in=self.contingency_table.size) as record:
+                release_changes = self.get_release_changes()
+                release_changes.to_csv(
+                    os.path.join(self.out_dir, f"{self.drug_modality_key}_{self.location_key}_release_changes.tsv"),
+                    sep="\t", index=False, na_rep="nan"
+                )
+                record["rows_out"] = len(release_changes)
+
+        if self.plots and self.contingency_table.size > PLOT_CELL_LIMIT:
+            print(f"Skipping the figures of {self.drug_modality_key} x {self.location_key}, the crosstab has more than {PLOT_CELL_LIMIT} cells")
+        elif self.plots:
+            with self.profile.stage("plots", rows_in=self.contingency_table.size):
+                self.create_plots()
+
+    def get_significance_table(self, significance=0.05, contingency_table=None):
+        """
+        Tests every drug modality and location cell of the contingency table at once, see significance_table.
+        The significance flag uses the p-values adjusted with self.correction
+        :param contingency_table: defaults to self.contingency_table, the permutation p-values are only added for that one
+        :return: pandas dataframe with one row per cell, drug modality by drug modality
+        """
+        if contingency_table is not None:
+            return significance_table(contingency_table, self.correction, significance, self.mid_p)
+        return significance_table(self.contingency_table, self.correction, significance, self.mid_p, self.permutation_p_values)
+
+    def get_release_changes(self, significance=0.05):
+        """
+        Count, p-value and significance of every cell in the previous and the current release, see lib.incremental.release_changes
+        :return: pandas dataframe with one row per cell of either release
+        """
+        from lib.incremental import release_changes
+        return release_changes(
+            _dense(self.previous_contingency_table), _dense(self.contingency_table),
+            self.get_significance_table(significance, contingency_table=self.previous_contingency_table),
+            self.get_significance_table(significance),
+        )
+
+    def get_permutation_p_values(self, drug_modality_key, location_key):
+        """
+        Empirical p-values of every cell from self.permutations permutations of the drug modality labels between drugs.
+        Each drug (ChemblID) keeps all its rows, so the fan-out of one drug over targets and locations is permuted as a whole
+        :return: locations x drug modalities pandas dataframe
+        """
+        from lib.resampling import permutation_test
+        blocks = self._resampling_blocks("ChemblID", drug_modality_key, location_key)
+        p_values, n_permutations = permutation_test(blocks, n_permutations=self.permutations, seed=self.seed, workers=self.workers)
+        print(f"Permutation test {drug_modality_key} x {location_key}: {n_permutations.to_numpy().min()}-{n_permutations.to_numpy().max()} permutations per cell")
+        return p_values
+
+    def get_percentage_intervals(self, drug_modality_key, location_key):
+        """
+        Bootstrap confidence intervals of the drug modality percentages of every location, from self.bootstrap resamples
+        of the drugs or targets (self.bootstrap_unit). All rows of a unit are resampled together
+        :return: lower and upper bounds as locations x drug modalities pandas dataframes
+        """
+        from lib.resampling import bootstrap_percentages
+        blocks = self._resampling_blocks(self.bootstrap_unit, drug_modality_key, location_key)
+        return bootstrap_percentages(blocks, n_replicates=self.bootstrap, seed=self.seed, workers=self.workers, location_or_modality="loc")
+
+    def _resampling_blocks(self, unit_key, drug_modality_key, location_key):
+        """
+        :return: lib.resampling.ContingencyBlocks of the combined table with one block per unit and drug modality
+        """
+        from lib.resampling import ContingencyBlocks
+        if self.combined_data is None or unit_key not in self.combined_data.columns:
+            raise Exception(f"Resampling needs the combined table with {unit_key}, it does not work with --chunksize")
+
+        self._add_combined_keys()
+        df = self.combined_data
+        if self.unit_columns:
+            ## every unit counts once per cell, like in the crosstabs
+            df = df[list(dict.fromkeys(self.unit_columns + [unit_key, drug_modality_key, location_key]))].drop_duplicates()
+        return ContingencyBlocks.from_frame(df, unit_key, drug_modality_key, location_key)
 
-        self.create_heatmap()
-        self.create_stacked_bar_distributions()
+    def get_percentage_table(self):
+        """
+        Drug modality percentages of every location with their bootstrap confidence intervals
+        :return: pandas dataframe with one row per cell, drug modality by drug modality
+        """
+        percentages = self._get_percentages("loc")
+        lower, upper = self._percentage_intervals(percentages)
+        n_locations = len(percentages.index)
+        return pd.DataFrame({
+            "Drug Modality": np.repeat(percentages.columns.to_numpy(), n_locations),
+            "Location": np.tile(percentages.index.to_numpy(), len(percentages.columns)),
+            "Percentage": percentages.to_numpy().T.ravel(),
+            "CI Lower": lower.to_numpy().T.ravel(),
+            "CI Upper": upper.to_numpy().T.ravel(),
+        })
+
+    def _percentage_intervals(self, percentages):
+        """
+        :return: self.percentage_intervals aligned with percentages, or None
+        """
+        if self.percentage_intervals is None:
+            return None
+        index, columns = percentages.index.astype(object), percentages.columns.astype(object)
+        return tuple(
+            bound.set_axis(bound.index.astype(object), axis=0).set_axis(bound.columns.astype(object), axis=1)
+            .reindex(index=index, columns=columns).set_axis(percentages.index, axis=0).set_axis(percentages.columns, axis=1)
+            for bound in self.percentage_intervals
+        )
 
     def test_significance(self, column_name, row_name, significance=0.05):
         """
         This function tests the significance of the association between a specific drug type and a subcellular location using Fisher's exact test.
+        get_significance_table tests all cells at once, this is for a single cell.
 
         Args:
           data: cross tab with rows indexed
@@ -185,7 +890,7 @@ class DataProcess:
         row_column = data[column_name][row_name]
         not_row_all_column = data[column_name].sum() - row_column
         all_row_not_column = data.loc[row_name].sum() - row_column
-        not_row_not_column = data.sum().sum() - not_row_all_column - all_row_not_column + row_column
+        not_row_not_column = data.sum().sum() - not_row_all_column - all_row_not_column - row_column
         contingency_table[0][0] = row_column  ## column+row sum
         contingency_table[1][0] = all_row_not_column  ## row - column
         contingency_table[0][1] = not_row_all_column
@@ -196,46 +901,129 @@ class DataProcess:
         #chi_stat, chi_p_value = chi2_contingency(contingency_table)
         return fisher_p_value, odds_ratio, significance > fisher_p_value
 
+    def create_plots(self):
+        """
+        Renders the heatmap and the stacked bar distributions in every format of self.plot_formats,
+        in parallel over self.workers processes, see lib.plotting.render_figures
+        """
+        from lib.plotting import render_figures
+        return render_figures([self._heatmap_job(), self._stacked_bar_job()], workers=self.workers)
+
     def create_heatmap(self, log_transform=True):
-        import seaborn as sns
-        import numpy as np
-        import matplotlib.pyplot as plt
-
-        title = f"{self.drug_modality_key} distribution on subcellular locations"
-        contingency_table = self.contingency_table
-        if log_transform:
-            contingency_table = np.log2(self.contingency_table + 1)
-            title = f"{title} (Log Scale)"
-
-        # Create a heatmap using seaborn
-        sns.heatmap(contingency_table, annot=False, cmap="viridis")
-        plt.title(title)
-        plt.xlabel(self.drug_modality_key)
-        plt.ylabel("subcellular locations")
-        plt.xticks(rotation=45, ha="right")
-
-        plt.savefig(
-            os.path.join(self.out_dir, f"{self.drug_modality_key}_{self.location_key}_heatmap.pdf"),
-            format="pdf", bbox_inches="tight"
-        )
-        plt.show()
+        plot, args = self._heatmap_job(log_transform)
+        return plot(*args)
 
     def create_stacked_bar_distributions(self):
-        import matplotlib.pyplot as plt
-
-        plt.figure(figsize=(10, 6))  # Adjust figure size as needed
-        df_percentage = self._get_percentages("loc")
-        df_percentage.plot(kind="bar", stacked=True, use_index=True)
-        plt.xlabel("Subcellular Location")
-        plt.ylabel("Percentages")
-        plt.title(f"Distribution of {self.drug_modality_key} Across Subcellular Locations")
-        plt.xticks(rotation=45, ha="right")  # Rotate x-axis labels for readability
-        plt.legend(loc='upper left', bbox_to_anchor=(1, 1))
-        plt.tight_layout()
-        plt.savefig(os.path.join(self.out_dir, "stacked_bar_distributions.pdf"), format="pdf", bbox_inches="tight")
-        plt.show()
+        plot, args = self._stacked_bar_job()
+        return plot(*args)
+
+    def _heatmap_job(self, log_transform=True):
+        from lib.plotting import output_files, plot_heatmap
+        files = output_files(self.out_dir, f"{self.drug_modality_key}_{self.location_key}_heatmap", self.plot_formats)
+        return plot_heatmap, (_dense(self.contingency_table), self.drug_modality_key, files, log_transform)
+
+    def _stacked_bar_job(self):
+        from lib.plotting import output_files, plot_stacked_bar
+        files = output_files(self.out_dir, f"{self.drug_modality_key}_{self.location_key}_stacked_bar_distributions", self.plot_formats)
+        percentages = self._get_percentages("loc")
+        return plot_stacked_bar, (percentages, self.drug_modality_key, files, 0.5, self._percentage_intervals(percentages))
 
     def _get_percentages(self, location_or_modality="loc"):
-        if location_or_modality == "loc": ##percentages by row
-            return self.contingency_table.T.apply(lambda x: x * 100 / x.sum()).T
-        return self.contingency_table.apply(lambda x: x * 100 / x.sum()) ##precentage by column
\ No newline at end of file
+        return get_percentages(_dense(self.contingency_table), location_or_modality)
+
+    def write_profile(self, **metadata):
+        """
+        Writes the run profile next to the significance reports, see lib.profiling.RunProfile
+        """
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        return self.profile.write(
+            os.path.join(self.out_dir, "run_profile.json"),
+            analysis_keys=[list(keys) for keys in self.analysis_keys], **metadata
+        )
+
+
+def significance_table(contingency_table, correction="none", significance=0.05, mid_p=False, permutation_p_values=None):
+    """
+    Tests every drug modality and location cell of a contingency table at once with Fisher's exact test,
+    see lib.stats.crosstab_significance
+    :param correction: multiple testing correction of the significance flag, see lib.stats.CORRECTIONS
+    :param permutation_p_values: optional locations x drug modalities empirical p-values, see DataProcess.get_permutation_p_values
+    :return: pandas dataframe with one row per cell, drug modality by drug modality.
+        Only the non-zero cells for a lib.sparse.SparseContingency, see SparseContingency.significance_table
+    """
+    from lib.sparse import SparseContingency
+    if isinstance(contingency_table, SparseContingency):
+        return contingency_table.significance_table(correction, significance, mid_p, permutation_p_values)
+
+    from lib.stats import crosstab_significance
+
+    ## cells in column order: all locations of the first drug modality, then the next one
+    counts = contingency_table.to_numpy().T
+    statistics = crosstab_significance(counts, correction=correction, significance=significance, mid_p=mid_p)
+    n_locations = len(contingency_table.index)
+
+    significance_table = pd.DataFrame({
+        "Drug Modality": np.repeat(contingency_table.columns.to_numpy(), n_locations),
+        "Location": np.tile(contingency_table.index.to_numpy(), len(contingency_table.columns)),
+        "P-value": statistics["p_value"].ravel(),
+        "Odds Ratio": statistics["odds_ratio"].ravel(),
+        "Significance": statistics["significant"].ravel(),
+        "BH Adjusted P-value": statistics["bh_p_value"].ravel(),
+        "Bonferroni Adjusted P-value": statistics["bonferroni_p_value"].ravel(),
+        "Log Odds Ratio CI Lower": statistics["log_odds_ratio_ci_lower"].ravel(),
+        "Log Odds Ratio CI Upper": statistics["log_odds_ratio_ci_upper"].ravel(),
+    })
+    if mid_p:
+        significance_table["Mid P-value"] = statistics["mid_p_value"].ravel()
+    if permutation_p_values is not None:
+        permutation_p_values = permutation_p_values.reindex(index=contingency_table.index, columns=contingency_table.columns)
+        significance_table["Permutation P-value"] = permutation_p_values.to_numpy().T.ravel()
+    return significance_table
+
+
+def _unit_counts(counts, keys, unit_columns=()):
+    """
+    Sums grouped counts over every level but keys. With unit_columns, the number of distinct units per cell instead
+    """
+    if not unit_columns:
+        return counts.groupby(level=keys, observed=True).sum()
+    units = counts.groupby(level=list(unit_columns) + keys, observed=True).sum()
+    return units[units > 0].groupby(level=keys, observed=True).size()
+
+
+def _dense(contingency_table):
+    from lib.sparse import SparseContingency
+    if isinstance(contingency_table, SparseContingency):
+        return contingency_table.to_dense()
+    return contingency_table
+
+
+def get_percentages(contingency_table, location_or_modality="loc"):
+    if location_or_modality == "loc": ##percentages by row
+        return contingency_table.T.apply(lambda x: x * 100 / x.sum()).T
+    return contingency_table.apply(lambda x: x * 100 / x.sum()) ##precentage by column
+
+
+def _analyse_contingency_table(contingency_table, drug_modality_key, location_key, options, permutation_p_values=None,
+                               previous_contingency_table=None, percentage_intervals=None):
+    """
+    Runs DataProcess.analyse on one contingency table, used by the worker processes of DataProcess.analyse_all
+    """
+    dataprocess_obj = DataProcess(drug_modality=drug_modality_key, location_key=location_key, **options)
+    dataprocess_obj.contingency_table = contingency_table
+    dataprocess_obj.permutation_p_values = permutation_p_values
+    dataprocess_obj.previous_contingency_table = previous_contingency_table
+    dataprocess_obj.percentage_intervals = percentage_intervals
+    dataprocess_obj.analyse()
+
+
+def _read_json_part(json_file, fields, chunk_func, dtypes):
+    """
+    Reads and preprocesses one json lines file chunk by chunk, see DataProcess._read_json_data
+    """
+    from utils import iter_json_chunks
+    chunks = iter_json_chunks(json_file, fields, chunksize=READ_CHUNKSIZE, dtypes=dtypes)
+    df = pd.concat([chunk_func(chunk) if chunk_func is not None else chunk for chunk in chunks])
+    ## categories differ between chunks, so concat falls back to object columns
+    return df.astype({column: dtype for column, dtype in (dtypes or {}).items() if column in df.columns})
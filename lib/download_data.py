@@ -1,70 +1,113 @@
 import os
-from settings import OPENTARGETS_LINK, DATA_VERSION, DATA_TYPE
-from utils import call_subprocess
-import tempfile
+from settings import DATASETS, DOWNLOAD_WORKERS, WORK_AREA_SIZE_LIMIT
+from lib.mirror import DatasetMirror
+from lib.profiling import RunProfile
+from lib.work_area import WorkArea
 
 
 class DownloadPrepareInitialData:
     """
     Downloads the OpenTargets dataset and joins the json files.
-    If the output files are not specified, it creates them in a temporary directory
+    If the output files are not specified, it creates them in a work area that cleanup removes, see lib.work_area
+    The datasets are mirrored into work_dir, by default the persistent mirror of settings.DATA_VERSION,
+    so only missing or changed files are downloaded again.
     If download is set to False, work_dir should be specified as the directory containing the downloaded directories
+    With join=False the part files are not joined, get_combined_files returns the dataset directories instead,
+    which DataProcess reads part by part in parallel
+    The joined files count against the size limit of the work area, created in temp_dir
     """
 
-    def __init__(self, mechanism_of_action_output=None, targets_output=None, molecules_output=None,  work_dir=None):
+    def __init__(self, mechanism_of_action_output=None, targets_output=None, molecules_output=None,  work_dir=None,
+                 base_url=None, workers=DOWNLOAD_WORKERS, profile=None, join=True, temp_dir=None, work_area_size_limit=WORK_AREA_SIZE_LIMIT):
 
-        self.temp_dir = work_dir if work_dir is not None else tempfile.mkdtemp(prefix="download_OT")
-        self.moa_combined = mechanism_of_action_output if mechanism_of_action_output is not None else tempfile.mktemp(dir=self.temp_dir, suffix="moa_combined.json")
-        self.targets_combined = targets_output if targets_output is not None else tempfile.mktemp(dir=self.temp_dir, suffix="targets_combined.json")
-        self.molecules_combined = molecules_output if molecules_output is not None else tempfile.mktemp(dir=self.temp_dir, suffix="molecules_combined.json")
+        self.mirror = DatasetMirror(local_dir=work_dir, base_url=base_url, workers=workers)
+        self.data_dir = self.mirror.local_dir
+        self.work_area = WorkArea(root=temp_dir, prefix="download_OT", size_limit=work_area_size_limit)
+        self.moa_combined = mechanism_of_action_output
+        self.targets_combined = targets_output
+        self.molecules_combined = molecules_output
 
         self.download = not all([mechanism_of_action_output, targets_output, molecules_output])
+        self.profile = profile if profile is not None else RunProfile()
+        self.join = join
+        if not join:
+            self.targets_combined = os.path.join(self.data_dir, "targets")
+            self.moa_combined = os.path.join(self.data_dir, "mechanismOfAction")
+            self.molecules_combined = os.path.join(self.data_dir, "molecule")
+        else:
+            ## the joined files only live as long as the run
+            self.moa_combined = self.moa_combined or self.work_area.path("moa_combined.json")
+            self.targets_combined = self.targets_combined or self.work_area.path("targets_combined.json")
+            self.molecules_combined = self.molecules_combined or self.work_area.path("molecules_combined.json")
+        self.work_area_files = {
+            file for file, output in [(self.moa_combined, mechanism_of_action_output), (self.targets_combined, targets_output),
+                                      (self.molecules_combined, molecules_output)] if join and output is None
+        }
 
     def process(self):
         if self.download:
-            self.download_all()
-
-        self.join_json_files(os.path.join(self.temp_dir, "targets"), self.targets_combined)
-        self.join_json_files(os.path.join(self.temp_dir, "mechanismOfAction"), self.moa_combined)
-        self.join_json_files(os.path.join(self.temp_dir, "molecule"), self.molecules_combined)
+            with self.profile.stage("download"):
+                self.download_all()
+
+        if not self.join:
+            return
+
+        for data_name, combined_file in [("targets", self.targets_combined), ("mechanismOfAction", self.moa_combined), ("molecule", self.molecules_combined)]:
+            input_folder = os.path.join(self.data_dir, data_name)
+            in_work_area = combined_file in self.work_area_files
+            if in_work_area:
+                ## the joined file is about as large as its part files
+                self.work_area.reserve(self.dataset_size(input_folder), os.path.basename(combined_file))
+            with self.profile.stage(f"join_{data_name}") as record:
+                record["rows_out"] = self.join_json_files(input_folder, combined_file)
+            if in_work_area:
+                self.work_area.add_file(combined_file)
 
     def download_data(self, data_name):
         """
-        Downloads the OpenTargets dataset from the link specified in settings.py
+        Downloads one OpenTargets dataset from the link specified in settings.py
         """
-
-        download_url = f"{OPENTARGETS_LINK}/{DATA_VERSION}/output/etl/{DATA_TYPE}/{data_name}"
-
-        download_params = ["--recursive", "--no-parent", "--no-host-directories", "--cut-dirs", "8", "--directory-prefix", self.temp_dir,  download_url]
-
-        return_code, _ = call_subprocess("wget", download_params)
-
-        if return_code != 0:
-            raise Exception("Download failed")
-
+        self.mirror.sync([data_name])
         print(f"Downloaded {data_name}")
         return 1
 
+    @staticmethod
+    def dataset_size(input_folder):
+        """
+        :return: bytes of the json part files in input_folder
+        """
+        return sum(os.path.getsize(os.path.join(input_folder, file)) for file in os.listdir(input_folder) if file.endswith(".json"))
+
     @staticmethod
     def join_json_files(input_folder, output_file):
         """
         Joins all the json lines files in the input_folder into one file
+        :return: number of lines written
         """
+        n_lines = 0
         with open(output_file, "w") as out_fh:
             for file in os.listdir(input_folder):
                 if not file.endswith(".json"): continue
                 with open(os.path.join(input_folder, file), "r") as in_fh:
-                    out_fh.write("\n".join([line.strip() for line in in_fh]))
+                    lines = [line.strip() for line in in_fh]
+                    out_fh.write("\n".join(lines))
                     out_fh.write("\n")
+                    n_lines += len(lines)
+        return n_lines
 
     def download_all(self):
-        print(f"Downloading targets to {os.path.join(self.temp_dir, 'targets')}")
-        self.download_data("targets")
-        print(f"Downloading mechanismOfAction to {os.path.join(self.temp_dir, 'mechanismOfAction')}")
-        self.download_data("mechanismOfAction")
-        print(f"Downloading molecule to {os.path.join(self.temp_dir, 'molecule')}")
-        self.download_data("molecule")
+        """
+        Downloads the part files of all datasets concurrently into the mirror
+        """
+        print(f"Downloading {', '.join(DATASETS)} to {self.data_dir}")
+        self.mirror.sync(DATASETS)
 
     def get_combined_files(self):
         return self.targets_combined, self.moa_combined, self.molecules_combined
 
+    def cleanup(self):
+        """
+        Removes the joined files of the work area, the mirror is kept
+        """
+        self.work_area.cleanup()
+
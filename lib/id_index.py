@@ -0,0 +1,158 @@
+## Integer encoding of the ChEMBL and Ensembl IDs of the preprocessed tables.
+## Every ID set is stored as a sorted unique array, an ID is encoded as its position in the array,
+## and set queries run on whole arrays with numpy instead of python sets.
+
+import numpy as np
+import pandas as pd
+
+from utils import convert_to_list
+
+
+class IDIndex:
+    """
+    Sorted unique IDs. encode() maps IDs to their positions, -1 for unknown or missing IDs
+    """
+
+    def __init__(self, ids):
+        ids = np.asarray(ids, dtype=object)
+        self.ids = np.unique(ids[pd.notna(ids)].astype(str))
+
+    @classmethod
+    def from_sorted(cls, ids):
+        index = cls.__new__(cls)
+        index.ids = np.asarray(ids, dtype=str)
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def encode(self, values):
+        values = np.asarray(values, dtype=object)
+        present = pd.notna(values)
+        codes = np.full(len(values), -1, dtype=np.int64)
+        if not len(self.ids) or not present.any():
+            return codes
+        strings = values[present].astype(str)
+        positions = np.minimum(np.searchsorted(self.ids, strings), len(self.ids) - 1)
+        codes[present] = np.where(self.ids[positions] == strings, positions, -1)
+        return codes
+
+    def decode(self, codes):
+        return self.ids[codes]
+
+    def contains(self, values):
+        return self.encode(values) >= 0
+
+    def intersection(self, other):
+        return IDIndex.from_sorted(np.intersect1d(self.ids, other.ids, assume_unique=True))
+
+    def difference(self, other):
+        return IDIndex.from_sorted(np.setdiff1d(self.ids, other.ids, assume_unique=True))
+
+    def union(self, other):
+        return IDIndex.from_sorted(np.union1d(self.ids, other.ids))
+
+    def issubset(self, other):
+        return len(self.difference(other)) == 0
+
+
+def _flatten_ids(values):
+    """IDs of a column of ID lists, lists read back from tsv files are strings"""
+    ids = []
+    for value in values:
+        value = convert_to_list(value) if isinstance(value, str) and value.startswith("[") else value
+        if isinstance(value, (list, np.ndarray)):
+            ids.extend(value)
+        elif isinstance(value, str):
+            ids.append(value)
+    return ids
+
+
+class IDIndexSet:
+    """
+    The ID sets of the three datasets and the parent/child relations of the molecules:
+        moa_chembl, moa_targets         IDs linked by the mechanisms of action
+        molecules, targets              IDs of the molecule and target records
+        molecule_parents, molecule_children, linked_targets, alternative_genes
+    Built once from the preprocessed tables and saved as one .npz file
+    """
+
+    NAMES = ["moa_chembl", "moa_targets", "molecules", "targets", "molecule_parents", "molecule_children", "linked_targets", "alternative_genes"]
+
+    def __init__(self, indexes, parents, children_offsets, children):
+        self.indexes = indexes
+        ## parent ID of every molecule of indexes["molecules"], "" if it has none
+        self.parents = parents
+        ## children of molecule i are children[children_offsets[i]:children_offsets[i + 1]]
+        self.children_offsets = children_offsets
+        self.children = children
+
+    def __getitem__(self, name):
+        return self.indexes[name]
+
+    @classmethod
+    def from_tables(cls, df_moa, df_molecules, df_targets):
+        """
+        :param df_moa: preprocessed mechanisms of action with chemblIds and targets
+        :param df_molecules: preprocessed molecules with id, parentId, childChemblIds and linkedTargets.rows
+        :param df_targets: preprocessed targets with id and alternativeGenes
+        """
+        def column(df, name):
+            return df[name] if name in df.columns else pd.Series([], dtype=object)
+
+        indexes = {
+            "moa_chembl": IDIndex(_flatten_ids(column(df_moa, "chemblIds"))),
+            "moa_targets": IDIndex(_flatten_ids(column(df_moa, "targets"))),
+            "molecules": IDIndex(column(df_molecules, "id")),
+            "targets": IDIndex(column(df_targets, "id")),
+            "molecule_parents": IDIndex(column(df_molecules, "parentId")),
+            "molecule_children": IDIndex(_flatten_ids(column(df_molecules, "childChemblIds"))),
+            "linked_targets": IDIndex(_flatten_ids(column(df_molecules, "linkedTargets.rows"))),
+            "alternative_genes": IDIndex(_flatten_ids(column(df_targets, "alternativeGenes"))),
+        }
+
+        ## parent and children per molecule, aligned with the molecules index
+        molecules = df_molecules.drop_duplicates(subset=["id"])
+        codes = indexes["molecules"].encode(molecules["id"])
+        order = np.argsort(codes)
+        molecules = molecules.iloc[order[codes[order] >= 0]]
+        parents = np.asarray(column(molecules, "parentId").fillna(""), dtype=str) if "parentId" in molecules.columns else np.full(len(molecules), "", dtype=str)
+        children_lists = [_flatten_ids([value]) for value in column(molecules, "childChemblIds")] if "childChemblIds" in molecules.columns else [[] for _ in range(len(molecules))]
+        children_offsets = np.concatenate([[0], np.cumsum([len(children) for children in children_lists])]).astype(np.int64)
+        children = np.asarray([child for children in children_lists for child in children], dtype=str)
+        return cls(indexes, parents, children_offsets, children)
+
+    def resolve_parents(self, chembl_ids):
+        """
+        :return: the parent ID of every molecule that has one, the ID itself otherwise
+        """
+        chembl_ids = np.asarray(chembl_ids, dtype=object)
+        codes = self["molecules"].encode(chembl_ids)
+        resolved = chembl_ids.astype(str)
+        known = codes >= 0
+        parents = self.parents[codes[known]]
+        resolved[np.flatnonzero(known)[parents != ""]] = parents[parents != ""]
+        return resolved
+
+    def children_of(self, chembl_ids):
+        """
+        :return: IDIndex of all children of the given molecules
+        """
+        codes = self["molecules"].encode(chembl_ids)
+        codes = codes[codes >= 0]
+        starts, ends = self.children_offsets[codes], self.children_offsets[codes + 1]
+        positions = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)]) if len(codes) else np.array([], dtype=np.int64)
+        return IDIndex(self.children[positions.astype(np.int64)])
+
+    def save(self, output_file):
+        np.savez_compressed(
+            output_file, parents=self.parents, children_offsets=self.children_offsets, children=self.children,
+            **{name: index.ids for name, index in self.indexes.items()}
+        )
+        return output_file
+
+    @classmethod
+    def load(cls, index_file):
+        with np.load(index_file) as data:
+            indexes = {name: IDIndex.from_sorted(data[name]) for name in cls.NAMES}
+            return cls(indexes, data["parents"], data["children_offsets"], data["children"])
@@ -0,0 +1,157 @@
+## Release to release update of the combined table and its cell counts.
+## The preprocessed tables of the new release are compared with the cached tables of the previous release by record ID:
+## molecules by ChemblID, targets by EnsemblID and mechanisms of action by their (ChemblID, EnsemblID) pair.
+## A combined row only depends on its mechanism of action rows, its molecule and its target, so only the combined rows
+## of changed IDs are deleted and joined again, and the cell counts are updated by the counts of those rows.
+
+import pandas as pd
+
+## columns compared per preprocessed table, the ones that end up in the combined table
+DIFF_COLUMNS = {
+    "moa": (["chemblIds", "targets"], ["actionType", "chemblIds", "targetType", "targets"]),
+    "molecules": (["id"], ["id", "drugType"]),
+    "targets": (["id"], ["id", "biotype", "subcellular_location", "subcellular_location_label"]),
+}
+
+
+def record_hashes(df, id_columns, columns):
+    """
+    Order independent hash of the rows of every record, the sum of its row hashes
+    :return: pandas series of uint64 hashes indexed by id_columns
+    """
+    columns = [column for column in columns if column in df.columns]
+    ## the same value hashes the same whether it was read as a category or as a string
+    row_hashes = pd.util.hash_pandas_object(df[columns].astype(str), index=False)
+    return row_hashes.groupby([df[column].astype(str) for column in id_columns]).sum()
+
+
+class ReleaseDiff:
+    """
+    IDs of one preprocessed table inserted, deleted or changed between two releases
+    """
+
+    def __init__(self, inserted, deleted, changed):
+        self.inserted = inserted
+        self.deleted = deleted
+        self.changed = changed
+
+    @classmethod
+    def from_tables(cls, df_previous, df, id_columns, columns):
+        previous_hashes = record_hashes(df_previous, id_columns, columns)
+        hashes = record_hashes(df, id_columns, columns)
+        common = hashes.index.intersection(previous_hashes.index)
+        changed = common[hashes[common].to_numpy() != previous_hashes[common].to_numpy()]
+        return cls(hashes.index.difference(previous_hashes.index), previous_hashes.index.difference(hashes.index), changed)
+
+    @property
+    def affected(self):
+        return self.inserted.union(self.deleted).union(self.changed)
+
+    def __str__(self):
+        return f"{len(self.inserted)} inserted, {len(self.deleted)} deleted, {len(self.changed)} changed"
+
+
+class ReleaseUpdate:
+    """
+    Differences of the moa, molecules and targets tables between two releases
+    and the combined rows they affect
+    """
+
+    def __init__(self, diffs):
+        self.diffs = diffs
+        self.chembl_ids = diffs["molecules"].affected
+        self.ensembl_ids = diffs["targets"].affected
+        self.moa_pairs = diffs["moa"].affected
+
+    @classmethod
+    def from_tables(cls, previous_tables, tables):
+        """
+        :param previous_tables: {"moa", "molecules", "targets": preprocessed table of the previous release}
+        :param tables: the same tables of the new release
+        """
+        diffs = {}
+        for name, (id_columns, columns) in DIFF_COLUMNS.items():
+            diffs[name] = ReleaseDiff.from_tables(previous_tables[name], tables[name], id_columns, columns)
+            print(f"{name}: {diffs[name]}")
+        return cls(diffs)
+
+    def affected_rows(self, df, chembl_column="ChemblID", ensembl_column="EnsemblID"):
+        """
+        :return: boolean mask of the rows of df that depend on a changed molecule, target or mechanism of action
+        """
+        chembl_ids = df[chembl_column].astype(str)
+        ensembl_ids = df[ensembl_column].astype(str)
+        mask = chembl_ids.isin(self.chembl_ids) | ensembl_ids.isin(self.ensembl_ids)
+        if len(self.moa_pairs):
+            mask |= pd.MultiIndex.from_arrays([chembl_ids, ensembl_ids]).isin(self.moa_pairs)
+        return mask.to_numpy()
+
+    def affected_tables(self, df_moa, df_molecules, df_targets):
+        """
+        Restricts the preprocessed tables of the new release to the rows needed to join the affected combined rows again
+        """
+        df_moa = df_moa[self.affected_rows(df_moa, chembl_column="chemblIds", ensembl_column="targets")]
+        df_molecules = df_molecules[df_molecules["id"].isin(df_moa["chemblIds"])]
+        df_targets = df_targets[df_targets["id"].isin(df_moa["targets"])]
+        return df_moa, df_molecules, df_targets
+
+
+def cell_counts(df, keys):
+    """
+    Row counts of every combination of the drug modality and location keys, the crosstabs of all key pairs are sums of it
+    :return: pandas dataframe with the keys and a count column
+    """
+    keys = [key for key in keys if key in df.columns]
+    return df.groupby(keys, dropna=False, observed=True).size().reset_index(name="count")
+
+
+def update_cell_counts(counts, inserted_counts, deleted_counts):
+    """
+    :return: counts plus inserted_counts minus deleted_counts, without the combinations that dropped to zero
+    """
+    keys = [column for column in counts.columns if column != "count"]
+    deleted_counts = deleted_counts.assign(count=-deleted_counts["count"])
+    counts = pd.concat([counts, inserted_counts, deleted_counts], ignore_index=True)
+    counts = counts.groupby(keys, dropna=False, observed=True)["count"].sum().reset_index()
+    return counts[counts["count"] != 0].reset_index(drop=True)
+
+
+def release_changes(previous_table, table, previous_significance_table, significance_table):
+    """
+    Per cell change summary of a contingency table between two releases
+    :param previous_significance_table: DataProcess.get_significance_table of previous_table
+    :param significance_table: DataProcess.get_significance_table of table
+    :return: pandas dataframe with one row per cell of either release, drug modality by drug modality
+    """
+    previous_table = _with_object_labels(previous_table)
+    table = _with_object_labels(table)
+    previous_table, table = previous_table.align(table, fill_value=0)
+    previous_table, table = previous_table.sort_index().sort_index(axis=1), table.sort_index().sort_index(axis=1)
+
+    n_locations = len(table.index)
+    changes = pd.DataFrame({
+        "Drug Modality": table.columns.repeat(n_locations).to_numpy(),
+        "Location": list(table.index) * len(table.columns),
+        "Previous Count": previous_table.to_numpy().T.ravel().astype(int),
+        "Count": table.to_numpy().T.ravel().astype(int),
+    })
+    changes["Count Change"] = changes["Count"] - changes["Previous Count"]
+
+    columns = ["Drug Modality", "Location", "P-value", "Significance"]
+    previous_significance_table = _with_object_columns(previous_significance_table[columns]).rename(
+        columns={"P-value": "Previous P-value", "Significance": "Previous Significance"}
+    )
+    changes = changes.merge(previous_significance_table, on=["Drug Modality", "Location"], how="left")
+    changes = changes.merge(_with_object_columns(significance_table[columns]), on=["Drug Modality", "Location"], how="left")
+    changes["Previous Significance"] = changes["Previous Significance"].astype("boolean").fillna(False).astype(bool)
+    changes["Significance"] = changes["Significance"].astype("boolean").fillna(False).astype(bool)
+    changes["Significance Changed"] = changes["Previous Significance"] != changes["Significance"]
+    return changes
+
+
+def _with_object_labels(table):
+    return table.set_axis(table.index.astype(object), axis=0).set_axis(table.columns.astype(object), axis=1)
+
+
+def _with_object_columns(df):
+    return df.astype({"Drug Modality": object, "Location": object})
@@ -0,0 +1,200 @@
+## Keeps a persistent local copy of the OpenTargets json dumps.
+## Part files of all datasets are fetched concurrently, partial files are resumed
+## and every file is checked against the size in the remote listing.
+
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+from settings import OPENTARGETS_LINK, DATA_VERSION, DATA_TYPE, MIRROR_DIR, DOWNLOAD_WORKERS
+
+
+class DatasetMirror:
+    """
+    Mirrors the part files of the OpenTargets datasets into local_dir/<dataset>.
+    A manifest.json in local_dir records the size and modification time of every fetched file,
+    so later runs only fetch the files that are missing, incomplete or changed on the server.
+    base_url can point to any ftp:// or http(s):// server with the same layout, e.g. a local test server
+    """
+
+    MANIFEST = "manifest.json"
+    PARTIAL_SUFFIX = ".part"
+
+    def __init__(self, local_dir=None, base_url=None, data_version=DATA_VERSION, workers=DOWNLOAD_WORKERS, retries=3):
+        self.base_url = (base_url if base_url is not None else f"{OPENTARGETS_LINK}/{data_version}/output/etl/{DATA_TYPE}").rstrip("/")
+        self.local_dir = local_dir if local_dir is not None else os.path.join(MIRROR_DIR, data_version)
+        self.workers = workers
+        self.retries = retries
+
+        self._manifest_lock = threading.Lock()
+        self.manifest = self._load_manifest()
+
+    def sync(self, datasets):
+        """
+        Brings the local copies of the datasets up to date with the server
+        :param datasets: dataset names, e.g. settings.DATASETS
+        :return: {dataset: local directory}
+        """
+        tasks = []
+        for dataset in datasets:
+            os.makedirs(os.path.join(self.local_dir, dataset), exist_ok=True)
+            for entry in self.list_remote(dataset):
+                if self.is_up_to_date(dataset, entry):
+                    continue
+                tasks.append((dataset, entry))
+
+        print(f"{len(tasks)} files to fetch into {self.local_dir}")
+        failures = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._fetch_with_retries, dataset, entry): (dataset, entry) for dataset, entry in tasks}
+            for future in as_completed(futures):
+                dataset, entry = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    failures.append((f"{dataset}/{entry['name']}", e))
+
+        if failures:
+            raise Exception("Download failed", failures)
+
+        return {dataset: os.path.join(self.local_dir, dataset) for dataset in datasets}
+
+    def list_remote(self, dataset):
+        """
+        Lists the json part files of a dataset on the server
+        :return: list of {"name", "size", "modified"}
+        """
+        url = f"{self.base_url}/{dataset}"
+        if urlparse(url).scheme == "ftp":
+            entries = self._list_ftp(url)
+        else:
+            entries = self._list_http(url)
+        return [entry for entry in entries if entry["name"].endswith(".json")]
+
+    def is_up_to_date(self, dataset, entry):
+        local_file = os.path.join(self.local_dir, dataset, entry["name"])
+        recorded = self.manifest.get(f"{dataset}/{entry['name']}")
+        return (
+            os.path.exists(local_file)
+            and os.path.getsize(local_file) == entry["size"]
+            and recorded is not None
+            and recorded == {"size": entry["size"], "modified": entry["modified"]}
+        )
+
+    def _fetch_with_retries(self, dataset, entry):
+        for attempt in range(1, self.retries + 1):
+            try:
+                return self._fetch(dataset, entry)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise e
+                print(f"Retrying {dataset}/{entry['name']} ({attempt}/{self.retries}): {e}")
+                time.sleep(2 ** attempt)
+
+    def _fetch(self, dataset, entry):
+        local_file = os.path.join(self.local_dir, dataset, entry["name"])
+        partial_file = local_file + self.PARTIAL_SUFFIX
+        url = f"{self.base_url}/{dataset}/{entry['name']}"
+        key = f"{dataset}/{entry['name']}"
+        version = {"size": entry["size"], "modified": entry["modified"]}
+
+        ## the manifest records the remote version a partial file belongs to, a partial of another version
+        ## is not resumed, which would splice two versions into one file
+        offset = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+        if offset and (offset > entry["size"] or self.manifest.get(key + self.PARTIAL_SUFFIX) != version):
+            os.remove(partial_file)
+            offset = 0
+        with self._manifest_lock:
+            self.manifest[key + self.PARTIAL_SUFFIX] = version
+            self._save_manifest()
+
+        ## a complete partial file of an interrupted run only has to be renamed
+        if offset < entry["size"] or not os.path.exists(partial_file):
+            if urlparse(url).scheme == "ftp":
+                self._fetch_ftp(url, partial_file, offset)
+            else:
+                self._fetch_http(url, partial_file, offset)
+
+        fetched_size = os.path.getsize(partial_file)
+        if fetched_size != entry["size"]:
+            raise Exception(f"Size mismatch for {url}: expected {entry['size']}, got {fetched_size}")
+
+        os.replace(partial_file, local_file)
+        with self._manifest_lock:
+            self.manifest[key] = version
+            self.manifest.pop(key + self.PARTIAL_SUFFIX, None)
+            self._save_manifest()
+        print(f"Fetched {dataset}/{entry['name']}")
+
+    @staticmethod
+    def _list_ftp(url):
+        from ftplib import FTP, error_perm
+        parsed = urlparse(url)
+        with FTP() as ftp:
+            ftp.connect(parsed.hostname, parsed.port or 21)
+            ftp.login(parsed.username or "anonymous", parsed.password or "")
+            ftp.cwd(parsed.path)
+            try:
+                return [
+                    {"name": name, "size": int(facts["size"]), "modified": facts.get("modify")}
+                    for name, facts in ftp.mlsd(facts=["type", "size", "modify"]) if facts.get("type") == "file"
+                ]
+            except error_perm:
+                ## server without MLSD support
+                ftp.voidcmd("TYPE I")
+                return [{"name": name, "size": ftp.size(name), "modified": None} for name in ftp.nlst()]
+
+    def _list_http(self, url):
+        from urllib.request import urlopen, Request
+        with urlopen(url + "/") as response:
+            index = response.read().decode()
+
+        def head(name):
+            with urlopen(Request(f"{url}/{name}", method="HEAD")) as response:
+                return {
+                    "name": name,
+                    "size": int(response.headers["Content-Length"]),
+                    "modified": response.headers.get("Last-Modified"),
+                }
+
+        ## one HEAD request per part file, sent in parallel
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(head, sorted(set(re.findall(r'href="([^"/?]+)"', index)))))
+
+    @staticmethod
+    def _fetch_ftp(url, partial_file, offset):
+        from ftplib import FTP
+        parsed = urlparse(url)
+        with FTP() as ftp, open(partial_file, "ab" if offset else "wb") as fh:
+            ftp.connect(parsed.hostname, parsed.port or 21)
+            ftp.login(parsed.username or "anonymous", parsed.password or "")
+            ftp.retrbinary(f"RETR {parsed.path}", fh.write, rest=offset or None)
+
+    @staticmethod
+    def _fetch_http(url, partial_file, offset):
+        from urllib.request import urlopen, Request
+        import shutil
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with urlopen(Request(url, headers=headers)) as response:
+            ## servers without range support answer 200 with the whole file
+            resumed = offset and response.status == 206
+            with open(partial_file, "ab" if resumed else "wb") as fh:
+                shutil.copyfileobj(response, fh)
+
+    def _load_manifest(self):
+        manifest_file = os.path.join(self.local_dir, self.MANIFEST)
+        if not os.path.exists(manifest_file):
+            return {}
+        with open(manifest_file, "r") as fh:
+            return json.load(fh)
+
+    def _save_manifest(self):
+        os.makedirs(self.local_dir, exist_ok=True)
+        manifest_file = os.path.join(self.local_dir, self.MANIFEST)
+        with open(manifest_file + ".tmp", "w") as fh:
+            json.dump(self.manifest, fh, indent=1, sort_keys=True)
+        os.replace(manifest_file + ".tmp", manifest_file)
@@ -0,0 +1,112 @@
+## Headless rendering of the analysis figures.
+## Every figure is an explicit matplotlib Figure drawn by the Agg canvas, never registered in pyplot,
+## so nothing is shown, nothing blocks and the figure is freed once it is saved.
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+FORMATS = ["pdf", "png", "svg"]
+PNG_DPI = 150
+
+
+def output_files(out_dir, name, formats):
+    """
+    :return: one path per format, out_dir/name.<format>
+    """
+    for output_format in formats:
+        if output_format not in FORMATS:
+            raise Exception(f"Unknown figure format {output_format}, select from {', '.join(FORMATS)}")
+    return [os.path.join(out_dir, f"{name}.{output_format}") for output_format in formats]
+
+
+def _new_figure(figsize=None):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure(figsize=figsize)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def _save_figure(figure, files):
+    for output_file in files:
+        output_format = os.path.splitext(output_file)[1][1:]
+        figure.savefig(output_file, format=output_format, bbox_inches="tight", dpi=PNG_DPI if output_format == "png" else None)
+    figure.clear()
+
+
+def plot_heatmap(contingency_table, drug_modality_key, files, log_transform=True):
+    import seaborn as sns
+
+    title = f"{drug_modality_key} distribution on subcellular locations"
+    if log_transform:
+        contingency_table = np.log2(contingency_table + 1)
+        title = f"{title} (Log Scale)"
+
+    figure = _new_figure()
+    ax = figure.add_subplot()
+    sns.heatmap(contingency_table, annot=False, cmap="viridis", ax=ax)
+    ax.set_title(title)
+    ax.set_xlabel(drug_modality_key)
+    ax.set_ylabel("subcellular locations")
+    ax.tick_params(axis="x", labelrotation=45)
+    for label in ax.get_xticklabels():
+        label.set_horizontalalignment("right")
+    _save_figure(figure, files)
+    return files
+
+
+def plot_stacked_bar(percentages, drug_modality_key, files, width=0.5, intervals=None):
+    """
+    Stacked bars of the percentages, one bar per location and one stack segment per drug modality.
+    The segments of a drug modality are drawn as one collection instead of one patch per bar,
+    which keeps the drawing time flat on large crosstabs
+    :param intervals: optional (lower, upper) confidence bounds aligned with percentages, drawn as error bars
+        at the top of every segment, see lib.resampling.bootstrap_percentages
+    """
+    from matplotlib.collections import PolyCollection
+
+    figure = _new_figure(figsize=(10, 6))
+    ax = figure.add_subplot()
+    x = np.arange(len(percentages.index))
+    bottom = np.zeros(len(x))
+    for i, column in enumerate(percentages.columns):
+        height = np.nan_to_num(percentages[column].to_numpy(dtype=float))
+        corners = [(x - width / 2, bottom), (x + width / 2, bottom), (x + width / 2, bottom + height), (x - width / 2, bottom + height)]
+        vertices = np.stack([np.stack(corner, axis=1) for corner in corners], axis=1)
+        ax.add_collection(PolyCollection(vertices, facecolors=f"C{i % 10}", edgecolors="none", label=str(column)))
+        if intervals is not None:
+            ## error bars side by side within the bar, so the ones of neighbouring segments do not overlap
+            lower, upper = (bound[column].to_numpy(dtype=float) for bound in intervals)
+            lower, upper = np.where(np.isnan(lower), height, lower), np.where(np.isnan(upper), height, upper)
+            offset = ((i + 0.5) / len(percentages.columns) - 0.5) * width
+            yerr = np.stack([np.maximum(height - lower, 0), np.maximum(upper - height, 0)])
+            ax.errorbar(x + offset, bottom + height, yerr=yerr, fmt="none", ecolor="black", elinewidth=0.6, capsize=1.5)
+        bottom = bottom + height
+    ax.set_xlim(-0.5, len(x) - 0.5)
+    ax.set_ylim(0, max(bottom.max(), 1) * 1.05)
+
+    ax.set_xticks(x, [str(label) for label in percentages.index], rotation=45, ha="right")
+    ax.set_xlabel("Subcellular Location")
+    ax.set_ylabel("Percentages")
+    ax.set_title(f"Distribution of {drug_modality_key} Across Subcellular Locations")
+    ax.legend(loc="upper left", bbox_to_anchor=(1, 1))
+    figure.tight_layout()
+    _save_figure(figure, files)
+    return files
+
+
+def render_figures(jobs, workers=None):
+    """
+    Renders the figures of jobs, in a process pool when there are several of them
+    :param jobs: list of (plot function, args) tuples, e.g. (plot_heatmap, (contingency_table, "drugType", files))
+    :param workers: number of processes, 1 renders in the calling process
+    :return: list of the written files of every job
+    """
+    if len(jobs) <= 1 or workers == 1:
+        return [plot(*args) for plot, args in jobs]
+
+    with ProcessPoolExecutor(max_workers=min(len(jobs), workers or os.cpu_count())) as executor:
+        futures = [executor.submit(plot, *args) for plot, args in jobs]
+        return [future.result() for future in futures]
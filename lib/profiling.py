@@ -0,0 +1,97 @@
+## Stage level instrumentation of a pipeline run.
+## Off by default; when enabled every stage records wall time, CPU time (including finished child processes),
+## resident memory and row counts, and the run is written as one json document.
+
+import json
+import os
+import platform
+import resource
+import time
+from contextlib import contextmanager
+
+
+class RunProfile:
+    """
+    Collects one record per pipeline stage:
+
+        with profile.stage("combine", rows_in=n) as record:
+            ...
+            record["rows_out"] = len(df)
+
+    A disabled profile runs the stages without measuring them.
+    Intermediate tables inside a stage can be recorded as checkpoints, see checkpoint
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = []
+        self.checkpoints = []
+        self.started = time.time()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        record = {"stage": name, "rows_in": rows_in, "rows_out": None}
+        if not self.enabled:
+            yield record
+            return
+
+        wall_start = time.perf_counter()
+        cpu_start = self._cpu_seconds()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = round(time.perf_counter() - wall_start, 4)
+            record["cpu_seconds"] = round(self._cpu_seconds() - cpu_start, 4)
+            record["rss_mb"] = self._rss_mb()
+            record["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+            self.stages.append(record)
+
+    def checkpoint(self, name, df, start):
+        """
+        Records the rows and memory of an intermediate table and the seconds since start, does nothing if the profile is disabled.
+        The memory of the object columns is measured by a scan over their values
+        """
+        if not self.enabled:
+            return
+        self.checkpoints.append({
+            "checkpoint": name,
+            "rows": len(df),
+            "memory_mb": round(df.memory_usage(deep=True).sum() / 2 ** 20, 1),
+            "seconds": round(time.perf_counter() - start, 4),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        })
+
+    def to_dict(self, **metadata):
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "wall_seconds": round(time.time() - self.started, 4),
+            "python": platform.python_version(),
+            **metadata,
+            "stages": self.stages,
+            "checkpoints": self.checkpoints,
+        }
+
+    def write(self, output_file, **metadata):
+        """
+        Writes the run profile as json, does nothing if the profile is disabled
+        :param metadata: extra top level fields, e.g. the release and the analysed keys
+        """
+        if not self.enabled:
+            return None
+        with open(output_file, "w") as fh:
+            json.dump(self.to_dict(**metadata), fh, indent=2, default=str)
+        print(f"Run profile written to {output_file}")
+        return output_file
+
+    @staticmethod
+    def _cpu_seconds():
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.process_time() + children.ru_utime + children.ru_stime
+
+    @staticmethod
+    def _rss_mb():
+        try:
+            with open("/proc/self/statm", "r") as fh:
+                return round(int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1)
+        except (OSError, ValueError):
+            return None
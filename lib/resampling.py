@@ -0,0 +1,205 @@
+## Resampling based statistics over contingency tables.
+## The rows of the combined table are grouped into blocks, e.g. all rows of one drug, which are resampled
+## as a whole, so the fan-out of one drug over many targets and locations is kept together.
+## permutation_test permutes the modality labels of the blocks, bootstrap_percentages resamples the units (drugs or targets).
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+class ContingencyBlocks:
+    """
+    Location counts of every block of rows with its modality label.
+    The contingency table is the sum of the block counts per modality:
+        table[location, modality] = counts[labels == modality, location].sum()
+    """
+
+    def __init__(self, labels, counts, modalities, locations, units=None):
+        self.labels = labels
+        self.counts = counts
+        self.modalities = modalities
+        self.locations = locations
+        ## unit code of every block, blocks of one unit are resampled together
+        self.units = units
+
+    @classmethod
+    def from_frame(cls, df, unit_key, drug_modality_key, location_key):
+        """
+        One block per (unit, drug modality) pair, so a drug with several modality values
+        (e.g. actionType per mechanism of action) contributes one block per value
+        """
+        df = df[[unit_key, drug_modality_key, location_key]].dropna()
+        unit_codes, _ = pd.factorize(df[unit_key])
+        modality_codes, modalities = pd.factorize(df[drug_modality_key], sort=True)
+        location_codes, locations = pd.factorize(df[location_key], sort=True)
+
+        block_codes, block_index = pd.factorize(pd.MultiIndex.from_arrays([unit_codes, modality_codes]))
+        counts = np.zeros((len(block_index), len(locations)), dtype=np.float64)
+        np.add.at(counts, (block_codes, location_codes), 1)
+        labels = block_index.get_level_values(1).to_numpy()
+        return cls(labels, counts, np.asarray(modalities), np.asarray(locations), block_index.get_level_values(0).to_numpy())
+
+    @property
+    def n_modalities(self):
+        return len(self.modalities)
+
+    def contingency_table(self, labels=None, values=None):
+        """
+        :param labels: block labels, by default the observed ones. A 2D array gives one table per row
+        :param values: blocks x locations values summed instead of the counts
+        :return: locations x modalities counts, or n x locations x modalities for 2D labels
+        """
+        labels = self.labels if labels is None else labels
+        values = self.counts if values is None else values
+        if labels.ndim == 1:
+            return self.contingency_table(labels[None, :], values)[0]
+        one_hot = np.zeros((labels.shape[0], self.n_modalities, labels.shape[1]), dtype=np.float64)
+        one_hot[np.arange(labels.shape[0])[:, None], labels, np.arange(labels.shape[1])[None, :]] = 1
+        return np.swapaxes(one_hot @ values, 1, 2)
+
+    def residuals(self):
+        """
+        :return: blocks x locations counts minus their expectation under independence, the block size times the location share.
+            Summed over the blocks of a modality they give count - row total x column total / total of that cell
+        """
+        totals = self.counts.sum(axis=0)
+        return self.counts - self.counts.sum(axis=1, keepdims=True) * totals / totals.sum()
+
+    def to_frame(self, values):
+        return pd.DataFrame(values, index=pd.Index(self.locations), columns=pd.Index(self.modalities))
+
+
+def _statistics(blocks, residuals, labels=None):
+    """
+    Studentized deviation of every cell from independence. The deviation is |count - row total x column total / total|,
+    the sum of the block residuals of the modality. It is divided by its Welch type standard error from the spread of
+    the block residuals inside and outside the modality, which keeps the statistic comparable between labelings that put
+    large or small blocks (drugs with a large or small fan-out) into a modality
+    :return: locations x modalities statistics, or n x locations x modalities for 2D labels
+    """
+    deviations = np.abs(blocks.contingency_table(labels, residuals))
+    ## share of the rows in the modality, and the squared residuals inside and outside of it
+    share = blocks.contingency_table(labels).sum(axis=-2, keepdims=True) / blocks.counts.sum()
+    inside = blocks.contingency_table(labels, residuals ** 2)
+    outside = (residuals ** 2).sum(axis=0)[:, None] - inside
+    spread = np.sqrt((1 - share) ** 2 * inside + share ** 2 * outside)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ## cells without any residual, e.g. of a location without rows, never deviate
+        return np.where(spread > 0, deviations / spread, 0.0)
+
+
+def _permutation_exceedances(blocks, residuals, observed_statistics, seed, n_permutations):
+    """
+    Counts per cell how often a permuted table deviates from independence at least as much as the observed one
+    """
+    rng = np.random.default_rng(seed)
+    labels = rng.permuted(np.tile(blocks.labels, (n_permutations, 1)), axis=1)
+    ## tolerance for the float sums of equal tables
+    return (_statistics(blocks, residuals, labels) >= observed_statistics - 1e-9).sum(axis=0)
+
+
+def permutation_test(blocks, n_permutations=1000, seed=0, workers=None, batch_size=100, batches_per_round=8,
+                     significance=0.05, confidence_z=3.0):
+    """
+    Empirical two-sided p-values of every cell of the contingency table of blocks, under random
+    permutations of the block modality labels. The statistic is |count - expected count| with the expected count from
+    the margins of the same table (row total x column total / total), studentized by the spread of the blocks of the
+    modality, see _statistics. The modality totals change with the permutation when blocks differ in size, and the
+    studentization keeps the p-values calibrated when the block sizes depend on the modality.
+    Permutations run in rounds of batches_per_round batches over worker processes; after every round the cells whose p-value
+    is clearly above or below significance (confidence_z standard errors away) keep their current
+    estimate, and the test stops once every cell is decided or n_permutations is reached.
+    Batches are seeded from seed in a fixed order, so results do not depend on the number of workers.
+    :return: p-values and the number of permutations used per cell, as locations x modalities frames
+    """
+    residuals = blocks.residuals()
+    observed_statistics = _statistics(blocks, residuals)
+
+    exceedances = np.zeros(observed_statistics.shape, dtype=np.int64)
+    n_used = np.zeros(observed_statistics.shape, dtype=np.int64)
+    decided = np.zeros(observed_statistics.shape, dtype=bool)
+    workers = workers or 1
+    seeds = np.random.SeedSequence(seed)
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        done = 0
+        while done < n_permutations and not decided.all():
+            sizes = [min(batch_size, n_permutations - done - i * batch_size) for i in range(batches_per_round)]
+            sizes = [size for size in sizes if size > 0]
+            batch_seeds = seeds.spawn(len(sizes))
+            arguments = [(blocks, residuals, observed_statistics, batch_seed, size) for batch_seed, size in zip(batch_seeds, sizes)]
+            if executor is None:
+                results = [_permutation_exceedances(*argument) for argument in arguments]
+            else:
+                results = list(executor.map(_permutation_exceedances, *zip(*arguments)))
+
+            exceedances[~decided] += sum(results)[~decided]
+            n_used[~decided] += sum(sizes)
+            done += sum(sizes)
+
+            p_values = (exceedances + 1) / (n_used + 1)
+            standard_error = np.sqrt(p_values * (1 - p_values) / (n_used + 1))
+            decided |= np.abs(p_values - significance) > confidence_z * standard_error
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    p_values = (exceedances + 1) / (n_used + 1)
+    return blocks.to_frame(p_values), blocks.to_frame(n_used)
+
+
+def _bootstrap_batch(blocks, unit_counts, seed, n_replicates, location_or_modality):
+    """
+    Percentages of n_replicates bootstrap tables. The units are resampled with replacement as multinomial weights,
+    drawn in one call, and every table is the weighted sum of the block counts
+    :param unit_counts: sparse blocks x (locations * modalities) matrix of the block counts in the cells of their modality
+    :return: n_replicates x locations x modalities percentages
+    """
+    rng = np.random.default_rng(seed)
+    n_units = blocks.units.max() + 1
+    weights = rng.multinomial(n_units, np.full(n_units, 1 / n_units), size=n_replicates)[:, blocks.units]
+    tables = np.asarray((unit_counts.T @ weights.T).T).reshape(n_replicates, len(blocks.locations), blocks.n_modalities)
+    totals = tables.sum(axis=2 if location_or_modality == "loc" else 1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return tables * 100 / totals
+
+
+def bootstrap_percentages(blocks, n_replicates=1000, seed=0, workers=None, batch_size=250, confidence=0.95,
+                          location_or_modality="loc"):
+    """
+    Percentile bootstrap confidence intervals of the percentages of every cell, see lib.data_process.get_percentages.
+    The units of blocks (e.g. drugs or targets) are resampled with replacement and the whole percentage matrix is
+    recomputed for every replicate. Batches run over worker processes and are seeded from seed in a fixed order,
+    so results do not depend on the number of workers
+    :param location_or_modality: "loc" for the drug modality percentages of every location, anything else for the location percentages of every drug modality
+    :return: lower and upper bounds as locations x modalities frames. A bound is nan if the location (modality) was never drawn
+    """
+    from scipy.sparse import csr_matrix
+
+    ## the counts of every block in the columns of its modality, cells flattened as location * n_modalities + modality
+    rows, locations = np.nonzero(blocks.counts)
+    unit_counts = csr_matrix(
+        (blocks.counts[rows, locations], (rows, locations * blocks.n_modalities + blocks.labels[rows])),
+        shape=(len(blocks.labels), len(blocks.locations) * blocks.n_modalities),
+    )
+
+    sizes = [min(batch_size, n_replicates - start) for start in range(0, n_replicates, batch_size)]
+    batch_seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    arguments = [(blocks, unit_counts, batch_seed, size, location_or_modality) for batch_seed, size in zip(batch_seeds, sizes)]
+    if (workers or 1) > 1 and len(sizes) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            percentages = list(executor.map(_bootstrap_batch, *zip(*arguments)))
+    else:
+        percentages = [_bootstrap_batch(*argument) for argument in arguments]
+    percentages = np.concatenate(percentages)
+
+    alpha = 1 - confidence
+    with warnings.catch_warnings():
+        ## cells of locations that were never drawn are all nan
+        warnings.simplefilter("ignore", RuntimeWarning)
+        lower, upper = np.nanpercentile(percentages, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return blocks.to_frame(lower), blocks.to_frame(upper)
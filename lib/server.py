@@ -0,0 +1,265 @@
+## Local JSON query service over the crosstabs and significance tables of one combined table.
+## The combined table is loaded once, the crosstabs of all drug modality and location keys are computed up front,
+## and every response is serialized once and then served from memory. Only the python standard library http.server is used.
+##
+##   GET /keys
+##   GET /counts?drug_modality=drugType&location_key=subcellular_location_label
+##   GET /percentages?drug_modality=drugType&location_key=subcellular_location_label&by=loc
+##   GET /significance?drug_modality=drugType&location_key=subcellular_location_label&correction=bh&mid_p=1&only_significant=1
+##
+## The source of the table (the combined file, or the last preprocessing run in the cache) is checked every
+## check_interval seconds, and the table is reloaded in a background thread when it changed, e.g. for a new release.
+## The old table keeps answering until the new one is loaded, and also if loading it fails.
+## The query parameters are validated and normalized before the responses are memoized, and at most MAX_RESPONSES
+## responses are kept, the least recently used are dropped.
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from settings import DATA_VERSION
+
+PATHS = ["/keys", "/counts", "/percentages", "/significance"]
+MAX_RESPONSES = 1024
+
+
+class QueryService:
+    """
+    Answers the queries of the server, see the module description.
+    load() returns a lib.analysis.CombinedAnalysis and version() anything that changes when the source changes
+    """
+
+    def __init__(self, load, version, check_interval=5.0):
+        self._load = load
+        self._version = version
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._reloading = None
+        self._responses = OrderedDict()
+        ## incremented with every reload, a response is only memoized for the generation of the table it was computed from
+        self._generation = 0
+        self.analysis = None
+        self.keys = []
+        self.source_version = None
+        self._checked = 0.0
+        self.reload()
+
+    @classmethod
+    def from_combined_file(cls, combined_file, check_interval=5.0):
+        from lib.analysis import CombinedAnalysis
+
+        def version():
+            stat = os.stat(combined_file)
+            return stat.st_mtime_ns, stat.st_size
+
+        return cls(lambda: CombinedAnalysis.from_combined_file(combined_file), version, check_interval)
+
+    @classmethod
+    def from_cache(cls, cache_dir=None, release=DATA_VERSION, check_interval=5.0):
+        """
+        Serves the combined table of the last complete preprocessing run of the release, see PreprocessCache.latest
+        """
+        from lib.analysis import CombinedAnalysis
+        from lib.cache import PreprocessCache
+        cache = PreprocessCache(cache_dir=cache_dir, release=release)
+
+        def load():
+            keys = cache.latest()
+            combined_data = cache.load("combined", keys["combined"]) if keys is not None else None
+            if combined_data is None:
+                raise Exception(f"No cached combined table of release {release} in {cache.cache_dir}, run the preprocessing first")
+            return CombinedAnalysis(combined_data, release=release)
+
+        return cls(load, lambda: (release, cache.latest()), check_interval)
+
+    def reload(self):
+        """
+        Loads the table and precomputes the crosstabs and significance tables of all keys
+        """
+        from lib.data_process import DRUG_MODALITY_KEYS, LOCATION_KEYS
+        start = time.perf_counter()
+        source_version = self._version()
+        analysis = self._load()
+        columns = analysis.combined_data.columns
+        keys = [(modality, location) for modality in DRUG_MODALITY_KEYS for location in LOCATION_KEYS if modality in columns and location in columns]
+        analysis.crosstabs(keys)
+        for modality, location in keys:
+            analysis.significance(modality, location)
+
+        with self._lock:
+            self.analysis = analysis
+            self.keys = keys
+            self.source_version = source_version
+            self._generation += 1
+            self._responses = OrderedDict()
+            self._checked = time.monotonic()
+        print(f"Loaded release {analysis.release} with {len(analysis.combined_data)} rows and {len(keys)} crosstabs in {time.perf_counter() - start:.2f}s")
+
+    def check_source(self):
+        """
+        Starts a reload in a background thread if the source changed, checked at most once per check_interval seconds.
+        The current table answers the queries in the meantime
+        """
+        if time.monotonic() - self._checked < self.check_interval:
+            return
+        self._checked = time.monotonic()
+        with self._reload_lock:
+            if self._reloading is not None and self._reloading.is_alive():
+                return
+            try:
+                changed = self._version() != self.source_version
+            except OSError as error:
+                print(f"Cannot check the source of the combined table, keeping the loaded one: {error}")
+                return
+            if changed:
+                print("The combined table changed, reloading")
+                self._reloading = threading.Thread(target=self._reload_or_keep, daemon=True)
+                self._reloading.start()
+
+    def _reload_or_keep(self):
+        try:
+            self.reload()
+        except Exception as error:
+            ## e.g. a half written combined file, tried again with the next check
+            print(f"Reloading the combined table failed, keeping release {self.analysis.release}: {error!r}")
+
+    def query(self, path, params):
+        """
+        :param params: {name: value} of the query string
+        :return: serialized json response
+        """
+        self.check_source()
+        ## a reload can swap the table at any time, the query is answered from the table of one generation
+        with self._lock:
+            analysis, keys, generation = self.analysis, self.keys, self._generation
+        request = self._normalize(path, params, keys)
+        with self._lock:
+            response = self._responses.get(request) if generation == self._generation else None
+            if response is not None:
+                self._responses.move_to_end(request)
+                return response
+        response = json.dumps(self._answer(request, analysis, keys)).encode()
+        with self._lock:
+            if generation == self._generation:
+                self._responses[request] = response
+                while len(self._responses) > MAX_RESPONSES:
+                    self._responses.popitem(last=False)
+        return response
+
+    @staticmethod
+    def _normalize(path, params, keys):
+        """
+        Validates the parameters of path and fills in their defaults, unknown parameters are ignored
+        :param keys: (drug modality, location key) pairs of the loaded table
+        :return: tuple of the path and its parameters, the key of the memoized response
+        """
+        if path not in PATHS:
+            raise LookupError(f"Unknown path {path}, select from {', '.join(PATHS)}")
+        if path == "/keys":
+            return (path,)
+
+        modality = params.get("drug_modality", "drugType")
+        location = params.get("location_key", "subcellular_location_label")
+        if (modality, location) not in keys:
+            raise ValueError(f"Unknown drug_modality {modality} or location_key {location}")
+        if path == "/counts":
+            return path, modality, location
+        if path == "/percentages":
+            ## anything but loc gives the location percentages of every drug modality, see get_percentages
+            return path, modality, location, "loc" if params.get("by", "loc") == "loc" else "mod"
+
+        correction = params.get("correction", "none")
+        from lib.stats import CORRECTIONS
+        if correction not in CORRECTIONS:
+            raise ValueError(f"Unknown correction {correction}, select from {', '.join(CORRECTIONS)}")
+        try:
+            significance = float(params.get("significance", 0.05))
+        except ValueError:
+            raise ValueError(f"significance should be a number, got {params['significance']}")
+        if not 0 < significance < 1:
+            raise ValueError(f"significance should be between 0 and 1, got {significance}")
+        return path, modality, location, correction, _flag(params.get("mid_p")), significance, _flag(params.get("only_significant"))
+
+    @staticmethod
+    def _answer(request, analysis, keys):
+        path = request[0]
+        if path == "/keys":
+            return {
+                "release": analysis.release,
+                "drug_modality_keys": sorted({modality for modality, _ in keys}),
+                "location_keys": sorted({location for _, location in keys}),
+            }
+
+        modality, location = request[1:3]
+        answer = {"release": analysis.release, "drug_modality": modality, "location_key": location}
+
+        if path in ("/counts", "/percentages"):
+            if path == "/counts":
+                table = analysis.crosstab(modality, location)
+            else:
+                table = analysis.percentages(modality, location, request[3])
+            answer.update({
+                "locations": [str(label) for label in table.index],
+                "drug_modalities": [str(label) for label in table.columns],
+                path[1:]: table.to_numpy().tolist(),
+            })
+            return answer
+
+        correction, mid_p, significance, only_significant = request[3:]
+        table = analysis.significance(
+            modality, location, correction=correction, mid_p=mid_p, significance=significance, only_significant=only_significant,
+        )
+        ## to_json writes NaN as null
+        answer["rows"] = json.loads(table.to_json(orient="records", double_precision=15))
+        return answer
+
+
+def _flag(value):
+    return value is not None and value.lower() in ("1", "true", "yes")
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            self._send(200, self.server.service.query(url.path, params))
+        except LookupError as error:
+            self._send(404, json.dumps({"error": str(error)}).encode())
+        except ValueError as error:
+            self._send(400, json.dumps({"error": str(error)}).encode())
+        except Exception as error:
+            self._send(500, json.dumps({"error": repr(error)}).encode())
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_request(self, code="-", size="-"):
+        ## one line per request is too much for a query service, errors are still logged
+        pass
+
+
+def serve(service, host="127.0.0.1", port=8000):
+    """
+    Serves the queries of service until interrupted
+    """
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.service = service
+    print(f"Serving on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return server
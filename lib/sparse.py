@@ -0,0 +1,179 @@
+## Sparse crosstabs for high-cardinality keys.
+## Only the non-zero cells are counted and stored (scipy.sparse matrix plus the row and column labels),
+## the margins are sums over them, and the significance of the zero cells is computed per distinct margin pair,
+## see lib.stats.sparse_crosstab_significance. Memory and time scale with the non-zero cells.
+
+import numpy as np
+import pandas as pd
+
+## separator of the labels of combined keys such as "drugType+biotype"
+KEY_SEPARATOR = "+"
+LABEL_SEPARATOR = " | "
+
+
+def add_combined_keys(df, keys):
+    """
+    Adds a column for every combined key of keys, e.g. "drugType+biotype" with labels "Antibody | protein_coding".
+    Rows with a missing value in one of the parts get a missing label
+    """
+    for key in keys:
+        if KEY_SEPARATOR not in key or key in df.columns:
+            continue
+        parts = key.split(KEY_SEPARATOR)
+        labels = df[parts[0]].astype(object).astype(str)
+        for part in parts[1:]:
+            labels = labels + LABEL_SEPARATOR + df[part].astype(object).astype(str)
+        labels[df[parts].isna().any(axis=1).to_numpy()] = np.nan
+        df[key] = labels.astype("category")
+    return df
+
+
+def add_combined_count_keys(counts, keys):
+    """
+    add_combined_keys for a series of row counts indexed by the key columns, e.g. the grouped counts of the combined table
+    :return: the counts indexed by keys
+    """
+    if not any(KEY_SEPARATOR in key for key in keys):
+        return counts
+    counts = add_combined_keys(counts.rename("count").reset_index(), keys)
+    return counts.set_index(list(dict.fromkeys(keys)))["count"]
+
+
+def key_columns(keys):
+    """
+    :return: the columns of the combined table that keys are built from
+    """
+    return sorted({column for key in keys for column in key.split(KEY_SEPARATOR)})
+
+
+class SparseContingency:
+    """
+    locations x drug modalities crosstab stored as a sparse count matrix with label arrays.
+    to_dense() equals pd.crosstab(df[location_key], df[drug_modality_key])
+    """
+
+    def __init__(self, matrix, locations, modalities, location_key=None, drug_modality_key=None):
+        from scipy.sparse import csr_matrix
+        self.matrix = csr_matrix(matrix, dtype=np.int64)
+        self.locations = np.asarray(locations, dtype=object)
+        self.modalities = np.asarray(modalities, dtype=object)
+        self.location_key = location_key
+        self.drug_modality_key = drug_modality_key
+
+    @classmethod
+    def from_frame(cls, df, location_key, drug_modality_key):
+        """
+        Counts the non-zero cells with one groupby, rows with a missing key are left out like in pd.crosstab
+        """
+        counts = df.groupby([location_key, drug_modality_key], observed=True).size()
+        return cls.from_counts(counts[counts > 0], location_key, drug_modality_key)
+
+    @classmethod
+    def from_counts(cls, counts, location_key=None, drug_modality_key=None):
+        """
+        :param counts: pandas series of counts indexed by (location, drug modality)
+        """
+        from scipy.sparse import coo_matrix
+        index = counts.index.remove_unused_levels()
+        locations, modalities = index.levels
+        matrix = coo_matrix(
+            (counts.to_numpy(dtype=np.int64), (index.codes[0], index.codes[1])), shape=(len(locations), len(modalities))
+        )
+        return cls(matrix, locations, modalities, location_key, drug_modality_key)
+
+    @classmethod
+    def from_dense(cls, contingency_table):
+        return cls(
+            contingency_table.to_numpy(), contingency_table.index, contingency_table.columns,
+            contingency_table.index.name, contingency_table.columns.name,
+        )
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def size(self):
+        return self.matrix.shape[0] * self.matrix.shape[1]
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    def row_totals(self):
+        return np.asarray(self.matrix.sum(axis=1)).ravel()
+
+    def column_totals(self):
+        return np.asarray(self.matrix.sum(axis=0)).ravel()
+
+    def cells(self):
+        """
+        :return: rows, columns and counts of the non-zero cells, drug modality by drug modality
+        """
+        coo = self.matrix.tocoo()
+        order = np.lexsort((coo.row, coo.col))
+        return coo.row[order], coo.col[order], coo.data[order]
+
+    def to_dense(self):
+        return pd.DataFrame(
+            self.matrix.toarray(),
+            index=pd.Index(self.locations, name=self.location_key), columns=pd.Index(self.modalities, name=self.drug_modality_key),
+        )
+
+    def percentages(self, location_or_modality="loc"):
+        """
+        Percentages of the non-zero cells, by location ("loc") or by drug modality, see lib.data_process.get_percentages
+        :return: sparse matrix with the shape of the crosstab
+        """
+        from scipy.sparse import diags
+        if location_or_modality == "loc":
+            return diags(100 / self.row_totals()) @ self.matrix
+        return self.matrix @ diags(100 / self.column_totals())
+
+    def significance_table(self, correction="none", significance=0.05, mid_p=False, permutation_p_values=None, include_zero_cells=False):
+        """
+        lib.data_process.significance_table of the crosstab computed on the non-zero cells,
+        the corrections count every cell of the crosstab
+        :param include_zero_cells: also report the zero cells, the table then equals the one of the dense crosstab
+        :return: pandas dataframe with one row per non-zero (or every) cell, drug modality by drug modality
+        """
+        from lib.stats import sparse_crosstab_significance
+        rows, columns, counts = self.cells()
+        row_totals, column_totals = self.row_totals(), self.column_totals()
+        statistics, zero_statistics = sparse_crosstab_significance(
+            rows, columns, counts, row_totals, column_totals, correction=correction, significance=significance, mid_p=mid_p
+        )
+
+        if include_zero_cells:
+            ## every cell takes the statistics of its non-zero entry or of its zero cell margins
+            all_rows = np.tile(np.arange(self.shape[0]), self.shape[1])
+            all_columns = np.repeat(np.arange(self.shape[1]), self.shape[0])
+            nonzero = np.full(self.size, -1, dtype=np.int64)
+            nonzero[columns * self.shape[0] + rows] = np.arange(len(rows))
+            zero_pairs = pd.MultiIndex.from_arrays([zero_statistics["row_total"], zero_statistics["column_total"]])
+            zero = zero_pairs.get_indexer(pd.MultiIndex.from_arrays([row_totals[all_rows], column_totals[all_columns]]))
+            is_nonzero = nonzero >= 0
+            statistics = {
+                name: np.where(is_nonzero, values[np.maximum(nonzero, 0)], zero_statistics[name][np.maximum(zero, 0)])
+                if len(zero_pairs) else values[nonzero]
+                for name, values in statistics.items()
+            }
+            rows, columns = all_rows, all_columns
+
+        significance_table = pd.DataFrame({
+            "Drug Modality": self.modalities[columns],
+            "Location": self.locations[rows],
+            "P-value": statistics["p_value"],
+            "Odds Ratio": statistics["odds_ratio"],
+            "Significance": statistics["significant"],
+            "BH Adjusted P-value": statistics["bh_p_value"],
+            "Bonferroni Adjusted P-value": statistics["bonferroni_p_value"],
+            "Log Odds Ratio CI Lower": statistics["log_odds_ratio_ci_lower"],
+            "Log Odds Ratio CI Upper": statistics["log_odds_ratio_ci_upper"],
+        })
+        if mid_p:
+            significance_table["Mid P-value"] = statistics["mid_p_value"]
+        if permutation_p_values is not None:
+            permutation_p_values = permutation_p_values.reindex(index=self.locations, columns=self.modalities).to_numpy()
+            significance_table["Permutation P-value"] = permutation_p_values[rows, columns]
+        return significance_table
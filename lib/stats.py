@@ -0,0 +1,346 @@
+## Batched statistics over contingency tables.
+## fisher_exact_batch follows scipy.stats.fisher_exact (two-sided) step by step, but evaluates
+## the hypergeometric distribution on whole arrays of 2x2 tables instead of one table per call.
+
+import numpy as np
+
+
+def crosstab_2x2_tables(counts):
+    """
+    Builds the 2x2 table of every cell of a crosstab from its row, column and grand totals.
+    For cell (row, column):
+        a = row and column          b = column but not row
+        c = row but not column      d = neither row nor column
+    :param counts: 2D array of counts, rows x columns
+    :return: a, b, c, d int64 arrays with the shape of counts
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    row_totals = counts.sum(axis=1, keepdims=True)
+    column_totals = counts.sum(axis=0, keepdims=True)
+    total = counts.sum()
+
+    a = counts
+    b = column_totals - a
+    c = row_totals - a
+    d = total - row_totals - column_totals + a
+    return a, b, c, d
+
+
+CORRECTIONS = ["none", "bh", "bonferroni"]
+
+
+def fisher_exact_batch(a, b, c, d, mid_p=False):
+    """
+    Two-sided Fisher's exact test of the tables [[a, b], [c, d]], identical to scipy.stats.fisher_exact.
+    Repeated tables are computed once.
+    :param mid_p: also return the mid-p values, the p-values minus half the probability of the observed table
+    :return: p-values, odds ratios (and mid-p values) as float arrays with the shape of a
+    """
+    tables = np.stack([np.ravel(x) for x in (a, b, c, d)], axis=1).astype(np.int64)
+    unique_tables, inverse = np.unique(tables, axis=0, return_inverse=True)
+    p_values, odds_ratios, p_observed = _fisher_exact_unique(*unique_tables.T)
+    shape = np.shape(a)
+    results = (p_values[inverse.ravel()].reshape(shape), odds_ratios[inverse.ravel()].reshape(shape))
+    if mid_p:
+        results += ((p_values - 0.5 * p_observed)[inverse.ravel()].reshape(shape),)
+    return results
+
+
+def adjust_p_values(p_values, method, weights=None):
+    """
+    Adjusts p-values for multiple testing
+    :param method: "bh" for Benjamini-Hochberg, "bonferroni", or "none"
+    :param weights: optional number of tests that share each p-value, e.g. the zero cells of a sparse crosstab with the same margins
+    :return: adjusted p-values with the shape of p_values
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    if method == "none":
+        return p_values.copy()
+
+    flat = p_values.ravel()
+    weights = np.ones(len(flat), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64).ravel()
+    n_tests = weights.sum()
+    if method == "bonferroni":
+        return np.minimum(flat * n_tests, 1.0).reshape(p_values.shape)
+    if method == "bh":
+        order = np.argsort(flat)
+        ## tests sharing a p-value take the rank of the last of them, as their step-up value is the smallest one
+        ranked = flat[order] * n_tests / np.cumsum(weights[order])
+        ## step-up: each adjusted value is the smallest one at its rank or above
+        ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+        adjusted = np.empty(len(flat), dtype=np.float64)
+        adjusted[order] = np.minimum(ranked, 1.0)
+        return adjusted.reshape(p_values.shape)
+    raise ValueError(f"Unknown correction {method}, select from {CORRECTIONS}")
+
+
+def log_odds_ratio_ci(a, b, c, d, alpha=0.05):
+    """
+    Woolf confidence interval of the log odds ratio of the tables [[a, b], [c, d]].
+    0.5 is added to all cells of tables with a zero cell (Haldane-Anscombe correction)
+    :return: lower and upper bounds as float arrays with the shape of a
+    """
+    from scipy.stats import norm
+
+    a, b, c, d = (np.asarray(x, dtype=np.float64) for x in (a, b, c, d))
+    correction = np.where((a == 0) | (b == 0) | (c == 0) | (d == 0), 0.5, 0.0)
+    a, b, c, d = a + correction, b + correction, c + correction, d + correction
+
+    log_odds_ratio = np.log(a * d / (b * c))
+    standard_error = np.sqrt(1 / a + 1 / b + 1 / c + 1 / d)
+    z = norm.ppf(1 - alpha / 2)
+    return log_odds_ratio - z * standard_error, log_odds_ratio + z * standard_error
+
+
+def crosstab_significance(counts, correction="none", significance=0.05, mid_p=False):
+    """
+    Fisher's exact test, multiple testing corrections and odds ratio confidence intervals
+    for every cell of a crosstab, computed from one set of 2x2 tables
+    :param counts: 2D array of counts, rows x columns
+    :param correction: the adjusted p-values used for the significance flag, see CORRECTIONS
+    :return: {name: array with the shape of counts}
+    """
+    tables = crosstab_2x2_tables(counts)
+    fisher_results = fisher_exact_batch(*tables, mid_p=mid_p)
+    ci_lower, ci_upper = log_odds_ratio_ci(*tables, alpha=significance)
+
+    statistics = {
+        "p_value": fisher_results[0],
+        "odds_ratio": fisher_results[1],
+        "log_odds_ratio_ci_lower": ci_lower,
+        "log_odds_ratio_ci_upper": ci_upper,
+        "bh_p_value": adjust_p_values(fisher_results[0], "bh"),
+        "bonferroni_p_value": adjust_p_values(fisher_results[0], "bonferroni"),
+    }
+    if mid_p:
+        statistics["mid_p_value"] = fisher_results[2]
+    statistics["significant"] = adjust_p_values(fisher_results[0], correction) < significance
+    return statistics
+
+
+def sparse_crosstab_significance(rows, columns, counts, row_totals, column_totals, correction="none", significance=0.05, mid_p=False):
+    """
+    crosstab_significance for the non-zero cells of a sparse crosstab.
+    The 2x2 table of a zero cell only depends on its row and column totals, so the zero cells are never enumerated:
+    they are tested once per distinct (row total, column total) pair and enter the corrections with their number of cells
+    :param rows, columns, counts: coordinates and counts of the non-zero cells
+    :param row_totals, column_totals: totals of all rows and columns
+    :return: {name: array over the non-zero cells}, {name: array over the distinct zero cell margins}.
+        The zero cell statistics also have row_total, column_total and n_cells
+    """
+    rows, columns, counts = (np.asarray(x, dtype=np.int64) for x in (rows, columns, counts))
+    row_totals, column_totals = np.asarray(row_totals, dtype=np.int64), np.asarray(column_totals, dtype=np.int64)
+    total = row_totals.sum()
+
+    ## zero cells per margin pair: all cells with these totals minus the non-zero ones
+    unique_row_totals, n_rows = np.unique(row_totals, return_counts=True)
+    unique_column_totals, n_columns = np.unique(column_totals, return_counts=True)
+    zero_row_totals = np.repeat(unique_row_totals, len(unique_column_totals))
+    zero_column_totals = np.tile(unique_column_totals, len(unique_row_totals))
+    n_cells = np.outer(n_rows, n_columns).ravel()
+    nonzero_pairs = np.searchsorted(unique_row_totals, row_totals[rows]) * len(unique_column_totals) + np.searchsorted(unique_column_totals, column_totals[columns])
+    n_cells -= np.bincount(nonzero_pairs, minlength=len(n_cells))
+    has_zero_cells = n_cells > 0
+    zero_row_totals, zero_column_totals, n_cells = zero_row_totals[has_zero_cells], zero_column_totals[has_zero_cells], n_cells[has_zero_cells]
+
+    ## cells as a = count, b = column total - a, c = row total - a, like crosstab_2x2_tables
+    a = np.concatenate([counts, np.zeros(len(n_cells), dtype=np.int64)])
+    row_total = np.concatenate([row_totals[rows], zero_row_totals])
+    column_total = np.concatenate([column_totals[columns], zero_column_totals])
+    b, c = column_total - a, row_total - a
+    d = total - row_total - column_total + a
+    weights = np.concatenate([np.ones(len(counts), dtype=np.int64), n_cells])
+
+    fisher_results = fisher_exact_batch(a, b, c, d, mid_p=mid_p)
+    ci_lower, ci_upper = log_odds_ratio_ci(a, b, c, d, alpha=significance)
+    statistics = {
+        "p_value": fisher_results[0],
+        "odds_ratio": fisher_results[1],
+        "log_odds_ratio_ci_lower": ci_lower,
+        "log_odds_ratio_ci_upper": ci_upper,
+        "bh_p_value": adjust_p_values(fisher_results[0], "bh", weights),
+        "bonferroni_p_value": adjust_p_values(fisher_results[0], "bonferroni", weights),
+    }
+    if mid_p:
+        statistics["mid_p_value"] = fisher_results[2]
+    statistics["significant"] = adjust_p_values(fisher_results[0], correction, weights) < significance
+
+    n_nonzero = len(counts)
+    nonzero_statistics = {name: values[:n_nonzero] for name, values in statistics.items()}
+    zero_statistics = {name: values[n_nonzero:] for name, values in statistics.items()}
+    zero_statistics.update(row_total=zero_row_totals, column_total=zero_column_totals, n_cells=n_cells)
+    return nonzero_statistics, zero_statistics
+
+
+def cmh_test_batch(a, b, c, d, continuity=True):
+    """
+    Cochran-Mantel-Haenszel test of the stratified tables [[a, b], [c, d]], with the strata along the last axis.
+    Strata with less than two observations carry no information and are left out
+    :param continuity: subtract 0.5 from the absolute deviation, like R mantelhaen.test
+    :return: {"statistic", "p_value", "odds_ratio" (Mantel-Haenszel common odds ratio), "n_strata"} arrays without the last axis
+    """
+    from scipy.stats import chi2
+
+    a, b, c, d = (np.asarray(x, dtype=np.float64) for x in (a, b, c, d))
+    n = a + b + c + d
+    informative = n > 1
+    n_safe = np.where(informative, n, 2.0)
+    row, column = a + b, a + c
+    expected = np.where(informative, row * column / n_safe, 0.0)
+    variance = np.where(informative, row * column * (n - row) * (n - column) / (n_safe ** 2 * (n_safe - 1)), 0.0)
+
+    deviation = np.abs(np.where(informative, a, 0.0).sum(axis=-1) - expected.sum(axis=-1))
+    if continuity:
+        deviation = np.maximum(deviation - 0.5, 0.0)
+    variance = variance.sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        statistic = np.where(variance > 0, deviation ** 2 / variance, np.nan)
+        odds_ratio = (np.where(informative, a * d / n_safe, 0.0).sum(axis=-1) / np.where(informative, b * c / n_safe, 0.0).sum(axis=-1))
+    return {
+        "statistic": statistic,
+        "p_value": np.where(np.isnan(statistic), 1.0, chi2.sf(np.nan_to_num(statistic), 1)),
+        "odds_ratio": odds_ratio,
+        "n_strata": informative.sum(axis=-1),
+    }
+
+
+def mh_log_odds_ratio_ci(a, b, c, d, alpha=0.05):
+    """
+    Confidence interval of the log Mantel-Haenszel common odds ratio with the Robins-Breslow-Greenland variance,
+    strata along the last axis
+    :return: lower and upper bounds as float arrays without the last axis
+    """
+    from scipy.stats import norm
+
+    a, b, c, d = (np.asarray(x, dtype=np.float64) for x in (a, b, c, d))
+    n = a + b + c + d
+    n_safe = np.where(n > 0, n, 1.0)
+    p, q = (a + d) / n_safe, (b + c) / n_safe
+    r, s = a * d / n_safe, b * c / n_safe
+    r_sum, s_sum = r.sum(axis=-1), s.sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = (
+            (p * r).sum(axis=-1) / (2 * r_sum ** 2)
+            + (p * s + q * r).sum(axis=-1) / (2 * r_sum * s_sum)
+            + (q * s).sum(axis=-1) / (2 * s_sum ** 2)
+        )
+        log_odds_ratio = np.log(r_sum / s_sum)
+    z = norm.ppf(1 - alpha / 2)
+    standard_error = np.sqrt(variance)
+    return log_odds_ratio - z * standard_error, log_odds_ratio + z * standard_error
+
+
+def cube_significance(cube, correction="none", significance=0.05):
+    """
+    Cochran-Mantel-Haenszel test of every cell of a stratified crosstab, computed at once for all cells.
+    The 2x2 tables of a cell come from the totals of its stratum, see crosstab_2x2_tables
+    :param cube: 3D array of counts, rows x columns x strata
+    :return: {name: array rows x columns}
+    """
+    cube = np.asarray(cube, dtype=np.int64)
+    row_totals = cube.sum(axis=1, keepdims=True)
+    column_totals = cube.sum(axis=0, keepdims=True)
+    totals = cube.sum(axis=(0, 1), keepdims=True)
+    a = cube
+    b = column_totals - a
+    c = row_totals - a
+    d = totals - row_totals - column_totals + a
+
+    statistics = cmh_test_batch(a, b, c, d)
+    ci_lower, ci_upper = mh_log_odds_ratio_ci(a, b, c, d, alpha=significance)
+    statistics.update(
+        log_odds_ratio_ci_lower=ci_lower,
+        log_odds_ratio_ci_upper=ci_upper,
+        bh_p_value=adjust_p_values(statistics["p_value"], "bh"),
+        bonferroni_p_value=adjust_p_values(statistics["p_value"], "bonferroni"),
+        significant=adjust_p_values(statistics["p_value"], correction) < significance,
+    )
+    return statistics
+
+
+def _fisher_exact_unique(a, b, c, d):
+    from scipy.stats import hypergeom
+
+    p_values = np.ones(len(a), dtype=np.float64)
+    odds_ratios = np.full(len(a), np.nan, dtype=np.float64)
+    p_observed = np.ones(len(a), dtype=np.float64)
+
+    ## a row or column of zeros gives p-value 1 and an undefined odds ratio
+    defined = (a + b > 0) & (c + d > 0) & (a + c > 0) & (b + d > 0)
+    a, b, c, d = a[defined], b[defined], c[defined], d[defined]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        odds_ratios[defined] = np.where((c > 0) & (b > 0), (a * d) / (c * b), np.inf)
+
+    n1 = a + b
+    total = a + b + c + d
+    n = a + c
+    mode = ((n + 1) * (n1 + 1) / (total + 2)).astype(np.int64)
+    p_exact = hypergeom.pmf(a, total, n1, n)
+    p_mode = hypergeom.pmf(mode, total, n1, n)
+
+    epsilon = 1e-14
+    gamma = 1 + epsilon
+
+    p_values_defined = np.ones(len(a), dtype=np.float64)
+    at_mode = np.abs(p_exact - p_mode) / np.maximum(p_exact, p_mode) <= epsilon
+    lower = ~at_mode & (a < mode)
+    upper = ~at_mode & ~lower
+
+    ## observed count below the mode: lower tail plus the matching upper tail
+    p_lower = hypergeom.cdf(a[lower], total[lower], n1[lower], n[lower])
+    one_tailed = hypergeom.pmf(n[lower], total[lower], n1[lower], n[lower]) > p_exact[lower] * gamma
+    guess = _binary_search_batch(
+        -p_exact[lower] * gamma, mode[lower], n[lower], total[lower], n1[lower], n[lower], sign=-1
+    )
+    p_values_defined[lower] = np.where(
+        one_tailed, p_lower, p_lower + hypergeom.sf(guess, total[lower], n1[lower], n[lower])
+    )
+
+    ## observed count above the mode: upper tail plus the matching lower tail
+    p_upper = hypergeom.sf(a[upper] - 1, total[upper], n1[upper], n[upper])
+    one_tailed = hypergeom.pmf(0, total[upper], n1[upper], n[upper]) > p_exact[upper] * gamma
+    guess = _binary_search_batch(
+        p_exact[upper] * gamma, np.zeros(upper.sum(), dtype=np.int64), mode[upper], total[upper], n1[upper], n[upper], sign=1
+    )
+    p_values_defined[upper] = np.where(
+        one_tailed, p_upper, p_upper + hypergeom.cdf(guess, total[upper], n1[upper], n[upper])
+    )
+
+    p_values[defined] = np.minimum(p_values_defined, 1.0)
+    p_observed[defined] = p_exact
+    return p_values, odds_ratios, p_observed
+
+
+def _binary_search_batch(target, lo, hi, total, n1, n, sign):
+    """
+    Vectorized scipy.stats._stats_py._binary_search over sign * hypergeom.pmf:
+    finds i in [lo, hi] with f(i) <= target < f(i + 1) for every table
+    """
+    from scipy.stats import hypergeom
+
+    def f(x, index):
+        return sign * hypergeom.pmf(x, total[index], n1[index], n[index])
+
+    lo = lo.copy()
+    hi = hi.copy()
+    found = np.zeros(len(lo), dtype=bool)
+    result = np.zeros(len(lo), dtype=np.int64)
+
+    active = np.flatnonzero(lo < hi)
+    while len(active):
+        mid = lo[active] + (hi[active] - lo[active]) // 2
+        values = f(mid, active)
+        below = values < target[active]
+        above = values > target[active]
+        equal = ~below & ~above
+        lo[active[below]] = mid[below] + 1
+        hi[active[above]] = mid[above] - 1
+        found[active[equal]] = True
+        result[active[equal]] = mid[equal]
+        active = active[~equal]
+        active = active[lo[active] < hi[active]]
+
+    rest = np.flatnonzero(~found)
+    result[rest] = np.where(f(lo[rest], rest) <= target[rest], lo[rest], lo[rest] - 1)
+    return result
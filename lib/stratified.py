@@ -0,0 +1,82 @@
+## Stratified analysis of a drug modality x location crosstab, conditioned on a third key such as biotype or targetType.
+## The counts are held in one locations x drug modalities x strata cube built from a single groupby,
+## and every cell is tested at once with the Cochran-Mantel-Haenszel test across the strata, see lib.stats.cube_significance.
+
+import numpy as np
+import pandas as pd
+
+## keys that can be used as strata, any other column of the combined table works as well
+STRATIFY_KEYS = ["biotype", "targetType"]
+
+
+class CountCube:
+    """
+    locations x drug modalities x strata counts with their labels.
+    cube[:, :, k] equals the crosstab of the rows of the k-th stratum, rows with a missing key are left out
+    """
+
+    def __init__(self, counts, locations, modalities, strata, location_key=None, drug_modality_key=None, stratum_key=None):
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.locations = pd.Index(locations, name=location_key)
+        self.modalities = pd.Index(modalities, name=drug_modality_key)
+        self.strata = pd.Index(strata, name=stratum_key)
+        self.location_key = location_key
+        self.drug_modality_key = drug_modality_key
+        self.stratum_key = stratum_key
+
+    @classmethod
+    def from_frame(cls, df, location_key, drug_modality_key, stratum_key):
+        counts = df.groupby([location_key, drug_modality_key, stratum_key], observed=True).size()
+        return cls.from_counts(counts, location_key, drug_modality_key, stratum_key)
+
+    @classmethod
+    def from_counts(cls, counts, location_key, drug_modality_key, stratum_key):
+        """
+        :param counts: pandas series of row counts indexed by (location, drug modality, stratum)
+        """
+        counts = counts[counts > 0]
+        index = counts.index.remove_unused_levels()
+        shape = tuple(len(level) for level in index.levels)
+        flat = np.ravel_multi_index(tuple(index.codes), shape)
+        cube = np.bincount(flat, weights=counts.to_numpy(), minlength=int(np.prod(shape))).astype(np.int64).reshape(shape)
+        return cls(cube, *index.levels, location_key, drug_modality_key, stratum_key)
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    def crosstab(self, stratum=None):
+        """
+        :param stratum: label of one stratum, the crosstab over all strata if None
+        :return: locations x drug modalities pandas dataframe
+        """
+        counts = self.counts.sum(axis=2) if stratum is None else self.counts[:, :, self.strata.get_loc(stratum)]
+        return pd.DataFrame(counts, index=self.locations, columns=self.modalities)
+
+    def significance_table(self, correction="none", significance=0.05):
+        """
+        Cochran-Mantel-Haenszel test of every cell across the strata, see lib.stats.cube_significance
+        :return: pandas dataframe with one row per cell, drug modality by drug modality like lib.data_process.significance_table
+        """
+        from lib.stats import cube_significance
+        statistics = cube_significance(self.counts, correction=correction, significance=significance)
+        n_locations = len(self.locations)
+
+        def cells(values):
+            ## cells in column order, all locations of the first drug modality, then the next one
+            return np.asarray(values).T.ravel()
+
+        return pd.DataFrame({
+            "Drug Modality": np.repeat(self.modalities.to_numpy(), n_locations),
+            "Location": np.tile(self.locations.to_numpy(), len(self.modalities)),
+            "Count": cells(self.counts.sum(axis=2)),
+            "Strata": cells(statistics["n_strata"]),
+            "CMH Statistic": cells(statistics["statistic"]),
+            "P-value": cells(statistics["p_value"]),
+            "Common Odds Ratio": cells(statistics["odds_ratio"]),
+            "Significance": cells(statistics["significant"]),
+            "BH Adjusted P-value": cells(statistics["bh_p_value"]),
+            "Bonferroni Adjusted P-value": cells(statistics["bonferroni_p_value"]),
+            "Log Odds Ratio CI Lower": cells(statistics["log_odds_ratio_ci_lower"]),
+            "Log Odds Ratio CI Upper": cells(statistics["log_odds_ratio_ci_upper"]),
+        })
@@ -0,0 +1,259 @@
+## Scratch space of one pipeline run.
+## The work area is a directory created on first use under the temp root, with a size budget for everything written to it.
+## Intermediate tables are written compressed, and tables are only spilled out of memory when the process or the machine
+## runs short of memory. The directory is removed when the run ends, also on errors, and work areas left behind by killed
+## runs (their process is gone) are removed when the next run starts, so repeated runs do not fill the disk.
+
+import io
+import os
+import shutil
+import tempfile
+
+from settings import WORK_AREA_MEMORY_LIMIT, WORK_AREA_SIZE_LIMIT
+
+## free memory below this fraction of the total memory counts as memory pressure
+MIN_AVAILABLE_MEMORY = 0.1
+PID_FILE = ".pid"
+SPILL_DIR = "spill"
+## rows written to memory to estimate the file size of a table before writing it
+SIZE_SAMPLE_ROWS = 1000
+
+
+class WorkArea:
+    """
+    Directory for the intermediate files of one run:
+
+        with WorkArea(prefix="dataprocess_OT") as work_area:
+            work_area.write_table(df, "preprocessed_targets")
+            work_area.save(out_dir)
+
+    Writes that would take it over size_limit bytes raise an exception before the file is written
+    """
+
+    def __init__(self, root=None, prefix="dataprocess_OT", size_limit=WORK_AREA_SIZE_LIMIT, memory_limit=WORK_AREA_MEMORY_LIMIT,
+                 compress=True):
+        """
+        :param root: directory the work area is created in, the system temp directory by default
+        :param memory_limit: resident memory in bytes above which tables are spilled, None to only watch the free memory
+        :param compress: gzip the tsv files
+        """
+        self.root = root if root is not None else tempfile.gettempdir()
+        self.prefix = prefix
+        self.size_limit = size_limit
+        self.memory_limit = memory_limit
+        self.compress = compress
+        self._dir = None
+        self._spilled = {}
+
+    @property
+    def dir(self):
+        """
+        The work area directory, created with the first access
+        """
+        if self._dir is None:
+            os.makedirs(self.root, exist_ok=True)
+            self.remove_stale(self.root, self.prefix)
+            self._dir = tempfile.mkdtemp(prefix=self.prefix, dir=self.root)
+            with open(os.path.join(self._dir, PID_FILE), "w") as fh:
+                fh.write(str(os.getpid()))
+        return self._dir
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+        return False
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def size(self):
+        """
+        :return: bytes used by the work area
+        """
+        if self._dir is None or not os.path.exists(self._dir):
+            return 0
+        return sum(
+            os.path.getsize(os.path.join(directory, file)) for directory, _, files in os.walk(self._dir) for file in files
+        )
+
+    def fits(self, n_bytes):
+        """
+        :return: True if n_bytes more stay within the size limit
+        """
+        return self.size() + n_bytes <= self.size_limit
+
+    def reserve(self, n_bytes, name):
+        """
+        Raises if writing n_bytes more, the (estimated) size of the file name, would take the work area over its size limit
+        """
+        if not self.fits(n_bytes):
+            raise Exception(
+                f"Work area {self.dir} has no room for {name}: {n_bytes / 2 ** 20:.1f} MB more would exceed its size limit "
+                f"of {self.size_limit / 2 ** 20:.1f} MB, {self.size() / 2 ** 20:.1f} MB are used"
+            )
+
+    def _check_size(self, path):
+        """
+        Removes path again and raises if it took the work area over its size limit, e.g. when its size was underestimated
+        :return: path
+        """
+        size = self.size()
+        if size <= self.size_limit:
+            return path
+        os.remove(path)
+        raise Exception(f"Work area {self._dir} is over its size limit of {self.size_limit / 2 ** 20:.1f} MB with {os.path.basename(path)}, removed it")
+
+    def _write_csv(self, df, path_or_buffer):
+        if self.compress:
+            ## the lowest level is a few times faster than the default and compresses the repetitive tables almost as well
+            df.to_csv(path_or_buffer, sep="\t", index=False, compression={"method": "gzip", "compresslevel": 1})
+        else:
+            df.to_csv(path_or_buffer, sep="\t", index=False)
+
+    def estimate_table_size(self, df):
+        """
+        :return: estimated bytes of the file of write_table, extrapolated from the first SIZE_SAMPLE_ROWS rows
+        """
+        sample = df.head(SIZE_SAMPLE_ROWS)
+        if not len(sample):
+            return 0
+        buffer = io.BytesIO()
+        self._write_csv(sample, buffer)
+        return int(len(buffer.getvalue()) * len(df) / len(sample))
+
+    def write_table(self, df, name):
+        """
+        Writes df as <name>.tsv, gzipped as <name>.tsv.gz if compress is set.
+        Raises if the estimated or the written file does not fit into the size limit
+        :return: the written file
+        """
+        path = self.path(f"{name}.tsv.gz" if self.compress else f"{name}.tsv")
+        self.reserve(self.estimate_table_size(df), os.path.basename(path))
+        self._write_csv(df, path)
+        return self._check_size(path)
+
+    def add_file(self, path):
+        """
+        Counts a file written into the work area by other code, e.g. a binary combined file, against the size limit.
+        Raises and removes it if it does not fit, see reserve to check an estimate before writing
+        """
+        return self._check_size(path)
+
+    def memory_pressure(self):
+        """
+        :return: True if the resident memory is over memory_limit or the free memory of the machine is low
+        """
+        from lib.profiling import RunProfile
+        rss_mb = RunProfile._rss_mb()
+        if self.memory_limit is not None and rss_mb is not None and rss_mb * 2 ** 20 > self.memory_limit:
+            return True
+        memory = _meminfo()
+        return bool(memory) and memory["MemAvailable"] < MIN_AVAILABLE_MEMORY * memory["MemTotal"]
+
+    def spill(self, name, df):
+        """
+        Writes df to the work area as parquet so the caller can drop it from memory, see restore
+        :return: True if df was spilled, False if it did not fit into the size limit and has to stay in memory
+        """
+        ## the in-memory size bounds the parquet file, which is compressed
+        if not self.fits(df.memory_usage(deep=True).sum()):
+            print(f"Not spilling {name}, it does not fit into the size limit of work area {self.dir}")
+            return False
+        os.makedirs(self.path(SPILL_DIR), exist_ok=True)
+        path = _write_parquet(df, self.path(os.path.join(SPILL_DIR, f"{name}.parquet")))
+        self._spilled[name] = path
+        print(f"Spilled {name} to {path}")
+        return True
+
+    def is_spilled(self, name):
+        return name in self._spilled
+
+    def restore(self, name):
+        """
+        :return: the spilled dataframe, its file is removed
+        """
+        import pandas as pd
+        path = self._spilled.pop(name)
+        df = pd.read_parquet(path)
+        os.remove(path)
+        return df
+
+    def save(self, out_dir):
+        """
+        Copies the files of the work area, but not the spilled tables, into out_dir
+        :return: list of the copied files
+        """
+        if self._dir is None:
+            return []
+        os.makedirs(out_dir, exist_ok=True)
+        copied = []
+        for file in sorted(os.listdir(self._dir)):
+            path = os.path.join(self._dir, file)
+            if file == PID_FILE or not os.path.isfile(path):
+                continue
+            copied.append(shutil.copy2(path, os.path.join(out_dir, file)))
+        print(f"Saved {', '.join(os.path.basename(file) for file in copied)} to {out_dir}")
+        return copied
+
+    def cleanup(self):
+        """
+        Removes the work area directory, can be called more than once
+        """
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+        self._dir = None
+        self._spilled = {}
+
+    @staticmethod
+    def remove_stale(root, prefix):
+        """
+        Removes the work areas in root whose process is not running anymore
+        :return: list of the removed directories
+        """
+        removed = []
+        for name in os.listdir(root):
+            directory = os.path.join(root, name)
+            pid_file = os.path.join(directory, PID_FILE)
+            if not name.startswith(prefix) or not os.path.isfile(pid_file):
+                continue
+            try:
+                with open(pid_file) as fh:
+                    pid = int(fh.read())
+            except (OSError, ValueError):
+                continue
+            if not _process_running(pid):
+                shutil.rmtree(directory, ignore_errors=True)
+                removed.append(directory)
+        if removed:
+            print(f"Removed {len(removed)} work areas of finished runs from {root}")
+        return removed
+
+
+def _write_parquet(df, path):
+    from lib.cache import PreprocessCache
+    PreprocessCache._with_categoricals(df).to_parquet(path, index=False)
+    return path
+
+
+def _process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        ## running, but as another user
+        return True
+    return True
+
+
+def _meminfo():
+    """
+    :return: {field: bytes} of /proc/meminfo, empty where it is not available
+    """
+    try:
+        with open("/proc/meminfo") as fh:
+            return {line.split(":")[0]: int(line.split()[1]) * 1024 for line in fh}
+    except (OSError, ValueError, IndexError):
+        return {}
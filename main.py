@@ -9,11 +9,49 @@
 ## across various subcellular locations.
 ## 4. Enhance the analysis with visualisations that illustrate your results.
 
-def download_files():
-    from lib.download_data import DownloadPrepareInitialData
-    init_data_obj = DownloadPrepareInitialData()
-    init_data_obj.process()
-    return init_data_obj.get_combined_files()
+def _read_ids(values, pattern, name):
+    """
+    :param values: IDs, or files with one ID per line
+    :param pattern: regular expression of a valid ID, e.g. ENSG\\d+
+    :return: list of IDs. Raises if a value is neither a valid ID nor an existing file, e.g. a mistyped file name
+    """
+    import os
+    import re
+    ids = []
+    for value in values or []:
+        if os.path.isfile(value):
+            with open(value) as fh:
+                ids += [line.strip() for line in fh if line.strip()]
+        else:
+            ids.append(value)
+    invalid = [value for value in ids if not re.fullmatch(pattern, value)]
+    if invalid:
+        raise Exception(f"{len(invalid)} {name} values are neither {name} IDs nor existing files: {', '.join(invalid[:10])}")
+    return ids
+
+def download_files(args, profile):
+    if args.api_targets or args.api_molecules:
+        ## only the records of the given IDs, from the GraphQL API
+        from lib.api_ingest import ApiIngest
+        from settings import API_CACHE_DIR, OPENTARGETS_API_URL
+        init_data_obj = ApiIngest(
+            target_ids=_read_ids(args.api_targets, r"ENSG\d+", "Ensembl"), molecule_ids=_read_ids(args.api_molecules, r"CHEMBL\d+", "ChEMBL"),
+            url=args.api_url or OPENTARGETS_API_URL,
+            cache_dir=None if args.no_api_cache else (args.api_cache_dir or API_CACHE_DIR), concurrency=args.api_concurrency,
+            batch_size=args.api_batch_size, profile=profile, work_dir=args.temp_dir,
+        )
+    else:
+        from lib.download_data import DownloadPrepareInitialData
+        init_data_obj = DownloadPrepareInitialData(
+            work_dir=args.mirror_dir, workers=args.download_workers, profile=profile, join=not args.no_join,
+            temp_dir=args.temp_dir, work_area_size_limit=int(args.work_area_size_limit * 2 ** 30),
+        )
+    try:
+        init_data_obj.process()
+    except BaseException:
+        init_data_obj.cleanup()
+        raise
+    return init_data_obj
 
 def run_data_analysis(args):
     """
@@ -21,11 +59,23 @@ def run_data_analysis(args):
     :param args:
     :return:
     """
+    from lib.profiling import RunProfile
+    profile = RunProfile(enabled=args.profile)
+
     ## Get data files
     download = args.do_not_download and args.combined_file is None
-    targets_file, moa_file, drugs_file = download_files() if download else (None, None, None)
+    init_data_obj = download_files(args, profile) if download else None
+    try:
+        _run_data_process(args, profile, *(init_data_obj.get_combined_files() if download else (None, None, None)))
+    finally:
+        ## the joined dataset files are only needed by this run
+        if init_data_obj is not None:
+            init_data_obj.cleanup()
 
-    from lib.data_process import DataProcess
+def _run_data_process(args, profile, targets_file, moa_file, drugs_file):
+    from lib.data_process import DataProcess, DRUG_MODALITY_KEYS, LOCATION_KEYS
+    if args.all_keys:
+        args.drug_modality, args.location_key = DRUG_MODALITY_KEYS, LOCATION_KEYS
     dataprocess_obj = DataProcess(
         targets_file=targets_file,
         mechanism_of_action_file=moa_file,
@@ -36,23 +86,106 @@ def run_data_analysis(args):
         save_preprocess_data=args.save_process_data,
         out_dir=args.out_dir,
         temp_dir=args.temp_dir,
-        show_only_significant=args.only_significant
+        show_only_significant=args.only_significant,
+        correction=args.correction,
+        mid_p=args.mid_p,
+        workers=args.workers,
+        chunksize=args.chunksize,
+        use_cache=not args.no_cache,
+        cache_dir=args.cache_dir,
+        cache_size_limit=int(args.cache_size_limit * 2 ** 30),
+        profile=profile,
+        permutations=args.permutations,
+        seed=args.seed,
+        previous_release=args.previous_release,
+        plot_formats=args.plot_formats,
+        combined_format=args.combined_format,
+        plots=not args.no_plots,
+        sparse=args.sparse,
+        stratify_by=args.stratify_by,
+        count_mode=args.count_mode,
+        work_area_size_limit=int(args.work_area_size_limit * 2 ** 30),
+        memory_limit=int(args.memory_limit * 2 ** 30) if args.memory_limit is not None else None,
+        bootstrap=args.bootstrap,
+        bootstrap_unit={"drug": "ChemblID", "target": "EnsemblID"}[args.bootstrap_unit],
     )
     ## Process the data
     dataprocess_obj.process()
+    from settings import DATA_VERSION
+    dataprocess_obj.write_profile(release=DATA_VERSION, arguments=vars(args))
+
+def run_server(args):
+    """
+    Serves the crosstabs and significance tables of --combined_file, or of the cached combined table of the release.
+    Runs the download and preprocessing first if the cache has none
+    """
+    from lib.server import QueryService, serve
+    if args.combined_file is not None:
+        service = QueryService.from_combined_file(args.combined_file)
+    else:
+        from lib.cache import PreprocessCache
+        if PreprocessCache(cache_dir=args.cache_dir).latest() is None:
+            from lib.analysis import CombinedAnalysis
+            from lib.profiling import RunProfile
+            init_data_obj = download_files(args, RunProfile())
+            try:
+                CombinedAnalysis.from_datasets(*init_data_obj.get_combined_files(), cache_dir=args.cache_dir, workers=args.workers)
+            finally:
+                init_data_obj.cleanup()
+        service = QueryService.from_cache(cache_dir=args.cache_dir)
+    serve(service, host=args.host, port=args.port)
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
+    from settings import API_BATCH_SIZE, API_CONCURRENCY, CACHE_SIZE_LIMIT, DOWNLOAD_WORKERS, WORK_AREA_SIZE_LIMIT
     parser = ArgumentParser()
 
     parser.add_argument("--do_not_download", action="store_false", help="Does not downloads the data if --combined_file is given.", required=False)
-    parser.add_argument("--combined_file", type=str, help="Combined file for all data", required=False, default=None)
-    parser.add_argument("--drug_modality", type=str, help="Drug modality key", required=False, default="drugType")
-    parser.add_argument("--location_key", type=str, help="Select from subcellular_location_label or subcellular_location", required=False, default="subcellular_location_label")
+    parser.add_argument("--combined_file", type=str, help="Combined file for all data, tsv or the binary format of --combined_format arrow", required=False, default=None)
+    parser.add_argument("--combined_format", type=str, choices=["tsv", "arrow"], help="Format of the combined file saved with --save_process_data", required=False, default="tsv")
+    parser.add_argument("--drug_modality", type=str, nargs="+", help="Drug modality key, several keys are analysed in one run. Keys joined with + are combined, e.g. drugType+biotype", required=False, default=["drugType"])
+    parser.add_argument("--location_key", type=str, nargs="+", help="Select from subcellular_location_label or subcellular_location, or both", required=False, default=["subcellular_location_label"])
+    parser.add_argument("--all_keys", action="store_true", help="Analyse every drug modality and location key combination", required=False, default=False)
+    parser.add_argument("--workers", type=int, help="Number of processes reading part files and analysing the combinations in parallel", required=False, default=None)
+    parser.add_argument("--chunksize", type=int, help="Read --combined_file in chunks of this many rows, for files larger than memory", required=False, default=None)
     parser.add_argument("--save_process_data", action="store_true", help="Save processed data", required=False, default=False)
     parser.add_argument("--out_dir", type=str, help="Output directory", required=False, default=None)
-    parser.add_argument("--temp_dir", type=str, help="Temporary directory", required=False, default=None)
+    parser.add_argument("--temp_dir", type=str, help="Directory the work area of the run is created in, the system temporary directory by default", required=False, default=None)
+    parser.add_argument("--work_area_size_limit", type=float, help="Size limit of the work area in GB", required=False, default=WORK_AREA_SIZE_LIMIT / 2 ** 30)
+    parser.add_argument("--memory_limit", type=float, help="Resident memory in GB above which finished tables are spilled to the work area", required=False, default=None)
+    parser.add_argument("--mirror_dir", type=str, help="Directory of the local dataset mirror, defaults to settings.MIRROR_DIR/DATA_VERSION", required=False, default=None)
+    parser.add_argument("--no_join", action="store_true", help="Do not join the downloaded part files, read them in parallel over --workers processes", required=False, default=False)
+    parser.add_argument("--api_targets", type=str, nargs="+", help="Fetch only these Ensembl IDs (or files with one ID per line) and their known drugs from the GraphQL API instead of downloading the release", required=False, default=None)
+    parser.add_argument("--api_molecules", type=str, nargs="+", help="Fetch only these ChEMBL IDs (or files with one ID per line) and their targets from the GraphQL API instead of downloading the release", required=False, default=None)
+    parser.add_argument("--api_url", type=str, help="GraphQL endpoint, defaults to settings.OPENTARGETS_API_URL", required=False, default=None)
+    parser.add_argument("--api_cache_dir", type=str, help="Directory of the API response cache, defaults to settings.API_CACHE_DIR", required=False, default=None)
+    parser.add_argument("--no_api_cache", action="store_true", help="Do not read or write the API response cache", required=False, default=False)
+    parser.add_argument("--api_concurrency", type=int, help="Number of API requests in flight at a time", required=False, default=API_CONCURRENCY)
+    parser.add_argument("--api_batch_size", type=int, help="Number of IDs per API request", required=False, default=API_BATCH_SIZE)
+    parser.add_argument("--download_workers", type=int, help="Number of files downloaded at the same time", required=False, default=DOWNLOAD_WORKERS)
+    parser.add_argument("--cache_dir", type=str, help="Directory of the preprocessed tables cache, defaults to settings.CACHE_DIR", required=False, default=None)
+    parser.add_argument("--cache_size_limit", type=float, help="Cache size limit in GB, least recently used tables are evicted", required=False, default=CACHE_SIZE_LIMIT / 2 ** 30)
+    parser.add_argument("--no_cache", action="store_true", help="Do not read or write the preprocessed tables cache", required=False, default=False)
+    parser.add_argument("--previous_release", type=str, help="Update the cached tables of this release with the differences to the current release and report the changes per cell", required=False, default=None)
+    parser.add_argument("--permutations", type=int, help="Also report empirical p-values from up to this many drug level permutations of the modality labels", required=False, default=0)
+    parser.add_argument("--bootstrap", type=int, help="Also report bootstrap confidence intervals of the percentages from this many resamples, drawn as error bars on the stacked bars", required=False, default=0)
+    parser.add_argument("--bootstrap_unit", type=str, choices=["drug", "target"], help="Units resampled by --bootstrap", required=False, default="drug")
+    parser.add_argument("--seed", type=int, help="Random seed of the permutations and the bootstrap", required=False, default=0)
+    parser.add_argument("--profile", action="store_true", help="Write timings, CPU, memory and row counts of every stage to run_profile.json in --out_dir", required=False, default=False)
+    parser.add_argument("--plot_formats", type=str, nargs="+", choices=["pdf", "png", "svg"], help="Formats of the figures", required=False, default=["pdf"])
+    parser.add_argument("--sparse", action="store_true", help="Sparse crosstabs, only the non-zero cells are counted and reported. For high-cardinality keys such as subcellular_location or drugType+biotype", required=False, default=False)
+    parser.add_argument("--stratify_by", type=str, help="Also test every drug modality and location cell across the strata of this key (e.g. biotype or targetType) with the Cochran-Mantel-Haenszel test", required=False, default=None)
+    parser.add_argument("--count_mode", type=str, choices=["rows", "drug_location", "drug_target"], help="Count every combined row, or the distinct drug and location (drug and target) pairs of every cell", required=False, default="rows")
+    parser.add_argument("--no_plots", action="store_true", help="Only write the significance reports, no figures", required=False, default=False)
+    parser.add_argument("--serve", action="store_true", help="Serve counts, percentages and significance of all keys as json over http instead of writing reports", required=False, default=False)
+    parser.add_argument("--host", type=str, help="Host of --serve", required=False, default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Port of --serve", required=False, default=8000)
     parser.add_argument("--only_significant", action="store_true", help="Only report significant results", required=False, default=False)
+    parser.add_argument("--correction", type=str, choices=["none", "bh", "bonferroni"], help="Multiple testing correction of the p-values used for significance", required=False, default="none")
+    parser.add_argument("--mid_p", action="store_true", help="Also report mid-p values", required=False, default=False)
 
     args = parser.parse_args()
-    run_data_analysis(args)
\ No newline at end of file
+    if args.serve:
+        run_server(args)
+    else:
+        run_data_analysis(args)
\ No newline at end of file
@@ -1,5 +1,27 @@
+import os
+
 OPENTARGETS_LINK = "ftp://ftp.ebi.ac.uk/pub/databases/opentargets/platform"
 DATA_VERSION = "24.03"
 DATA_TYPE="json"
 DATASETS = ["targets", "mechanismOfAction", "molecule"]
 
+## Local copy of the downloaded datasets, one sub directory per DATA_VERSION
+MIRROR_DIR = os.environ.get("OT_MIRROR_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "mirror"))
+DOWNLOAD_WORKERS = 8
+
+## Parquet cache of the preprocessed and combined tables
+CACHE_DIR = os.environ.get("OT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cache"))
+CACHE_SIZE_LIMIT = 5 * 2 ** 30
+
+## Scratch space of one run, see lib.work_area.WorkArea
+WORK_AREA_SIZE_LIMIT = 20 * 2 ** 30
+## resident memory in bytes above which finished tables are spilled to the work area, None to only spill when the machine runs low
+WORK_AREA_MEMORY_LIMIT = None
+
+## GraphQL API of the platform, fetches only the records of given target and molecule IDs, see lib.api_ingest
+OPENTARGETS_API_URL = os.environ.get("OT_API_URL", "https://api.platform.opentargets.org/api/v4/graphql")
+API_CACHE_DIR = os.environ.get("OT_API_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "api_cache"))
+## cached responses older than this many seconds are fetched again, the API always serves the latest release
+API_CACHE_MAX_AGE = 7 * 24 * 3600
+API_CONCURRENCY = 4
+API_BATCH_SIZE = 50
@@ -1,5 +1,4 @@
-import numpy as np
-import pandas as pd
+## numpy and pandas are imported by the functions that use them, so importing utils stays cheap
 import ast
 import os
 
@@ -34,7 +33,7 @@ def call_subprocess(command: str, params: list, outfile=None, chdir=None):
     return return_code, retstdout
 
 
-def convert_json2pandas(jsonfile: str, output_file: str = None) -> pd.DataFrame:
+def convert_json2pandas(jsonfile: str, output_file: str = None) -> "pd.DataFrame":
     """
     :param jsonfile: The path for the Json file in Json lines format
         Line1-  {"key" : "value"}
@@ -54,12 +53,158 @@ def convert_json2pandas(jsonfile: str, output_file: str = None) -> pd.DataFrame:
     return pd_df
 
 
+def _get_json_field(record: dict, field: str):
+    """
+    Returns the value of a field from a parsed json record.
+    Nested fields are addressed with dots as json_normalize names them, e.g. "linkedTargets.rows"
+    """
+    value = record
+    for key in field.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key, None)
+    return value
+
+
+def iter_json_chunks(jsonfile: str, fields: list, chunksize: int = 50000, dtypes: dict = None):
+    """
+    Streams a Json lines file as pandas dataframes, keeping only the requested fields.
+    Records are parsed line by line and only the projected values are kept, so the memory
+    is bounded by the chunksize instead of the file size.
+    :param jsonfile: The path for the Json file in Json lines format
+    :param fields: field names to keep, nested fields as "parent.child"
+    :param chunksize: maximum number of records per dataframe
+    :param dtypes: optional {field: dtype} applied to every chunk
+    :return: generator of pandas dataframes indexed by the line order of the records
+    """
+    import json
+    import pandas as pd
+
+    def _to_frame(columns, start):
+        df = pd.DataFrame(columns, columns=fields)
+        df.index = pd.RangeIndex(start, start + len(df))
+        if dtypes:
+            df = df.astype(dtypes)
+        return df
+
+    start = 0
+    columns = {field: [] for field in fields}
+    n_records = 0
+    with open(jsonfile, "r") as fh:
+        for json_line in fh:
+            if not json_line.strip(): continue
+            record = json.loads(json_line)
+            for field in fields:
+                columns[field].append(_get_json_field(record, field))
+            n_records += 1
+            if n_records == chunksize:
+                yield _to_frame(columns, start)
+                start += n_records
+                columns = {field: [] for field in fields}
+                n_records = 0
+
+    if n_records or start == 0:
+        yield _to_frame(columns, start)
+
+
+def read_json_fields(jsonfile: str, fields: list, chunksize: int = 50000, dtypes: dict = None) -> "pd.DataFrame":
+    """
+    Reads only the requested fields of a Json lines file into one dataframe.
+    See iter_json_chunks
+    :return: pandas dataframe
+    """
+    import pandas as pd
+    pd_df = pd.concat(iter_json_chunks(jsonfile, fields, chunksize=chunksize, dtypes=dtypes))
+    if dtypes:
+        ## categories differ between chunks, so concat falls back to object columns
+        pd_df = pd_df.astype(dtypes)
+    return pd_df
+
+
+def chunked_crosstabs(table_file: str, key_pairs: list, chunksize: int = 1000000, sep: str = "\t") -> dict:
+    """
+    Builds pd.crosstab(df[row_key], df[column_key]) for every pair without loading the whole table.
+    The file is read in chunks with only the needed columns, and the counts of the non-empty cells
+    are accumulated per pair, so memory is bounded by the chunksize and the number of non-empty cells.
+    :param table_file: delimited table with a header line
+    :param key_pairs: list of (row_key, column_key)
+    :return: {(row_key, column_key): contingency table}
+    """
+    import numpy as np
+    import pandas as pd
+    columns = sorted({key for pair in key_pairs for key in pair})
+    counts = {pair: None for pair in key_pairs}
+    for chunk in pd.read_csv(table_file, sep=sep, usecols=columns, dtype=str, chunksize=chunksize):
+        for row_key, column_key in key_pairs:
+            chunk_counts = chunk.groupby([row_key, column_key]).size()
+            previous = counts[(row_key, column_key)]
+            counts[(row_key, column_key)] = chunk_counts if previous is None else previous.add(chunk_counts, fill_value=0)
+
+    return {
+        pair: pair_counts.unstack(fill_value=0).astype(np.int64).rename_axis(index=pair[0], columns=pair[1])
+        for pair, pair_counts in counts.items()
+    }
+
+
+def file_fingerprint(path: str, block_size: int = 2 ** 24) -> str:
+    """
+    Content fingerprint of a file. Part files of a dataset mirror (see lib.mirror.DatasetMirror) are identified by their
+    name and the size and modification time on the server, as recorded in the mirror manifest when they were fetched.
+    Other files, e.g. joined dumps, are identified by their size and a streaming hash of their whole content.
+    Does not depend on the local path or modification time, so re-downloaded or re-joined copies of the same data match.
+    The fingerprint of a directory combines the fingerprints of its json part files
+    :return: hex digest
+    """
+    import hashlib
+    if os.path.isdir(path):
+        part_files = sorted(file for file in os.listdir(path) if file.endswith(".json"))
+        manifest = _mirror_manifest(path)
+        digest = hashlib.sha1()
+        for file in part_files:
+            digest.update(f"{file}:{_part_file_fingerprint(os.path.join(path, file), manifest, block_size)}".encode())
+        return digest.hexdigest()
+    return _part_file_fingerprint(path, _mirror_manifest(os.path.dirname(path)), block_size)
+
+
+def _mirror_manifest(dataset_dir: str) -> dict:
+    """
+    :return: the manifest of the mirror a dataset directory belongs to, empty if it is not in a mirror
+    """
+    import json
+    from lib.mirror import DatasetMirror
+    manifest_file = os.path.join(os.path.dirname(os.path.abspath(dataset_dir)), DatasetMirror.MANIFEST)
+    if not os.path.isfile(manifest_file):
+        return {}
+    try:
+        with open(manifest_file) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def _part_file_fingerprint(path: str, manifest: dict, block_size: int) -> str:
+    import hashlib
+    size = os.path.getsize(path)
+    key = f"{os.path.basename(os.path.dirname(os.path.abspath(path)))}/{os.path.basename(path)}"
+    record = manifest.get(key)
+    ## the manifest entry only vouches for the file while it has the fetched size and the server sent a modification time
+    if record is not None and record.get("modified") is not None and record.get("size") == size:
+        return hashlib.sha1(f"mirror:{key}:{size}:{record['modified']}".encode()).hexdigest()
+
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def convert_to_list(string):
     """
     Convert literal string in dataframe to a format that can be evaluated
     :param string:
     :return:
     """
+    import numpy as np
     if any([isinstance(string, list), isinstance(string, dict), string in [None, np.nan]]):
         return string
     try:
@@ -89,7 +234,7 @@ def test_significance(data, column_name, row_name):
     row_column = data[column_name][row_name]
     not_row_all_column = data[column_name].sum() - row_column
     all_row_not_column = data.loc[row_name].sum() - row_column
-    not_row_not_column = data.sum().sum() - not_row_all_column - all_row_not_column + row_column
+    not_row_not_column = data.sum().sum() - not_row_all_column - all_row_not_column - row_column
     contingency_table[0][0] = row_column ## column+row sum
     contingency_table[1][0] = all_row_not_column ## row - column
     contingency_table[0][1] = not_row_all_column